@@ -13,6 +13,7 @@ from scipy import spatial
 from maskgen.cv2api import cv2api_delegate
 from maskgen.image_wrap import ImageWrapper
 from maskgen.tool_set import VidTimeManager, differenceInFramesBetweenMillisecondsAndFrame
+from maskgen.video_tools import openAtStart
 
 import hashlib
 
@@ -29,12 +30,11 @@ def readFrames(in_file, start_time, end_time):
     """
     if not os.path.exists(in_file):
         raise ValueError(in_file + ' not found')
-    cap = cv2api_delegate.videoCapture(in_file)
     frames = list()
     histograms = list()
     fps = 0.0
-    startFrame = 0
     time_manager = VidTimeManager(startTimeandFrame=start_time, stopTimeandFrame=end_time)
+    cap, startFrame, elapsed_time = openAtStart(lambda: cv2api_delegate.videoCapture(in_file), time_manager)
     try:
         while (cap.grab()):
             fps = cap.get(cv2api_delegate.prop_fps)
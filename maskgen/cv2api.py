@@ -7,6 +7,7 @@
 #==============================================================================
 
 import cv2
+import numpy as np
 import ffmpeg_api
 
 """
@@ -60,6 +61,7 @@ class CAPReaderWithFFMPEG(CAPReader):
         """
         CAPReader.__init__(self, cap)
         self.frames = frames
+        self.times = ffmpeg_api.get_frame_table(frames, attributes=['pkt_pts_time', 'pkt_dts_time'])
         self.pos = 0
         self.last_frame = None
         self.use_last_frame = False
@@ -91,14 +93,10 @@ class CAPReaderWithFFMPEG(CAPReader):
         return ret, last_frame
 
     def get(self, prop):
-        if prop == cv2api_delegate.prop_pos_msec:
-            try:
-                return float(self.frames[self.pos]['pkt_pts_time']) * 1000
-            except:
-                try:
-                    return float(self.frames[self.pos]['pkt_dts_time']) * 1000
-                except:
-                    pass
+        if prop == cv2api_delegate.prop_pos_msec and self.pos < len(self.times):
+            for attribute in ['pkt_pts_time', 'pkt_dts_time']:
+                if not np.isnan(self.times[attribute][self.pos]):
+                    return self.times[attribute][self.pos] * 1000
         return CAPReader.get(self, prop)
 
 class CV2Api:
@@ -140,6 +138,7 @@ class CV2ApiV2(CV2Api):
         self.prop_frame_width = cv2.cv.CV_CAP_PROP_FRAME_WIDTH
         self.prop_fps = cv2.cv.CV_CAP_PROP_FPS
         self.prop_frame_count = cv2.cv.CV_CAP_PROP_FRAME_COUNT
+        self.prop_pos_frames = cv2.cv.CV_CAP_PROP_POS_FRAMES
         self.tm_sqdiff_normed = cv2.cv.CV_TM_SQDIFF_NORMED
         self.tm_ccorr_normed = cv2.cv.CV_TM_CCORR_NORMED
         self.fourcc_prop = cv2.cv.CV_CAP_PROP_FOURCC
@@ -181,6 +180,7 @@ class CV2ApiV3(CV2Api):
         self.prop_frame_width = cv2.CAP_PROP_FRAME_WIDTH
         self.prop_fps = cv2.CAP_PROP_FPS
         self.prop_frame_count = cv2.CAP_PROP_FRAME_COUNT
+        self.prop_pos_frames = cv2.CAP_PROP_POS_FRAMES
         self.tm_sqdiff_normed = cv2.TM_SQDIFF_NORMED
         self.tm_ccorr_normed = cv2.TM_CCORR_NORMED
         self.fourcc = cv2.CAP_PROP_FOURCC
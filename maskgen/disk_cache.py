@@ -0,0 +1,224 @@
+# =============================================================================
+# Authors: PAR Government
+# Organization: DARPA
+#
+# Copyright (c) 2016 PAR Government
+# All rights reserved.
+# ==============================================================================
+
+import os
+import hashlib
+import tempfile
+import logging
+import zlib
+import cPickle
+import time
+from threading import RLock
+from cachetools import LRUCache
+
+file_md5_lock = RLock()
+file_md5_memo = LRUCache(maxsize=1024)
+
+
+def file_identity(filename):
+    """
+    :param filename:
+    :return: (absolute path, size, modification time) or None if missing
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return os.path.abspath(filename), st.st_size, st.st_mtime
+
+
+def file_md5(filename):
+    """
+    MD5 of the file content, remembered for the file identity (path, size and modification time)
+    :param filename:
+    :return: hex digest or '' if the file is missing
+    """
+    identity = file_identity(filename)
+    if identity is None:
+        return ''
+    with file_md5_lock:
+        digest = file_md5_memo.get(identity)
+    if digest is not None:
+        return digest
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            md5.update(block)
+    digest = md5.hexdigest()
+    with file_md5_lock:
+        file_md5_memo[identity] = digest
+    return digest
+
+
+def make_key(*parts):
+    """
+    Hash of the parts.  Arrays (anything with tobytes) contribute their shape, type and content.
+    :param parts:
+    :return: hex digest
+    """
+    md5 = hashlib.md5()
+    for part in parts:
+        if hasattr(part, 'tobytes') and hasattr(part, 'shape'):
+            md5.update(str((part.shape, str(part.dtype))))
+            md5.update(part.tobytes())
+        else:
+            md5.update(repr(part))
+        md5.update('|')
+    return md5.hexdigest()
+
+
+class DiskCache:
+    """
+    Content-addressed store of pickled values in a directory.
+    The directory may be shared by processes: entries are written to a temporary file and
+    renamed in place, so a reader sees a complete entry or none.
+    Reading an entry refreshes its modification time; the least recently used entries
+    are evicted to keep the directory within the byte budget.
+    """
+
+    suffix = '.pkl'
+
+    def __init__(self, directory, max_bytes=2 * 1024 * 1024 * 1024, compress=True):
+        """
+        :param directory:
+        :param max_bytes: byte budget
+        :param compress: compress (zlib) the entries; suited to masks
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.lock = RLock()
+        self.bytes_since_check = None
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created by another process
+                pass
+
+    def __getstate__(self):
+        # sent to worker processes: the lock is not picklable and is per process
+        state = self.__dict__.copy()
+        state.pop('lock', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = RLock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[0:2], key + self.suffix)
+
+    def get(self, key):
+        """
+        :param key: see make_key
+        :return: the value or None if absent
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+            value = cPickle.loads(zlib.decompress(data) if self.compress else data)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            logging.getLogger('maskgen').warning('Discarding unreadable cache entry {}: {}'.format(path, str(e)))
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """
+        :param key: see make_key
+        :param value: picklable value
+        """
+        path = self._path(key)
+        data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        if self.compress:
+            data = zlib.compress(data, 1)
+        entry_dir = os.path.dirname(path)
+        if not os.path.exists(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                pass
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            try:
+                os.rename(temp_path, path)
+            except OSError:
+                # the entry already exists (Windows); the content is the same
+                self._remove(temp_path)
+        except (IOError, OSError) as e:
+            logging.getLogger('maskgen').warning('Cannot write cache entry {}: {}'.format(path, str(e)))
+            return
+        self._account(len(data))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _account(self, size):
+        with self.lock:
+            if self.bytes_since_check is not None:
+                self.bytes_since_check += size
+                if self.bytes_since_check < self.max_bytes / 20:
+                    return
+            self.bytes_since_check = 0
+        self.evict()
+
+    def size(self):
+        """
+        :return: bytes held by the entries
+        """
+        return sum([entry[1] for entry in self._entries()])
+
+    def _entries(self):
+        entries = []
+        stale = time.time() - 3600
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith('.tmp'):
+                    # abandoned by a failed writer
+                    if st.st_mtime < stale:
+                        self._remove(path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used entries until the directory is within 90% of the byte budget.
+        """
+        entries = self._entries()
+        total = sum([entry[1] for entry in entries])
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        for mtime, size, path in self._entries():
+            self._remove(path)
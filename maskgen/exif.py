@@ -14,6 +14,7 @@ from threading import RLock
 import numpy as np
 from cachetools import LRUCache
 from cachetools import cached
+from maskgen_loader import MaskGenLoader
 
 
 
@@ -150,7 +151,8 @@ def runexif(args, fix=True, ignoreError=False):
 
 
 exif_lock = RLock()
-exif_cache = LRUCache(maxsize=12)
+# exif of the most recent files (preference exif_cache_size), e.g. those opened by the media prefetch
+exif_cache = LRUCache(maxsize=int(MaskGenLoader().get_key('exif_cache_size', 12)))
 
 
 def stringifyargs(kwargs):
@@ -1,11 +1,156 @@
 #FFUN WITH FFMPEG
 
-import os, StringIO, tempfile
-import uuid, time
+import os, StringIO
+import numpy as np
 from subprocess import Popen, PIPE
 import logging
 import itertools
+from threading import Lock
 from support import getValue
+from maskgen_loader import MaskGenLoader
+from disk_cache import DiskCache, make_key, file_identity
+
+probe_cache = None
+probe_cache_lock = Lock()
+
+
+def get_probe_cache():
+    """
+    The cache of ffprobe results is used if the preference 'probe_cache.dir' is set.
+    The byte budget is set by preference 'probe_cache.bytes'.
+    The directory may be shared by processes.
+    @rtype: DiskCache
+    """
+    global probe_cache
+    with probe_cache_lock:
+        if probe_cache is None:
+            preferences = MaskGenLoader()
+            directory = preferences.get_key('probe_cache.dir')
+            if directory is None or len(directory) == 0:
+                probe_cache = False
+            else:
+                probe_cache = DiskCache(directory,
+                                        max_bytes=int(preferences.get_key('probe_cache.bytes', 512 * 1024 * 1024)))
+        return probe_cache if probe_cache else None
+
+
+class StreamFrames:
+    """
+    The frames of one stream held as columns: the values ffprobe reported for each attribute,
+    None where a frame lacks the attribute.  The numeric columns are converted once, when first asked for.
+    Indexing or iterating yields a frame as a dict of its attributes, for callers that walk the frames.
+    """
+
+    def __init__(self, names=(), columns=(), count=0):
+        self.columns = dict(zip(names, [list(column) for column in columns]))
+        self.count = count
+        self.numeric = {}
+
+    def append(self, entries):
+        """
+        :param entries: (name, value) of each attribute of the frame
+        """
+        for name, value in entries:
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = [None] * self.count
+            if len(column) > self.count:
+                column[self.count] = value
+            else:
+                column.append(value)
+        self.count += 1
+        for column in self.columns.itervalues():
+            if len(column) < self.count:
+                column.append(None)
+        if len(self.numeric) > 0:
+            self.numeric = {}
+
+    def names(self):
+        return sorted(self.columns.keys())
+
+    def column(self, name):
+        """
+        :param name: frame attribute
+        :return: the values of the attribute, NaN where absent or not a number (N/A)
+        @rtype: numpy.ndarray
+        """
+        values = self.numeric.get(name)
+        if values is None:
+            reported = np.array([value if value is not None else 'nan'
+                                 for value in self.columns.get(name, [None] * self.count)], dtype='S')
+            reported[reported == 'N/A'] = 'nan'
+            try:
+                values = reported.astype('f8')
+            except ValueError:
+                def number(value):
+                    try:
+                        return float(value)
+                    except ValueError:
+                        return np.nan
+                values = np.array([number(value) for value in self.columns[name]], dtype='f8')
+            self.numeric[name] = values
+        return values
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return StreamFrames(self.columns.keys(),
+                                [column[item] for column in self.columns.values()],
+                                len(range(*item.indices(self.count))))
+        pos = item + self.count if item < 0 else item
+        if pos < 0 or pos >= self.count:
+            raise IndexError('frame index out of range')
+        return {name: column[pos] for name, column in self.columns.iteritems() if column[pos] is not None}
+
+    def __iter__(self):
+        for pos in xrange(self.count):
+            yield self[pos]
+
+    def __add__(self, other):
+        combined = StreamFrames(self.columns.keys(), self.columns.values(), self.count)
+        for frame in other:
+            combined.append(frame.iteritems())
+        return combined
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all([one == two for one, two in itertools.izip(self, other)])
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+def _stream_frames(frames):
+    """
+    :param frames: frames of one stream, as StreamFrames or a list of dict
+    @rtype: StreamFrames
+    """
+    if isinstance(frames, StreamFrames):
+        return frames
+    stream_frames = StreamFrames()
+    for frame in frames:
+        stream_frames.append(frame.iteritems())
+    return stream_frames
+
+
+def _pack_frames(frames):
+    """
+    Frames of each stream as columns: the attribute names and a tuple of values (None if absent) per attribute
+    """
+    packed = []
+    for stream_frames in frames:
+        stream_frames = _stream_frames(stream_frames)
+        names = stream_frames.names()
+        packed.append((names, [tuple(stream_frames.columns[name]) for name in names], len(stream_frames)))
+    return packed
+
+
+def _unpack_frames(packed):
+    return [StreamFrames(names, columns, count) for names, columns, count in packed]
 
 
 
@@ -48,16 +193,6 @@ def run_ffmpeg(args, noOutput=True, tool=get_ffmpeg_tool()):
         logging.getLogger('maskgen').error(str(e))
         raise e
 
-def _run_command(command,outputCollector=None):
-    try:
-        stdout = run_ffmpeg(command, noOutput=False, tool=None)
-        if outputCollector is not None:
-            for line in stdout.splitlines():
-                outputCollector.append(line)
-    except ValueError as e:
-        return [e.message]
-    return []
-
 def __get_channel_data(source_data, codec_type):
     for data in source_data:
         if getValue(data,'codec_type','na') == codec_type:
@@ -110,6 +245,45 @@ def process_frames_from_stream(stream, errorstream):
     __add_meta_to_frames(frames, meta)
     return frames
 
+def process_frames_from_compact_stream(stream, errorstream):
+    """
+    Frames from ffprobe compact output (-of compact=p=0), one frame per line: key=value|key=value...
+    The stream is read incrementally as it is produced, straight into the columns of each stream.
+    :param stream: ffprobe standard output
+    :param errorstream: unused
+    :return: frames for each stream index
+    @rtype: list of StreamFrames
+    """
+    frames = []
+    for line in iter(stream.readline, ''):
+        entries = []
+        index = None
+        for part in line.strip().split('|'):
+            pos = part.find('=')
+            if pos > 0:
+                if part[0:pos] == 'stream_index':
+                    index = int(part[pos + 1:])
+                else:
+                    entries.append((part[0:pos], part[pos + 1:]))
+        if index is not None:
+            while index >= len(frames):
+                frames.append(StreamFrames())
+            frames[index].append(entries)
+    return frames
+
+def get_frame_table(frames, attributes=['pkt_pts_time', 'pkt_dts_time', 'pkt_duration_time']):
+    """
+    :param frames: frames of one stream as returned by get_meta_from_video (or a list of dict)
+    :param attributes: numeric frame attributes
+    :return: structured array with a float field per attribute, NaN where the attribute is absent or N/A
+    @rtype: numpy.ndarray
+    """
+    frames = _stream_frames(frames)
+    table = np.empty(len(frames), dtype=[(str(attribute), 'f8') for attribute in attributes])
+    for attribute in attributes:
+        table[str(attribute)] = frames.column(attribute)
+    return table
+
 def process_meta_from_streams(stream, errorstream):
     streams = []
     meta = {}
@@ -226,47 +400,35 @@ def get_meta_from_video(file,
                    if len(frames) > 0 else frames
 
     def runProbeWithFrames(func, args=None):
+        """
+        Parse the output as ffprobe produces it.  The diagnostics are discarded so that
+        a full error pipe cannot stall ffprobe.
+        """
         ffmpegcommand = [get_ffprobe_tool()]
         if args != None:
             ffmpegcommand.extend(args)
         ffmpegcommand.append(file)
-        stdout_fd, stdout_path = tempfile.mkstemp('.txt',
-                                                  'stdout_{}_{}'.format(uuid.uuid4(),
-                                                                        str(os.getpid())))
-        try:
-            stder_fd, stder_path = tempfile.mkstemp('.txt',
-                                                    'stderr_{}_{}'.format(uuid.uuid4(),
-                                                                          str(os.getpid())))
+        with open(os.devnull, 'w') as devnull:
+            p = Popen(ffmpegcommand, stdout=PIPE, stderr=devnull)
             try:
-                p = Popen(ffmpegcommand, stdout=stdout_fd, stderr=stder_fd)
-                p.wait()
+                return func(p.stdout, None)
             finally:
-                os.close(stder_fd)
-        finally:
-            os.close(stdout_fd)
-
-        try:
-            with open(stdout_path) as stdout_fd:
-                with open(stder_path) as stder_fd:
-                    return func(stdout_fd,stder_fd)
-        finally:
-            persistantDelete(stder_path)
-            persistantDelete(stdout_path)
-
-    def persistantDelete(path, attempts=10):
-        if os.path.exists(path):
-            for x in range(attempts):
-                try:
-                    os.remove(path)
-                    break
-                except WindowsError:
-                    time.sleep(0.1)
-        if os.path.exists(path):
-            logging.getLogger('maskgen').warn("Failed to remove file {}".format(path))
+                p.stdout.close()
+                p.wait()
 
     if not os.path.exists(file):
         raise ValueError("{} not found".format(file))
 
+    # results are reused while the file is unchanged (path, size and modification time)
+    cache = get_probe_cache()
+    key = None
+    if cache is not None:
+        key = make_key('ffprobe', get_ffprobe_tool(), file_identity(file), with_frames, show_streams, count_frames,
+                       list(media_types), frame_limit, frame_start, list(frame_meta))
+        value = cache.get(key)
+        if value is not None:
+            return value[0], _unpack_frames(value[1])
+
     def runProbe(func, args=None):
         ffmpegcommand = [get_ffprobe_tool(), file]
         if args != None:
@@ -290,41 +452,43 @@ def get_meta_from_video(file,
         if len(media_types) == 1:
             args.extend( ['-select_streams', media_types[0][0]])
         args.extend(['-show_frames', '-show_entries','subtitle=:frame={}'.format(','.join(frame_meta_list))])
+        # one line per frame holding only the requested entries
+        args.extend(['-of', 'compact=p=0'])
         if frame_limit is not None or frame_start is not None:
             limit = '%+#{}'.format(frame_limit) if frame_limit is not None else ''
             start = '{}'.format(frame_start) if frame_start is not None else ''
             args.extend(['-read_intervals', '{}{}'.format(start, limit)])
-            frames = runProbe(process_frames_from_stream, args=args)
+            frames = runProbe(process_frames_from_compact_stream, args=args)
         else:
-            frames = runProbeWithFrames(process_frames_from_stream, args=args)
+            frames = runProbeWithFrames(process_frames_from_compact_stream, args=args)
     else:
         # insure match of frames to meta
         frames = []
 
-    return strip(meta, frames, media_types)
+    meta, frames = strip(meta, frames, media_types)
+    if key is not None:
+        cache.put(key, (meta, _pack_frames(frames)))
+    return meta, frames
 
 def get_frame_attribute(fileOne, attribute, default=None, audio=False):
-    ffmpegcommand = get_ffprobe_tool()
-    results = []
-    errors = _run_command([ffmpegcommand,
-                          '-show_entries', 'stream={},codec_type'.format(attribute),
-                          fileOne],
-                         outputCollector=results)
-    if len(results) > 0:
-        streams = []
-        for result in results:
-            if result.find('[STREAM]') >= 0:
-                streams.append(dict())
-                continue
-            parts = result.split('=')
-            if len(parts) < 2:
-                continue
-            streams[-1][parts[0]] = parts[1]
-        for stream in streams:
-            if (audio and getValue(stream,'codec_type','na') == 'audio') or \
-                    (not audio and getValue(stream,'codec_type','na') != 'audio'):
-                return stream[attribute]
-
+    """
+    Attribute of the first audio or video stream, from the (cached) stream meta-data.
+    :param fileOne: media file
+    :param attribute: stream attribute as named by ffprobe (e.g. r_frame_rate)
+    :param default: returned if the stream or attribute is missing or the file cannot be probed
+    :param audio: True for the audio stream, otherwise the video stream
+    :return: attribute value as reported by ffprobe
+    @rtype: str
+    """
+    try:
+        meta, frames = get_meta_from_video(fileOne, show_streams=True)
+    except ValueError as e:
+        logging.getLogger('maskgen').debug('Cannot probe {}: {}'.format(fileOne, str(e)))
+        return default
+    for stream in meta:
+        if (audio and getValue(stream,'codec_type','na') == 'audio') or \
+                (not audio and getValue(stream,'codec_type','na') != 'audio'):
+            return getValue(stream, attribute, default)
     return default
 
 def get_video_frame_rate_from_meta(meta, frames):
@@ -357,7 +521,6 @@ def is_vfr(meta, frames=[]):
     if (r[0] != 'n' and r != avg) or r[0] in ['n','0'] or nb[0] in ['n','0']:
         return True
     # approach requires frames which is more expensive to gather but more accurate
-    frame_durations = set([frame['pkt_duration_time'] for frame in frames[0:100]]) if len(frames) > 0 else []
-    if len(frame_durations) > 1:
-        return True
-    return False
+    durations = get_frame_table(frames[0:100], attributes=['pkt_duration_time'])['pkt_duration_time']
+    missing = np.isnan(durations)
+    return len(np.unique(durations[~missing])) + (1 if missing.any() else 0) > 1
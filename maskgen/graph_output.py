@@ -102,7 +102,9 @@ class GraphMediaHandler:
     def __init__(self, media_fetcher=FileMediaFetcher()):
         self.media_fetcher = media_fetcher
 
-    def get_image(self, graph, node_id):
+    def get_image(self, graph, node_id, size=None):
+        if size is not None:
+            return graph.get_image_for_size(node_id, size)
         return graph.get_image(node_id)
 
     def get_url(self, graph, node_id):
@@ -117,7 +119,7 @@ class ExternalMediaHandler:
         self.media_fetcher = media_fetcher
         self.cache = {}
 
-    def get_image(self, graph, node_id):
+    def get_image(self, graph, node_id, size=None):
         filename = graph.get_filename(node_id)
         if len(graph.predecessors(node_id)) == 0 or len(graph.successors(node_id)) == 0:
             return self.media_fetcher.get_image(filename), os.path.join(graph.dir, filename)
@@ -232,7 +234,7 @@ class ImageGraphPainter:
                 shape = 'plain'
             fillcolor = 'turquoise' if 'experiment_id' in node else 'white'
             fillcolor = 'red' if iscgi else fillcolor
-            im,filename= self.handler.get_image(self.graph, node_id)
+            im,filename= self.handler.get_image(self.graph, node_id, size=self.max_size)
             im = imageResizeRelative(im, self.max_size, self.max_size)
             im.touint8()
             prefix = os.path.split(filename)[0]
@@ -790,6 +790,7 @@ def sampledInputMask(op,graph, frm, to):
 def addToComposite(graph, start, end):
     edge = graph.get_edge(start, end)
     edge['recordMaskInComposite'] = 'yes'
+    graph.mark_edge_dirty(start, end)
 
 def check_local(op, graph, frm, to):
     """
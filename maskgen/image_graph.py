@@ -19,6 +19,7 @@ from maskgen import __version__
 from threading import RLock
 from support import getPathValues, setPathValue, Proxy, ModuleStatus
 from image_wrap import getProxy
+from image_pyramid import getPyramidLevel
 from tool_set import getMilliSecondsAndFrameCount,fileType,openImage,getOS
 from maskgen.userinfo import get_username
 from datetime import datetime
@@ -239,6 +240,7 @@ class ImageGraph:
                  arg_checker_callback=None,username=None,tool=None):
         fname = os.path.split(pathname)[1]
         self.filesToRemove = set()
+        self.dirty_edges = set()
         self.U = list()
         self.lock = RLock()
         name = get_pre_name(fname, left=True)
@@ -296,11 +298,13 @@ class ImageGraph:
             found = True
         for n in self.G.nodes():
             if attributename in self.G.node[n] and comparefunc(self.G.node[n][attributename], oldvalue):
+                self.mark_node_dirty(n)
                 self.G.node[n][attributename] = newvalue
                 found = True
         for e in self.G.edges():
             if attributename in self.G.edge[e[0]][e[1]] and comparefunc(self.G.edge[e[0]][e[1]][attributename],
                                                                         oldvalue):
+                self._markDirty(e[0], e[1])
                 self.G.edge[e[0]][e[1]][attributename] = newvalue
                 found = True
         return found
@@ -426,6 +430,7 @@ class ImageGraph:
                             self.filesToRemove.remove(filePath)
                 start = d.pop('start')
                 end = d.pop('end')
+                self._markDirty(start, end)
                 self.G.add_edge(start, end, **d)
             elif action == 'addNode':
                 if (d['ownership'] == 'yes'):
@@ -497,6 +502,7 @@ class ImageGraph:
     def update_node(self, node, **kwargs):
         self._setUpdate(node, update_type='node')
         if self.G.has_node(node):
+            self.mark_node_dirty(node)
             self.__scan_args('node', kwargs)
             updated_args = self._updateNodePathValue(kwargs)
             for k, v in updated_args.iteritems():
@@ -508,6 +514,7 @@ class ImageGraph:
         if not self.G.has_node(start) or not self.G.has_node(end):
             return
         self._setUpdate((start, end), update_type='edge')
+        self._markDirty(start, end)
         op = kwargs['op'] if 'op' in kwargs else self.G.edge[start][end]['op']
         self.__scan_args(op, kwargs)
         unsetkeys = []
@@ -543,6 +550,7 @@ class ImageGraph:
 
     def update_mask(self, start, end, mask=None, maskname=None, errors=None,  **kwargs):
             self._setUpdate((start, end), update_type='edge')
+            self._markDirty(start, end)
             edge = self.get_edge(start,end)
             if mask is not None:
                 oldmaskname =  edge['maskname'] if 'maskname' in edge else \
@@ -569,6 +577,7 @@ class ImageGraph:
     def copy_edge(self, start, end, dir='.', edge=dict()):
         import copy
         self._setUpdate((start, end), update_type='edge')
+        self._markDirty(start, end)
         edge = copy.deepcopy(edge)
         if 'maskname' in edge:
             newmaskpathname = os.path.join(self.dir, edge['maskname'])
@@ -588,6 +597,7 @@ class ImageGraph:
     def add_edge(self, start, end, maskname=None, mask=None, op='Change', description='', **kwargs):
         import copy
         self._setUpdate((start, end), update_type='edge')
+        self._markDirty(start, end)
         self.__scan_args(op, kwargs)
         newmaskpathname = None
         if maskname is not None and len(maskname) > 0 and mask is not None:
@@ -657,6 +667,31 @@ class ImageGraph:
         im = self.openImage(filename, metadata=meta)
         return im, filename
 
+    def get_image_for_size(self, name, size):
+        """
+        Image of the node for display within a box; image files are read from their
+        pyramid (see ImagePyramid).  The image is returned in full while its pyramid is built
+        in the background.
+        :param name:
+        :param size: (width, height) of the box
+        :return:
+        @rtype (ImageWrapper,str)
+        """
+        if not self.G.has_node(name):
+            return None, None
+        node = self.G.node[name]
+        filename = os.path.abspath(os.path.join(self.dir, node['file']))
+        if self.getNodeFileType(name) == 'image' and 'proxyfile' not in node and \
+                os.path.splitext(filename)[1].lower() not in ['.zip', '.gz', '.tgz'] and \
+                os.path.exists(filename):
+            try:
+                level = getPyramidLevel(filename, size, wait=False)
+                if level is not None:
+                    return level, filename
+            except Exception as e:
+                logging.getLogger('maskgen').warning('Cannot use image pyramid of {}: {}'.format(filename, str(e)))
+        return self.get_image(name)
+
     def get_image_path(self, name):
         return os.path.abspath(os.path.join(self.dir, self.G.node[name]['file']))
 
@@ -706,6 +741,7 @@ class ImageGraph:
             self._setUpdate(node, update_type='node')
 
             def fileRemover(start, end, edge):
+                self._markDirty(start, end)
                 self._edgeFileRemover(self.E, edgeFunc, start, end, edge)
 
             # remove predecessor edges
@@ -743,6 +779,7 @@ class ImageGraph:
 
     def remove_edge(self, start, end, edgeFunc=None):
         self._setUpdate((start, end), update_type='edge')
+        self._markDirty(start, end)
         self.U = []
         edge = self.G.edge[start][end]
         self._edgeFileRemover(self.U, edgeFunc, start, end, edge)
@@ -895,6 +932,16 @@ class ImageGraph:
             self.G.graph['idcount'] = self.idc
             return self.idc
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('lock', None)
+        state['arg_checker_callback'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = RLock()
+
     def _copy_contents(self, currentdir):
         def moveFile(newdir, currentdir, name):
             oldpathname = os.path.join(currentdir, name)
@@ -1097,6 +1144,41 @@ class ImageGraph:
     def getLastUpdateTime(self):
         return strptime(self.G.graph['updatetime'], "%Y-%m-%d %H:%M:%S")
 
+    def _markDirty(self, start, end):
+        with self.lock:
+            self.dirty_edges.add((start, end))
+
+    def mark_edge_dirty(self, start, end):
+        """
+        Mark an edge changed outside of the graph's update methods (e.g. an edge attribute set directly)
+        :param start: source node id
+        :param end: target node id
+        """
+        self._markDirty(start, end)
+
+    def mark_node_dirty(self, node):
+        """
+        Mark the edges into and out of a changed node (e.g. its media replaced)
+        :param node: node id
+        """
+        if self.G.has_node(node):
+            with self.lock:
+                for start in self.G.predecessors(node):
+                    self.dirty_edges.add((start, node))
+                for end in self.G.successors(node):
+                    self.dirty_edges.add((node, end))
+
+    def pop_dirty_edges(self):
+        """
+        Edges updated, masks replaced, added or removed since the last call.
+        :return: set of edge ids (start, end); removed edges may no longer be in the graph
+        @rtype: set of (str, str)
+        """
+        with self.lock:
+            dirty_edges = self.dirty_edges
+            self.dirty_edges = set()
+            return dirty_edges
+
     def _setUpdate(self, name, update_type=None):
         self.G.graph['updatetime'] = strftime("%Y-%m-%d %H:%M:%S", gmtime())
         self.G.graph['igversion'] = igversion
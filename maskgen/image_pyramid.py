@@ -0,0 +1,194 @@
+# =============================================================================
+# Authors: PAR Government
+# Organization: DARPA
+#
+# Copyright (c) 2016 PAR Government
+# All rights reserved.
+# ==============================================================================
+
+import os
+import json
+import math
+import logging
+import tempfile
+import threading
+import cv2
+from image_wrap import openImageFile, ImageWrapper, deleteImage
+from disk_cache import file_md5
+
+
+class ImagePyramid:
+    """
+    Successive halvings of an image file, saved as PNG files in the '.pyramid' directory
+    beside the image file.  Level 0 is the image file itself.
+    An index records the modification time and MD5 of the image file; the levels are rebuilt
+    when the image file changes (a change of modification time alone, as by a copy, is accepted
+    if the MD5 is the same).
+    Levels and the index are written to temporary files and renamed in place, so a reader
+    sees a complete file or none.
+    """
+
+    directory_name = '.pyramid'
+
+    # the smallest level is at least this large in both dimensions
+    min_size = 64
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.directory = os.path.join(os.path.dirname(self.filename), self.directory_name)
+        self.prefix = os.path.join(self.directory, os.path.basename(self.filename))
+        self.index_file = self.prefix + '.json'
+
+    def _levelFile(self, level):
+        return '{}_{}.png'.format(self.prefix, level)
+
+    def _readIndex(self):
+        try:
+            with open(self.index_file, 'r') as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _replace(self, temp_path, filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp_path, filename)
+
+    def _writeIndex(self, index):
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(index, fp)
+            self._replace(temp_path, self.index_file)
+        except (IOError, OSError) as e:
+            logging.getLogger('maskgen').warning('Cannot write pyramid index {}: {}'.format(self.index_file, str(e)))
+
+    def _writeLevel(self, level, image):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp.png')
+        os.close(fd)
+        try:
+            image.save(temp_path, format='PNG')
+            self._replace(temp_path, self._levelFile(level))
+        finally:
+            # the level is cached by its file name when opened
+            deleteImage(temp_path)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _isCurrent(self, index):
+        mtime = os.stat(self.filename).st_mtime
+        if index['mtime'] == mtime:
+            return True
+        if index['md5'] == file_md5(self.filename):
+            index['mtime'] = mtime
+            self._writeIndex(index)
+            return True
+        return False
+
+    def build(self):
+        """
+        Save the levels of the image file.
+        :return: the index: modification time, md5 and the (width, height) of each level
+        @rtype: dict
+        """
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created by another thread
+                pass
+        index = {'mtime': os.stat(self.filename).st_mtime, 'md5': file_md5(self.filename)}
+        image = openImageFile(self.filename)
+        array = image.image_array
+        sizes = [image.size]
+        if str(array.dtype) in ['uint8', 'uint16'] and (len(array.shape) == 2 or array.shape[2] in [3, 4]):
+            while min(array.shape[0:2]) >= 2 * self.min_size:
+                array = cv2.resize(array,
+                                   ((array.shape[1] + 1) / 2, (array.shape[0] + 1) / 2),
+                                   interpolation=cv2.INTER_AREA)
+                self._writeLevel(len(sizes), ImageWrapper(array, mode=image.mode))
+                sizes.append((array.shape[1], array.shape[0]))
+        index['sizes'] = sizes
+        self._writeIndex(index)
+        return index
+
+    def sizes(self):
+        """
+        :return: (width, height) of each level, building the levels if absent or out of date
+        @rtype: list of (int,int)
+        """
+        index = self._readIndex()
+        if index is None or not self._isCurrent(index):
+            index = self.build()
+        return [tuple(size) for size in index['sizes']]
+
+    def level(self, size, wait=True):
+        """
+        :param size: (width, height) of the box the image is shown within
+        :param wait: build the levels if absent or out of date; otherwise build them in the background
+        and return None
+        :return: the smallest level at least as large as the image scaled to fit the box
+        @rtype: ImageWrapper
+        """
+        if wait:
+            sizes = self.sizes()
+        else:
+            index = self._readIndex()
+            if index is None or index['mtime'] != os.stat(self.filename).st_mtime:
+                buildInBackground(self.filename)
+                return None
+            sizes = [tuple(size) for size in index['sizes']]
+        scale = min(1.0, float(size[0]) / sizes[0][0], float(size[1]) / sizes[0][1])
+        width = int(math.ceil(sizes[0][0] * scale))
+        height = int(math.ceil(sizes[0][1] * scale))
+        chosen = 0
+        for level in range(len(sizes)):
+            if sizes[level][0] >= width and sizes[level][1] >= height:
+                chosen = level
+        if chosen > 0 and os.path.exists(self._levelFile(chosen)):
+            return openImageFile(self._levelFile(chosen))
+        return openImageFile(self.filename)
+
+
+build_lock = threading.Lock()
+# image files of the pyramids being built in the background
+pending_builds = set()
+build_pool = None
+
+
+def _build(filename):
+    try:
+        ImagePyramid(filename).sizes()
+    except Exception as e:
+        logging.getLogger('maskgen').warning('Cannot build image pyramid of {}: {}'.format(filename, str(e)))
+    finally:
+        with build_lock:
+            pending_builds.discard(filename)
+
+
+def buildInBackground(filename):
+    """
+    Build the pyramid of the image file in a background thread, unless a build is pending.
+    :param filename: image file
+    """
+    global build_pool
+    filename = os.path.abspath(filename)
+    with build_lock:
+        if filename in pending_builds:
+            return
+        pending_builds.add(filename)
+        if build_pool is None:
+            from multiprocessing.pool import ThreadPool
+            build_pool = ThreadPool(1)
+    build_pool.apply_async(_build, args=(filename,))
+
+
+def getPyramidLevel(filename, size, wait=True):
+    """
+    :param filename: image file
+    :param size: (width, height) of the box the image is shown within
+    :param wait: see ImagePyramid.level
+    :return: see ImagePyramid.level
+    @rtype: ImageWrapper
+    """
+    return ImagePyramid(filename).level(size, wait=wait)
@@ -12,6 +12,7 @@ import numpy as np
 import os
 import inspect
 import subprocess
+from functools import wraps
 from pkg_resources import iter_entry_points
 from cachetools import LRUCache
 from threading import RLock
@@ -21,10 +22,138 @@ import png
 import exif
 from numpngw import write_png
 from maskgen import config
+from maskgen_loader import MaskGenLoader
+
+
+class ImageCache(LRUCache):
+    """
+    Least recently used cache of opened images, keyed by (path, modification time, isMask, args).
+    Entries are weighed by the bytes of their pixel arrays and memoized conversions and evicted against
+    a byte budget (preference image_cache.bytes).
+    Counts hits, misses and evictions; misses are logged (debug) with their reason.
+    """
+
+    def __init__(self, max_bytes):
+        LRUCache.__init__(self, maxsize=max_bytes, getsizeof=_imageBytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # paths recently evicted, to explain a later miss
+        self.evicted = LRUCache(maxsize=256)
+
+    def popitem(self):
+        key, value = LRUCache.popitem(self)
+        self.evictions += 1
+        self.evicted[key[0]] = True
+        return key, value
+
+    def lookup(self, filename, update_time, isMask=False, args=None):
+        """
+        :return: the image or None
+        @rtype: ImageWrapper
+        """
+        key = _imageKey(filename, update_time, isMask, args)
+        if key in self:
+            self.hits += 1
+            return self[key][0]
+        if isMask:
+            # a saved mask is cached as it was written
+            unmasked = _imageKey(filename, update_time, False, args)
+            if unmasked in self and self[unmasked][0].mode == 'L':
+                self.hits += 1
+                return self[unmasked][0]
+        self.misses += 1
+        logger = logging.getLogger('maskgen')
+        if logger.isEnabledFor(logging.DEBUG):
+            if len([cached for cached in self.keys() if cached[0] == filename and cached[1] != update_time]) > 0:
+                reason = 'modified'
+            elif filename in self.evicted:
+                reason = 'evicted'
+            else:
+                reason = 'not cached'
+            logger.debug('Image cache miss for {} ({}); {}'.format(filename, reason, self.stats()))
+        return None
+
+    def store(self, filename, update_time, wrapper, isMask=False, args=None):
+        self.discard(filename, keep=update_time)
+        try:
+            self[_imageKey(filename, update_time, isMask, args)] = (wrapper, update_time)
+        except ValueError:
+            logging.getLogger('maskgen').debug('Image {} exceeds the image cache budget'.format(filename))
+
+    def discard(self, filename, keep=None):
+        """
+        Remove the entries of the file other than those of the modification time to keep.
+        """
+        for key in [key for key in self.keys() if key[0] == filename and key[1] != keep]:
+            self.pop(key)
+
+    def reweigh(self, wrapper):
+        """
+        Weigh the entries of the image again once its memoized conversions change, evicting other
+        entries as needed.
+        :param wrapper: the image
+        :return: True if the image is held by the cache
+        @type wrapper: ImageWrapper
+        @rtype: bool
+        """
+        held = False
+        for key in [key for key in self.keys() if key[0] == getattr(wrapper, 'filename', None)]:
+            entry = self[key]
+            if entry[0] is wrapper:
+                held = True
+                # removed first so the previous weight does not count against the budget
+                self.pop(key)
+                try:
+                    self[key] = entry
+                except ValueError:
+                    logging.getLogger('maskgen').debug(
+                        'Image {} exceeds the image cache budget'.format(wrapper.filename))
+        return held
+
+    def stats(self):
+        """
+        :return: hits, misses, evictions, bytes held, entries and byte budget
+        @rtype: dict
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes': self.currsize,
+                'entries': len(self),
+                'budget': self.maxsize}
+
+
+def _imageBytes(entry):
+    wrapper = entry[0]
+    if isinstance(wrapper, PackedMask):
+        return max(1, wrapper.bits.nbytes)
+    image_array = getattr(wrapper, 'image_array', None)
+    if isinstance(image_array, np.memmap):
+        # held by the file system cache
+        size = 1
+    else:
+        size = max(1, getattr(image_array, 'nbytes', 1))
+    conversions = getattr(wrapper, 'conversions', None)
+    if conversions is not None:
+        size += sum(_imageBytes((conversion,)) for conversion in conversions.values())
+    return size
+
+
+def _imageKey(filename, update_time, isMask, args):
+    return filename, update_time, isMask, (repr(sorted(args.items())) if isinstance(args, dict) else repr(args))
+
+
+def _imageCacheBudget():
+    return int(MaskGenLoader().get_key('image_cache.bytes', 2 * 1024 * 1024 * 1024))
+
+
+def _conversionMemoSize():
+    return int(MaskGenLoader().get_key('image_conversion_memo', 0))
 
 
 image_lock = config.getAndSet('image_lock', RLock())
-image_cache = config.getAndSet('image_cache', LRUCache(maxsize=24))
+image_cache = config.getAndSet('image_cache', ImageCache(_imageCacheBudget()))
 
 try:
     from skimage.external.tifffile import TiffFile,imsave
@@ -51,6 +180,15 @@ except ImportError:
                 return []
 
 
+try:
+    from skimage.external.tifffile import memmap as tiff_memmap
+except ImportError:
+    try:
+        from tifffile import memmap as tiff_memmap
+    except ImportError:
+        tiff_memmap = None
+
+
 def _processRaw(filename, raw, isMask=False, args=None):
     import rawpy
     def _open_from_rawpy(raw,args=None):
@@ -147,18 +285,50 @@ def _openCV2(filename):
         result = img
     return result
 
+def _tiffInfo(filename):
+    info = {}
+    try:
+        with TiffFile(filename) as tiffdata:
+            for page in tiffdata:
+                for tag in page.tags.values():
+                    t, v = tag.name, tag.value
+                    info[t] = v
+    except:
+        pass
+    return info
+
+
+def openMappedTiff(filename, isMask=False):
+    """
+    Open a large uncompressed TIFF as a copy-on-write memory map of its first page, so
+    pixels are read from the file as they are touched.
+    Applies to files at least as large as the preference tiff_memmap.bytes (512MB).
+    Compressed and tiled TIFFs are not mapped; they are decoded in full by the registry openers.
+    :param filename:
+    :param isMask:
+    :return: None if the file is not mapped
+    @rtype: ImageWrapper
+    """
+    if isMask or tiff_memmap is None or filename.lower().find('tif') < 0:
+        return None
+    if os.path.getsize(filename) < int(MaskGenLoader().get_key('tiff_memmap.bytes', 512 * 1024 * 1024)):
+        return None
+    try:
+        mapped = np.squeeze(tiff_memmap(filename, page=0, mode='c'))
+    except Exception as e:
+        # compressed or not contiguous
+        logging.getLogger('maskgen').debug('Cannot map {}: {}'.format(filename, str(e)))
+        return None
+    if not mapped.dtype.isnative or \
+            not (len(mapped.shape) == 2 or (len(mapped.shape) == 3 and mapped.shape[2] in [3, 4])):
+        return None
+    return ImageWrapper(mapped, info=_tiffInfo(filename), filename=filename)
+
+
 def openTiff(filename, isMask=False, args=None):
     raw = openRaw(filename, isMask=isMask, args=args)
-    info = {}
     if filename.lower().find('tif') >= 0:
-        try:
-            with TiffFile(filename) as tiffdata:
-                for page in tiffdata:
-                    for tag in page.tags.values():
-                        t, v = tag.name, tag.value
-                        info[t] = v
-        except:
-            pass
+        info = _tiffInfo(filename)
         try:
             nonRaw = ImageWrapper(_openCV2(filename),
                                   info=info,
@@ -259,20 +429,57 @@ def defaultOpen(filename, isMask=False, args=None):
     result = ImageWrapper(np.asarray(im), mode=im.mode, info=im.info, to_mask=isMask,filename=filename)
     return None if result.size == (0, 0) else result
 
-def readPNG(filename, isMask=False):
+def _pngHeader(filename):
+    """
+    :param filename:
+    :return: bit depth, color type and the chunk types preceding the image data, or None if not a PNG
+    @rtype: (int, int, set)
+    """
+    import struct
+    with open(filename, 'rb') as fp:
+        if fp.read(8) != '\x89PNG\r\n\x1a\n':
+            return None
+        chunk = fp.read(8)
+        if len(chunk) < 8 or chunk[4:8] != 'IHDR':
+            return None
+        ihdr = fp.read(13)
+        if len(ihdr) < 13:
+            return None
+        bitdepth, colortype = struct.unpack('>BB', ihdr[8:10])
+        fp.seek(4, 1)
+        chunks = set()
+        while True:
+            chunk = fp.read(8)
+            if len(chunk) < 8 or chunk[4:8] == 'IDAT':
+                break
+            chunks.add(chunk[4:8])
+            fp.seek(struct.unpack('>I', chunk[0:4])[0] + 4, 1)
+    return bitdepth, colortype, chunks
+
+
+def _readPNG16(filename, isMask=False):
     import itertools
-    exifdata = exif.getexif(filename)
-    if 'Bit Depth' in exifdata and exifdata['Bit Depth'] == '16':
-        with open(filename, 'rb') as f:
-            pngdata = png.Reader(file=f).asDirect()
-            image_2d = np.vstack(itertools.imap(np.uint16, pngdata[2]))
-            shape = image_2d.shape[1] / pngdata[0]
-            if shape > 1:
-                image_3d = np.reshape(image_2d,
-                                      (pngdata[1], pngdata[0], image_2d.shape[1] / pngdata[0]))
-                return ImageWrapper(image_3d, to_mask=isMask,filename=filename)
-            else:
-                return ImageWrapper(image_2d,filename=filename)
+    with open(filename, 'rb') as f:
+        pngdata = png.Reader(file=f).asDirect()
+        image_2d = np.vstack(itertools.imap(np.uint16, pngdata[2]))
+        shape = image_2d.shape[1] / pngdata[0]
+        if shape > 1:
+            image_3d = np.reshape(image_2d,
+                                  (pngdata[1], pngdata[0], image_2d.shape[1] / pngdata[0]))
+            return ImageWrapper(image_3d, to_mask=isMask,filename=filename)
+        else:
+            return ImageWrapper(image_2d,filename=filename)
+
+
+def readPNG(filename, isMask=False):
+    header = _pngHeader(filename)
+    if header is not None and header[0] == 16:
+        # gray with alpha (4) and scaled (sBIT) or transparent color (tRNS) images
+        # are converted as pypng does
+        if header[1] not in [0, 2, 6] or 'sBIT' in header[2] or 'tRNS' in header[2]:
+            return _readPNG16(filename, isMask=isMask)
+        result = _openCV2(filename)
+        return ImageWrapper(result, to_mask=isMask and len(result.shape) > 2, filename=filename)
     else:
         result = _openCV2(filename)
     return ImageWrapper(result,filename=filename)
@@ -306,32 +513,107 @@ def getFromWriterRegistry(format):
     return file_write_registry[format] if format in file_write_registry else None
 
 
+# leading bytes of a file and the registry suffix of its openers
+# (types without registry entries are left to the openers of the file name)
+image_signatures = [('\x89PNG\r\n\x1a\n', 'png'),
+                    ('%PDF', 'pdf'),
+                    ('FUJIFILMCCD-RAW', 'raf')]
+
+# (extension, signature) -> the opener that last succeeded, unless an earlier opener declined (see openFromRegistry)
+opener_memo = config.getAndSet('opener_memo', {})
+# opener -> accepts the args parameter
+opener_args = {}
+
+
+def sniffImageType(filename):
+    """
+    :param filename:
+    :return: the file type from the leading bytes of the file or None if unknown
+    @rtype: str
+    """
+    try:
+        with open(filename, 'rb') as fp:
+            header = fp.read(16)
+    except IOError:
+        return None
+    for signature, kind in image_signatures:
+        if header.startswith(signature):
+            return kind
+    return None
+
+
+def _acceptsArgs(func):
+    if func not in opener_args:
+        try:
+            argspec = inspect.getargspec(func)
+            opener_args[func] = 'args' in argspec.args or argspec.keywords is not None
+        except TypeError:
+            opener_args[func] = False
+    return opener_args[func]
+
+
+def _openers(filename, kind):
+    """
+    Openers of the registry entries matching the file name, preceded by those registered
+    for the type sniffed from the content.
+    """
+    name = filename.lower()
+    entries = [entry for entry in file_registry if entry[0] == kind] + \
+              [entry for entry in file_registry if entry[0] in name]
+    openers = []
+    for suffix, funcs in entries:
+        for func in funcs:
+            if func not in openers:
+                openers.append(func)
+    return openers
+
+
 def openFromRegistry(filename, isMask=False, args=None):
-    for suffixList in file_registry:
-        if suffixList[0] in filename.lower():
-            for func in suffixList[1]:
+    kind = sniffImageType(filename)
+    if kind is None:
+        # large TIFFs are mapped ahead of the registry, so the memo holds the opener of all other files
+        mapped = openMappedTiff(filename, isMask=isMask)
+        if mapped is not None:
+            return mapped
+    memo_key = (os.path.splitext(filename)[1].lower(), kind)
+    openers = _openers(filename, kind)
+    remembered = opener_memo.get(memo_key)
+    if remembered in openers:
+        openers.remove(remembered)
+        openers.insert(0, remembered)
+    # the opener that succeeds is remembered, so later files of the type skip the openers that raised.
+    # Conditional openers are not: an opener that follows one that declined (returned no image) is not
+    # remembered, as the declining opener may accept other files of the type, nor is proxyOpen, which
+    # reads a substitute of the media when its openers fail.
+    declined = False
+    for func in openers:
+        try:
+            if args is not None and _acceptsArgs(func):
                 try:
-                    if args is not None:
-                        try:
-                            inspect.getcallargs(func, filename, isMask=isMask, args=args)
-                            result = func(filename, isMask=isMask, args=args)
-                        except Exception as e:
-                            result = func(filename, isMask=isMask)
-                    else:
-                        result = func(filename, isMask=isMask)
-                    if result is not None and result.__class__ is not ImageWrapper:
-                        result = ImageWrapper(result[0], mode=result[1],filename=filename)
-                    if result is not None and result.size != (0, 0):
-                        logger = logging.getLogger('maskgen')
-                        if logger.isEnabledFor(logging.DEBUG):
-                            logging.getLogger('maskgen').debug('Opened {} with {}'.format(
-                                filename, func.__name__
-                            ))
-                        return result
+                    result = func(filename, isMask=isMask, args=args)
                 except Exception as e:
-                    logging.getLogger('maskgen').info(
-                        'Cannot to open image file ' + filename + ' with ' + str(func) + '...trying another opener.')
-                    logging.getLogger('maskgen').info(str(e))
+                    logging.getLogger('maskgen').debug(
+                        'Cannot open image file {} with {} and {}: {}'.format(filename, str(func), args, str(e)))
+                    result = func(filename, isMask=isMask)
+            else:
+                result = func(filename, isMask=isMask)
+            if result is not None and result.__class__ is not ImageWrapper:
+                result = ImageWrapper(result[0], mode=result[1],filename=filename)
+            if result is not None and result.size != (0, 0):
+                if not declined and func is not proxyOpen:
+                    opener_memo[memo_key] = func
+                logger = logging.getLogger('maskgen')
+                if logger.isEnabledFor(logging.DEBUG):
+                    logging.getLogger('maskgen').debug('Opened {} with {}'.format(
+                        filename, func.__name__
+                    ))
+                return result
+        except Exception as e:
+            logging.getLogger('maskgen').info(
+                'Cannot to open image file ' + filename + ' with ' + str(func) + '...trying another opener.')
+            logging.getLogger('maskgen').info(str(e))
+            continue
+        declined = True
     return None
 
 
@@ -342,8 +624,7 @@ def filehashkey(*args, **kwargs):
 
 def deleteImage(filename):
     with image_lock:
-        if filename in image_cache:
-            image_cache.pop(filename)
+        image_cache.discard(filename)
 
 
 def openImageFile(filename, isMask=False, args=None):
@@ -365,15 +646,18 @@ def openImageFile(filename, isMask=False, args=None):
     current_time = os.stat(filename).st_mtime
 
     with image_lock:
-        if filename in image_cache:
-            wrapper, update_time = image_cache[filename]
-            if current_time - update_time <= 0 and wrapper is not None:
-                return wrapper
+        wrapper = image_cache.lookup(filename, current_time, isMask=isMask, args=args)
+        if wrapper is not None:
+            return wrapper
 
     wrap = openFromRegistry(filename, isMask=isMask, args=args)
     wrap.filename = filename
+    wrap.open_args = args
+    memo_size = _conversionMemoSize()
+    if memo_size > 0 and isinstance(wrap, ImageWrapper):
+        wrap.memoize(memo_size)
     with image_lock:
-        image_cache[filename] = (wrap, current_time)
+        image_cache.store(filename, current_time, wrap, isMask=isMask, args=args)
     return wrap
 
 
@@ -410,8 +694,7 @@ def to_data_type(img_array, data_type):
 def get_mode(image_array):
     s = image_array.shape
     if len(s) == 2:
-        hasBigValues = (image_array > 1).any()
-        return 'F' if str(image_array.dtype).startswith('f') and not hasBigValues else 'L'
+        return 'F' if str(image_array.dtype).startswith('f') and not (image_array > 1).any() else 'L'
     elif s[2] == 4:
         return 'RGBA'
     elif s[2] == 2:
@@ -457,6 +740,33 @@ def scale_of_type_change(img,dest_type):
 def rescale_gray_image(img):
     return (img.astype('uint16') * scale_of_type_change(img, np.uint16)).astype('uint16')
 
+def _readOnly(wrapper):
+    """
+    :return: the image with its pixels viewed read-only; the pixels of other holders remain writable
+    @rtype: ImageWrapper
+    """
+    if isinstance(wrapper, ImageWrapper) and isinstance(wrapper.image_array, np.ndarray):
+        view = wrapper.image_array.view()
+        view.flags.writeable = False
+        wrapper.image_array = view
+    return wrapper
+
+
+def _memoizedConversion(func):
+    """
+    The conversions of an ImageWrapper are kept for reuse once ImageWrapper.memoize is called.
+    Kept conversions are shared by their callers and returned read-only; callers altering the pixels
+    copy them (to_array).
+    """
+    @wraps(func)
+    def conversion(self, *args, **kwargs):
+        if getattr(self, 'conversions', None) is None:
+            return func(self, *args, **kwargs)
+        return self._memoized((func.__name__, args, tuple(sorted(kwargs.items()))),
+                              lambda: func(self, *args, **kwargs))
+    return conversion
+
+
 class ImageWrapper:
     """
     @type image_array: numpy.ndarray
@@ -479,10 +789,50 @@ class ImageWrapper:
         self.mode = mode if mode is not None else get_mode(image_array)
         self.size = (image_array.shape[1], image_array.shape[0])
         self.filename = filename
+        # the arguments the file was opened with (e.g. raw decode arguments)
+        self.open_args = None
+        self.conversions = None
+        self.conversions_of = None
         if to_mask and self.mode != 'L':
             self.image_array = self.to_mask_array()
             self.mode = 'L'
 
+    def memoize(self, entries=4):
+        """
+        Keep the most recent conversions (to_rgb, to_float, to_16BitGray, to_mask, invert) of this image.
+        The conversions are dropped when the pixel array is replaced.  The conversions of an image held
+        by the image cache are weighed with the image, evicting other images as needed; the conversions
+        of any other image are kept only if they fit the budget left by the image cache.
+        The pixels of a kept conversion are shared by its callers and are read-only; use to_array for
+        a copy to alter.
+        :param entries: the number of conversions to keep; 0 to stop keeping conversions
+        """
+        self.conversions = LRUCache(maxsize=entries) if entries > 0 else None
+        self.conversions_of = None
+
+    def _memoized(self, key, convert):
+        with image_lock:
+            if self.conversions_of is not self.image_array:
+                if len(self.conversions) > 0:
+                    self.conversions.clear()
+                    image_cache.reweigh(self)
+                self.conversions_of = self.image_array
+            if key in self.conversions:
+                return self.conversions[key]
+        result = convert()
+        if result is self:
+            return result
+        with image_lock:
+            if self.conversions_of is self.image_array:
+                added = _imageBytes((result,))
+                if image_cache.reweigh(self):
+                    if _imageBytes((self,)) + added <= image_cache.maxsize:
+                        self.conversions[key] = _readOnly(result)
+                        image_cache.reweigh(self)
+                elif image_cache.currsize + _imageBytes((self,)) + added <= image_cache.maxsize:
+                    self.conversions[key] = _readOnly(result)
+        return result
+
     def has_alpha(self):
         return len(self.image_array.shape) == 3 and self.mode.find('A') > 0
 
@@ -495,6 +845,24 @@ class ImageWrapper:
     def to_array(self):
         return np.copy(self.image_array)
 
+    def crop(self, box):
+        """
+        Read a region.  Only the region is read from a memory mapped image (see openMappedTiff);
+        other images are already decoded in full.
+        :param box: (left, upper, right, lower)
+        :return: the region
+        @rtype: ImageWrapper
+        """
+        return ImageWrapper(np.array(self.image_array[box[1]:box[3], box[0]:box[2]]),
+                            mode=self.mode,
+                            info=self.info)
+
+    def is_mapped(self):
+        """
+        :return: True if the pixels are memory mapped from the file
+        """
+        return isinstance(self.image_array, np.memmap)
+
     def apply_mask(self, mask):
         if mask is not None and len(self.image_array.shape) == 3:
             img = np.copy(self.image_array)
@@ -512,6 +880,7 @@ class ImageWrapper:
         img[:, :, 3] = img[:, :, 3] * mask_array
         return ImageWrapper(self.image_array)
 
+    @_memoizedConversion
     def to_rgb(self, data_type=None):
         data_type = self.image_array.dtype if data_type is None else data_type
         s = self.image_array.shape
@@ -551,7 +920,12 @@ class ImageWrapper:
         :return:
         @type filename: str
         """
+        if self.is_mapped() and self.filename is not None and \
+                os.path.abspath(filename) == os.path.abspath(self.filename):
+            # the file is replaced underneath the map
+            self.image_array = np.array(self.image_array)
         self.filename = filename
+        self.open_args = None
         if 'format' in kwargs:
             image_format = kwargs['format']
         elif getFromWriterRegistry(self.mode.lower()):
@@ -586,7 +960,7 @@ class ImageWrapper:
             imsave(filename, img_array, **tiff_masssage_args(**newargs))
         if os.path.exists(filename):
             with image_lock:
-                image_cache[filename] = (self, os.stat(filename).st_mtime)
+                image_cache.store(filename, os.stat(filename).st_mtime, self)
                 # flags =[(cv2.IMWRITE_JPEG_QUALITY,100)]if format in kwargs and format['kwargs'] == 'JPEG' else [(int(cv2.IMWRITE_PNG_COMPRESSION),0)]
                 # cv2.imwrite(filename, self.image_array)
                 # tiff = TIFF.open(filename,mode='w')
@@ -682,6 +1056,7 @@ class ImageWrapper:
             gray_image[gray_image_temp.image_array == 0] = 0
         return gray_image
 
+    @_memoizedConversion
     def to_mask(self):
         """
         white = selected, black = unselected
@@ -689,6 +1064,7 @@ class ImageWrapper:
         """
         return ImageWrapper(self.to_mask_array())
 
+    @_memoizedConversion
     def to_16BitGray(self, equalize_colors=False):
         """
         Apply the alpha channel in the process of the conversion
@@ -714,6 +1090,7 @@ class ImageWrapper:
         gray = ((2.989 * r + 5.870 * g + 1.140 * b) * a)
         return ImageWrapper(gray.astype('uint16'))
 
+    @_memoizedConversion
     def to_float(self, equalize_colors=False):
         """
         Apply the alpha channel in the process of the conversion
@@ -743,6 +1120,7 @@ class ImageWrapper:
             return ImageWrapper(np.asarray(Image.fromarray(self.image_array).resize(size, flag)))
         return ImageWrapper(cv2.resize(self.image_array, size, fx=0.5, fy=0.5, interpolation=cv2.INTER_CUBIC))
 
+    @_memoizedConversion
     def invert(self):
         if str(self.image_array.dtype).startswith('f'):
             return ImageWrapper((1.0 - self.image_array).astype(self.image_array.dtype))
@@ -786,3 +1164,123 @@ class ImageWrapper:
             self_array = np.resize(self_array[:, :, 0:3], image_array.shape)
         return ImageWrapper(cv2.addWeighted(image_array, TUNE1, self_array[:, :, 0:3], TUNE2,
                                             0, self_array))
+
+
+_bit_counts = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class PackedMask(object):
+    """
+    A black (0) and white (255) mask held as one bit per pixel, white pixels set.
+    Rows are packed separately, so a range of rows unpacks on its own.
+    Provides the common attributes of a mask ImageWrapper (mode 'L') from the packed bits.
+    Other uses unpack the mask once, on purpose, with unpack() or numpy.asarray.
+    """
+
+    mode = 'L'
+
+    def __init__(self, selected, shape=None):
+        """
+        :param selected: array with white (non-zero) pixels or packed bits of the given shape
+        :param shape: (rows, columns) of the mask if selected holds packed bits
+        """
+        if shape is None:
+            selected = np.asarray(selected)
+            shape = selected.shape[0:2]
+            selected = np.packbits(selected != 0, axis=1)
+        self.bits = selected
+        self.shape = tuple(shape)
+
+    @property
+    def size(self):
+        return self.shape[1], self.shape[0]
+
+    def unpack_rows(self, start, end):
+        """
+        :return: the rows start up to end as 0 (black) and 1 (white)
+        """
+        return np.unpackbits(self.bits[start:end], axis=1)[:, 0:self.shape[1]]
+
+    def to_array(self):
+        return self.unpack_rows(0, self.shape[0]) * np.uint8(255)
+
+    def __array__(self, dtype=None):
+        array = self.to_array()
+        return array if dtype is None else array.astype(dtype)
+
+    def unpack(self):
+        """
+        @rtype : ImageWrapper
+        """
+        return ImageWrapper(self.to_array())
+
+    def to_mask(self):
+        """
+        white = selected, black = unselected
+        @rtype : ImageWrapper
+        """
+        return self.unpack()
+
+    def save(self, filename, **kwargs):
+        return self.unpack().save(filename, **kwargs)
+
+    def resize(self, size, flag):
+        """
+        @rtype : ImageWrapper
+        """
+        return self.unpack().resize(size, flag)
+
+    def _trim(self, bits):
+        # clear the padding bits past the last column
+        padding = bits.shape[1] * 8 - self.shape[1]
+        if padding > 0 and bits.shape[0] > 0:
+            bits[:, -1] &= np.uint8((0xFF << padding) & 0xFF)
+        return bits
+
+    def invert(self):
+        """
+        @rtype : PackedMask
+        """
+        return PackedMask(self._trim(np.invert(self.bits)), self.shape)
+
+    def __invert__(self):
+        return self.invert()
+
+    def __and__(self, other):
+        return PackedMask(self.bits & other.bits, self.shape)
+
+    def __or__(self, other):
+        return PackedMask(self.bits | other.bits, self.shape)
+
+    def equals(self, other):
+        return self.shape == other.shape and np.array_equal(self.bits, other.bits)
+
+    def count(self):
+        """
+        :return: number of white pixels
+        """
+        return int(np.sum(_bit_counts[self.bits]))
+
+    def bounding_region(self):
+        """
+        :return: the upper left (x,y) and lower right (x,y) exclusive corners of the white pixels or None if none
+        """
+        rows = np.where(np.any(self.bits, axis=1))[0]
+        if len(rows) == 0:
+            return None
+        columns = np.where(np.unpackbits(np.bitwise_or.reduce(self.bits[rows[0]:rows[-1] + 1], axis=0))
+                           [0:self.shape[1]])[0]
+        return (int(columns[0]), int(rows[0])), (int(columns[-1]) + 1, int(rows[-1]) + 1)
+
+
+def packMask(mask):
+    """
+    :param mask: ImageWrapper or array
+    :return: the mask as a PackedMask if it is only black (0) and white (255), otherwise the mask
+    """
+    if mask is None or isinstance(mask, PackedMask):
+        return mask
+    array = np.asarray(mask)
+    if array.ndim != 2 or array.dtype != np.uint8 or not np.all((array == 0) | (array == 255)):
+        return mask
+    return PackedMask(array)
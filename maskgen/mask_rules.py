@@ -11,6 +11,7 @@ import os
 import sys
 import traceback
 from collections import namedtuple
+from threading import RLock
 import time
 
 import cv2
@@ -21,7 +22,7 @@ import tool_set
 import video_tools
 from graph_meta_tools import MetaDataExtractor
 from image_graph import ImageGraph
-from image_wrap import ImageWrapper, openImageMaskFile
+from image_wrap import ImageWrapper, openImageMaskFile, PackedMask, packMask
 from support import getValue
 from tool_set import toIntTuple, alterMask, alterReverseMask, shortenName, openImageFile, sizeOfChange, \
     convertToMask,maskChangeAnalysis,  mergeColorMask, maskToColorArray, IntObject, addFrame, \
@@ -93,8 +94,8 @@ class Probe:
     """
     donorBaseNodeId = the donor base media node id
     donorVideoSegments = the list video and audio donor segments
-    targetMaskImage = the ImageWrapper target mask image (aligned to target final node)
-    donorMaskImage= the ImageWrapper donor mask image (aligned to donor)
+    targetMaskImage = the ImageWrapper (PackedMask if black and white) target mask image (aligned to target final node)
+    donorMaskImage= the ImageWrapper (PackedMask if black and white) donor mask image (aligned to donor)
     targetMaskFileName = the file name of the target mask image (aligned to target final node)
     donorMaskFileName = the file name of the  donor mask image (aligned to donor)
     targetVideoSegments = the list video and audio final node segments
@@ -196,7 +197,13 @@ class Probe:
 
 DonorImage = namedtuple('DonorImage', ['target', 'base', 'mask_wrapper', 'mask_file_name', 'media_type'])
 
-class CompositeImage:
+class CompositeImage(object):
+    """
+    Image composites are held sparsely: the bounding box of the change (offset and sub-array)
+    within the full shape. The full array is materialized on access of the mask.
+    The mask is read-only, as writes to a materialized array would be lost: set the mask
+    (or construct a new composite) to change it.  Use shape rather than mask.shape.
+    """
 
     def __init__(self,source, target, media_type, mask):
         self.source = source
@@ -206,6 +213,101 @@ class CompositeImage:
         self.mask = mask if media_type == 'image' else None
         self.ok = True
 
+    def _setMask(self, mask):
+        self.offset = (0, 0)
+        self.region = mask
+        self.shape = mask.shape if mask is not None and hasattr(mask, 'shape') else None
+        self.sparse = isinstance(mask, np.ndarray) and mask.ndim == 2
+        if not self.sparse:
+            return
+        rows = np.where(np.any(mask, axis=1))[0]
+        columns = np.where(np.any(mask, axis=0))[0]
+        if len(rows) == 0:
+            self.region = np.zeros((0, 0), dtype=mask.dtype)
+        elif (rows[0], columns[0], rows[-1] + 1, columns[-1] + 1) != (0, 0) + mask.shape:
+            self.offset = (int(rows[0]), int(columns[0]))
+            self.region = mask[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1].copy()
+
+    def _getMask(self):
+        if not self.sparse or (self.offset == (0, 0) and self.region.shape == self.shape):
+            mask = self.region.view() if isinstance(self.region, np.ndarray) else self.region
+        else:
+            mask = np.zeros(self.shape, dtype=self.region.dtype)
+            mask[self.offset[0]:self.offset[0] + self.region.shape[0],
+                 self.offset[1]:self.offset[1] + self.region.shape[1]] = self.region
+        if isinstance(mask, np.ndarray):
+            mask.flags.writeable = False
+        return mask
+
+    mask = property(_getMask, _setMask)
+
+    def _derive(self, region, offset, shape):
+        result = CompositeImage(self.source, self.target, self.media_type, None)
+        result.region = region
+        result.offset = offset
+        result.shape = shape
+        result.sparse = True
+        return result
+
+    def crop(self, location, shape):
+        """
+        The composite within the window at location of the given shape, clipped to the composite.
+        :param location: (row, column)
+        :param shape: (rows, columns)
+        :return: new composite
+        @rtype: CompositeImage
+        """
+        if not self.sparse:
+            mask = self.mask[location[0]:location[0] + shape[0], location[1]:location[1] + shape[1]]
+            return CompositeImage(self.source, self.target, self.media_type, mask)
+        new_shape = tuple([max(0, min(self.shape[i], location[i] + shape[i]) - location[i]) for i in range(2)])
+        return self._place(location, (-location[0], -location[1]), new_shape)
+
+    def shift(self, location, shape):
+        """
+        The composite placed at the location in a composite of the given shape, clipped to the shape.
+        :param location: (row, column)
+        :param shape: (rows, columns)
+        :return: new composite
+        @rtype: CompositeImage
+        """
+        if not self.sparse:
+            mask = np.zeros(shape, dtype=self.region.dtype)
+            upper = (min(self.shape[0] + location[0], shape[0]), min(self.shape[1] + location[1], shape[1]))
+            mask[location[0]:upper[0], location[1]:upper[1]] = \
+                self.region[0:upper[0] - location[0], 0:upper[1] - location[1]]
+            return CompositeImage(self.source, self.target, self.media_type, mask)
+        return self._place((0, 0), location, tuple(shape[0:2]))
+
+    def _place(self, window, movement, shape):
+        """
+        Clip the region to the window of the composite (window upper left corner to the end of the
+        composite) and to the new shape after moving.
+        """
+        lower = [max(self.offset[i], window[i], -movement[i]) for i in range(2)]
+        upper = [min(self.offset[i] + self.region.shape[i], shape[i] - movement[i]) for i in range(2)]
+        if upper[0] <= lower[0] or upper[1] <= lower[1]:
+            return self._derive(np.zeros((0, 0), dtype=self.region.dtype), (0, 0), shape)
+        region = self.region[lower[0] - self.offset[0]:upper[0] - self.offset[0],
+                             lower[1] - self.offset[1]:upper[1] - self.offset[1]]
+        return self._derive(region, (lower[0] + movement[0], lower[1] + movement[1]), shape)
+
+    def removeChange(self, edgeMask):
+        """
+        Remove the composite where the edge mask records a change (0).
+        :param edgeMask:
+        :return: new composite
+        @rtype: CompositeImage
+        """
+        if not self.sparse:
+            mask = self.mask.copy()
+            mask[edgeMask == 0] = 0
+            return CompositeImage(self.source, self.target, self.media_type, mask)
+        region = self.region.copy()
+        region[edgeMask[self.offset[0]:self.offset[0] + region.shape[0],
+                        self.offset[1]:self.offset[1] + region.shape[1]] == 0] = 0
+        return self._derive(region, self.offset, self.shape)
+
     def __getitem__(self, item):
         if item == 0:
             return self.source
@@ -219,16 +321,23 @@ class CompositeImage:
             return self.mask
 
     def isEmpty(self):
-        if self.mask is not None:
-            return np.sum(self.mask) == 0
+        if isinstance(self.region, PackedMask):
+            return self.region.count() == 0
+        if self.region is not None:
+            return np.sum(self.region) == 0
         return self.videomasks is None or len(self.videomasks) == 0
 
     def isImage(self):
         return self.media_type == 'image'
 
     def sizeOfChange(self):
-        return sizeOfChange(
-            np.asarray(self.mask).astype('uint8')) if self.media_type == 'image' else None
+        if self.media_type != 'image':
+            return None
+        if isinstance(self.region, PackedMask):
+            return self.shape[0] * self.shape[1] - self.region.count()
+        if not self.sparse:
+            return sizeOfChange(np.asarray(self.mask).astype('uint8'))
+        return self.shape[0] * self.shape[1] - int(np.sum(self.region.astype('uint8') == 255))
 
     def finalMask(self):
         return self.mask if self.media_type == 'image' else video_tools.getSingleFrameFromMask(
@@ -251,6 +360,47 @@ def getOrientationForEdge(edge):
             edge['exifdiff']['Orientation'][1]
     return ''
 
+class EdgeTransformMemory:
+    """
+    Memoizes, per edge, the artifacts used to transform masks through the edge:
+    the edge mask, the source and target shapes, the transform matrix and the seam carving tracker.
+    Downstream edges are shared by many base edges and paths; the artifacts are built once per edge
+    and applied to every composite arriving at the edge.
+    The artifacts are read-only once built: arrays (e.g. the edge mask) are kept as read-only views, so an
+    in-place write by a transform fails rather than altering the artifact of other composites and donors.
+    The artifacts are not invalidated when an edge changes: a memory lasts for one construction of
+    probes (see ImageProjectModel._constructProbes), during which the graph does not change.
+    """
+
+    def __init__(self):
+        self.artifacts = {}
+        self.lock = RLock()
+
+    def __call__(self, source, target, name, builder):
+        """
+        :param source:
+        :param target:
+        :param name: name of the artifact
+        :param builder: function to build the artifact if not memoized
+        :return: the artifact
+        """
+        key = (source, target, name)
+        with self.lock:
+            if key in self.artifacts:
+                return self.artifacts[key]
+        value = builder()
+        if isinstance(value, np.ndarray):
+            # a view, as the array may be held by others (e.g. the opened edge mask)
+            value = value.view()
+            value.flags.writeable = False
+        with self.lock:
+            return self.artifacts.setdefault(key, value)
+
+
+def _noTransformMemory(source, target, name, builder):
+    return builder()
+
+
 class BuildState:
     def __init__(self,
                  edge,
@@ -264,7 +414,8 @@ class BuildState:
                  donorMask=None,
                  pred_edges=None,
                  graph=None,
-                 checkEmpties=False
+                 checkEmpties=False,
+                 transformMemory=None
                  ):
         """
 
@@ -278,6 +429,7 @@ class BuildState:
         :param donorMask: donor mask
         :param pred_edges:
         :param graph: ImageGraph
+        :param transformMemory: memoizes edge artifacts across composites
         @type edge: dict
         @type source: str
         @type target: str
@@ -285,6 +437,7 @@ class BuildState:
         @type donorMask: CompositeImage
         @type pred_edges: list
         @type graph: ImageGraph
+        @type transformMemory: EdgeTransformMemory
         @targetShape: (int,int)
         """
         self.isComposite = compositeMask is not None
@@ -301,6 +454,15 @@ class BuildState:
         self.graph = graph
         self.meta_extractor =  MetaDataExtractor(graph=self.graph)
         self.checkEmpties = checkEmpties
+        self.transformMemory = transformMemory if transformMemory is not None else _noTransformMemory
+
+    def memoize(self, name, builder):
+        """
+        :param name: name of the edge artifact
+        :param builder: function building the artifact
+        :return: artifact, built at most once per edge
+        """
+        return self.transformMemory(self.source, self.target, name, builder)
 
     def isImage(self):
         return self.compositeMask is not None and self.compositeMask.isImage() or \
@@ -319,10 +481,10 @@ class BuildState:
         return (self.targetShape[0]-self.sourceShape[0], self.targetShape[1]-self.sourceShape[1])
 
     def compositeChange(self):
-        return (self.targetShape[0]-self.compositeMask.mask.shape[0], self.targetShape[1]-self.compositeMask.mask.shape[1])
+        return (self.targetShape[0]-self.compositeMask.shape[0], self.targetShape[1]-self.compositeMask.shape[1])
 
     def donorChange(self):
-        return (self.sourceShape[0]-self.donorMask.mask.shape[0], self.sourceShape[1]-self.donorMask.mask.shape[1])
+        return (self.sourceShape[0]-self.donorMask.shape[0], self.sourceShape[1]-self.donorMask.shape[1])
 
     def location(self):
         location = getValue(self.edge,'location',getValue(self.edge,'arguments.location',None))
@@ -335,10 +497,12 @@ class BuildState:
         return getValue(self.edge, 'arguments.flip direction')
 
     def transformMatrix(self):
-        tm = getValue(self.edge,'arguments.transform matrix', getValue(self.edge,'transform matrix'))
-        if tm is not None:
-            return tool_set.deserializeMatrix(tm)
-        return None
+        def build():
+            tm = getValue(self.edge, 'arguments.transform matrix', getValue(self.edge, 'transform matrix'))
+            if tm is not None:
+                return tool_set.deserializeMatrix(tm)
+            return None
+        return self.memoize('transform matrix', build)
 
     def arguments(self):
         return getValue(self.edge,'arguments',{})
@@ -664,7 +828,7 @@ def crop_resize_transform(buildState):
         args = buildState.arguments()
         width = int(args['crop width'])
         height =  int(args['crop height'])
-        crop_mask = buildState.compositeMask.mask[location[0]:location[0]+height, location[1]:location[1]+width]
+        crop_mask = buildState.compositeMask.crop(location, (height, width)).mask
         return CompositeImage(buildState.compositeMask.source,
                               buildState.compositeMask.target,
                               buildState.compositeMask.media_type,
@@ -676,13 +840,11 @@ def crop_resize_transform(buildState):
         height = int(args['crop height'])
         crop_shape = (height,width)
         crop_mask = tool_set.applyResizeComposite(buildState.donorMask.mask, crop_shape)
-        final_mask = np.zeros((buildState.sourceShape)).astype('uint8')
         # replace into cropped location
-        final_mask[location[0]:location[0]+height, location[1]:location[1]+width] = crop_mask
         return CompositeImage(buildState.donorMask.source,
                               buildState.donorMask.target,
                               buildState.donorMask.media_type,
-                              final_mask)
+                              crop_mask.astype('uint8')).shift(location, buildState.sourceShape)
 
 def resize_analysis(analysis, img1, img2, mask=None, linktype=None, arguments=dict(), directory='.'):
     from PIL import Image
@@ -713,16 +875,15 @@ def resize_transform(buildState):
     if location != (0, 0):
         shapeChange = (-location[0], -location[1]) if shapeChange == (0, 0) else shapeChange
     if buildState.isComposite:
-        mask = buildState.compositeMask.mask
-        expectedShape = (mask.shape[0] + shapeChange[0], mask.shape[1] + shapeChange[1])
+        composite = buildState.compositeMask
+        expectedShape = (composite.shape[0] + shapeChange[0], composite.shape[1] + shapeChange[1])
         if canvas_change:
-            newRes = np.zeros(expectedShape).astype('uint8')
-            upperBound = (min(mask.shape[0] + location[0], newRes.shape[0]),
-                          min(mask.shape[1] + location[1], newRes.shape[1]))
-            newRes[location[0]:upperBound[0], location[1]:upperBound[1]] = mask[0:(upperBound[0] - location[0]),
-                                                                           0:(upperBound[1] - location[1])]
-            mask = newRes
+            composite = composite.shift(location, expectedShape)
+            if buildState.targetShape == composite.shape:
+                return composite
+            mask = composite.mask
         else:
+            mask = composite.mask
             if tm is not None:
                 mask = tool_set.applyTransformToComposite(mask, buildState.edgeMask, tm,
                                                          shape= buildState.targetShape, returnRaw=shapeChange != (0, 0))
@@ -738,12 +899,13 @@ def resize_transform(buildState):
                                   buildState.compositeMask.media_type,
                                   mask)
     elif buildState.donorMask is not None:
-        mask = buildState.donorMask.mask
         if canvas_change:
-            upperBound = (
-                min(buildState.sourceShape[0] + location[0], mask.shape[0]), min(buildState.sourceShape[1] + location[1], mask.shape[1]))
-            mask = mask[location[0]:upperBound[0], location[1]:upperBound[1]]
+            donor = buildState.donorMask.crop(location, buildState.sourceShape)
+            if buildState.sourceShape == donor.shape:
+                return donor
+            mask = donor.mask
         else:
+            mask = buildState.donorMask.mask
             if tm is not None:
                 mask = tool_set.applyTransform(mask, mask=buildState.edgeMask, transform_matrix=tm,
                                               invert=True,  shape=buildState.sourceShape, returnRaw=shapeChange != (0, 0))
@@ -1409,26 +1571,9 @@ def crop_transform(buildState):
     """
     location = buildState.location()
     if buildState.isComposite:
-        mask = buildState.compositeMask.mask
-        mask = mask[location[0]:buildState.targetShape[0]+location[0], location[1]:buildState.targetShape[1]+location[1]]
-        return buildState.checkEmptyMask(CompositeImage(buildState.compositeMask.source,
-                              buildState.compositeMask.target,
-                              buildState.compositeMask.media_type,
-                              mask), force=True)
+        return buildState.checkEmptyMask(buildState.compositeMask.crop(location, buildState.targetShape), force=True)
     elif buildState.donorMask is not None:
-        mask = buildState.donorMask.mask
-        expectedShape = buildState.sourceShape
-        newRes = np.zeros(expectedShape).astype('uint8')
-        upperBound = (mask.shape[0] + location[0], mask.shape[1] + location[1])
-        newRes[location[0]:upperBound[0], location[1]:upperBound[1]] = mask[0:(upperBound[0] - location[0]),
-                                                                       0:(upperBound[1] - location[1])]
-        mask = newRes
-        if expectedShape != mask.shape:
-            mask = tool_set.applyResizeComposite(mask, expectedShape)
-        return CompositeImage(buildState.donorMask.source,
-                              buildState.donorMask.target,
-                              buildState.donorMask.media_type,
-                              mask)
+        return buildState.donorMask.shift(location, buildState.sourceShape)
     return CompositeImage(buildState.source,
                               buildState.target,
                               'image',
@@ -1485,14 +1630,20 @@ def seam_transform(buildState):
                         convertFunction=openImageFunc)
 
     if col_adjust is not None and row_adjust is not None:
-        mask_tracker = MaskTracker((targetImage.size[1], targetImage.size[0]))
-        mask_tracker.read_adjusters(os.path.join(buildState.directory,row_adjust),os.path.join(buildState.directory,col_adjust))
+        def build_tracker():
+            tracker = MaskTracker((targetImage.size[1], targetImage.size[0]))
+            tracker.read_adjusters(os.path.join(buildState.directory, row_adjust),
+                                   os.path.join(buildState.directory, col_adjust))
+            return tracker
         if buildState.isComposite:
+            # move_pixels does not alter the tracker
+            mask_tracker = buildState.memoize('mask tracker', build_tracker)
             return CompositeImage(buildState.compositeMask.source,
                               buildState.compositeMask.target,
                               buildState.compositeMask.media_type,
                                mask_tracker.move_pixels(buildState.compositeMask.mask))
         else:
+            mask_tracker = build_tracker()
             mask_tracker.set_dropped_mask(diffMask)
             return CompositeImage(buildState.donorMask.source,
                               buildState.donorMask.target,
@@ -1734,12 +1885,12 @@ def ca_fill(buildState):
     if buildState.isComposite:
         args = buildState.arguments()
         if 'purpose' in args and args['purpose'] == 'remove':
-            buildState.compositeMask.mask[buildState.edgeMask == 0] = 0
+            return buildState.compositeMask.removeChange(buildState.edgeMask)
         return buildState.compositeMask
     else:
         args = buildState.arguments()
         if 'purpose' in args and args['purpose'] in ['remove']:
-            buildState.donorMask.mask[buildState.edgeMask == 0] = 0
+            return buildState.donorMask.removeChange(buildState.edgeMask)
         return buildState.donorMask
 
 def paste_sampled(buildState):
@@ -1752,12 +1903,12 @@ def paste_sampled(buildState):
     if buildState.isComposite:
         args = buildState.arguments()
         if 'purpose' in args and args['purpose'] == 'remove':
-            buildState.compositeMask.mask[buildState.edgeMask==0] = 0
+            return buildState.checkEmptyMask(buildState.compositeMask.removeChange(buildState.edgeMask))
         return buildState.checkEmptyMask(buildState.compositeMask)
     else:
         args = buildState.arguments()
         if 'purpose' in args and args['purpose'] in ['remove']:
-            buildState.donorMask.mask[buildState.edgeMask == 0] = 0
+            return buildState.donorMask.removeChange(buildState.edgeMask)
         return buildState.donorMask
 
 def paste_splice(buildState):
@@ -1770,7 +1921,7 @@ def paste_splice(buildState):
     if buildState.isComposite:
         args = buildState.arguments()
         if 'purpose' in args and args['purpose'] != 'blend':
-            buildState.compositeMask.mask[buildState.edgeMask==0] = 0
+            return buildState.checkEmptyMask(buildState.compositeMask.removeChange(buildState.edgeMask))
         return buildState.checkEmptyMask(buildState.compositeMask)
     elif buildState.donorMask is not None:
         # during a paste splice, the edge mask can split up the donor.
@@ -2240,17 +2391,21 @@ def _getMaskTranformationFunction(
 
 
 def mAlterDonor(donorMask, op, source, target, edge, directory='.', pred_edges=[], graph=None, maskMemory=None,
-                baseEdge=None, checkEmptyMask=True):
-    remember = maskMemory[('donor', baseEdge, (source, target))] if maskMemory is not None else None
+                baseEdge=None, checkEmptyMask=True, transformMemory=None):
+    key = ('donor', baseEdge, (source, target))
+    remember = maskMemory.fetch(key, donorMask, graph, edge, related_edges=pred_edges) \
+        if maskMemory is not None else None
     if remember is not None:
         # print("memoize")
         return remember
-    result = alterDonor(donorMask, op, source, target, edge, directory, pred_edges, graph, checkEmptyMask=checkEmptyMask)
+    result = alterDonor(donorMask, op, source, target, edge, directory, pred_edges, graph, checkEmptyMask=checkEmptyMask,
+                        transformMemory=transformMemory)
     if maskMemory is not None:
-        maskMemory[('donor', baseEdge, (source, target))] = result
+        maskMemory.store(key, donorMask, graph, edge, result, related_edges=pred_edges)
     return result
 
-def alterDonor(donorMask, op, source, target, edge, directory='.', pred_edges=[], graph=None, checkEmptyMask=True):
+def alterDonor(donorMask, op, source, target, edge, directory='.', pred_edges=[], graph=None, checkEmptyMask=True,
+               transformMemory=None):
     """
     :param donorMask:
     :param op:  operation name
@@ -2261,15 +2416,17 @@ def alterDonor(donorMask, op, source, target, edge, directory='.', pred_edges=[]
     :param directory:
     :param pred_edges:
     :param graph:
+    :param transformMemory: memoizes edge artifacts across donors
     :return:
     @type op: Operation
+    @type transformMemory: EdgeTransformMemory
     """
+    transformMemory = transformMemory if transformMemory is not None else _noTransformMemory
 
-    edgeMask = graph.get_edge_image(source, target, 'maskname', returnNoneOnMissing=True)
+    edgeMask = transformMemory(source, target, 'edge mask', lambda: _getEdgeMaskArray(graph, source, target))
 
-    edgeMask = edgeMask.to_array() if edgeMask is not None else None
-
-    source_shape, target_shape = getShapes(graph,source,target,edge,edgeMask)
+    source_shape, target_shape = transformMemory(source, target, 'shapes',
+                                                 lambda: getShapes(graph, source, target, edge, edgeMask))
 
     buildState = BuildState(edge,
                             source,
@@ -2281,7 +2438,8 @@ def alterDonor(donorMask, op, source, target, edge, directory='.', pred_edges=[]
                             donorMask=donorMask if donorMask is not None else None,
                             pred_edges=pred_edges,
                             graph=graph,
-                            checkEmpties=checkEmptyMask)
+                            checkEmpties=checkEmptyMask,
+                            transformMemory=transformMemory)
 
     transformFunction = _getMaskTranformationFunction(op, source, target, buildState.getVideoMetaExtractor())
     nodefiletype = buildState.getVideoMetaExtractor().getNodeFileType(source)
@@ -2379,6 +2537,13 @@ def findBaseNodesWithCycleDetection(graph, node, excludeDonor=True):
     return res
 
 
+def _getEdgeMaskArray(graph, source, target, copy=True):
+    edgeMask = graph.get_edge_image(source, target, 'maskname', returnNoneOnMissing=True)
+    if edgeMask is None:
+        return None
+    return edgeMask.to_array() if copy else np.asarray(edgeMask)
+
+
 def getShapes(graph,source,target,edge, edgeMask):
 
     target_im, target_file= graph.get_image(target)
@@ -2413,9 +2578,13 @@ def mAlterComposite(graph,
                     base_id,
                     replacementEdgeMask=None,
                     maskMemory=None,
-                    checkEmptyMask=True
+                    checkEmptyMask=True,
+                    transformMemory=None
                     ):
-    remember = maskMemory[('composite', base_id, (source, target))] if maskMemory is not None else None
+    key = ('composite', base_id, (source, target))
+    # a replacement edge mask is not part of the remembered content
+    remember = maskMemory.fetch(key, composite, graph, edge) \
+        if maskMemory is not None and replacementEdgeMask is None else None
     if remember is not None:
         # print("memoize")
         return remember
@@ -2428,12 +2597,13 @@ def mAlterComposite(graph,
                             composite,
                             directory,
                             replacementEdgeMask,
-                            checkEmptyMask=checkEmptyMask)
+                            checkEmptyMask=checkEmptyMask,
+                            transformMemory=transformMemory)
     logger = logging.getLogger('maskgen')
     if logger.isEnabledFor(logging.DEBUG):
         logger.debug("{} edge {} to {}: {}".format(base_id, source, target, time.clock() - t))
-    if maskMemory is not None:
-        maskMemory[('composite', base_id, (source, target))] = result
+    if maskMemory is not None and replacementEdgeMask is None:
+        maskMemory.store(key, composite, graph, edge, result)
     return result
 
 
@@ -2445,7 +2615,8 @@ def alterComposite(graph,
                    composite,
                    directory,
                    replacementEdgeMask=None,
-                   checkEmptyMask=True):
+                   checkEmptyMask=True,
+                   transformMemory=None):
     """
 
     :param graph:
@@ -2456,14 +2627,22 @@ def alterComposite(graph,
     :param composite:
     :param directory:
     :param replacementEdgeMask:
+    :param transformMemory: memoizes edge artifacts across composites
     :return:
     @type composite: CompositeImage
+    @type transformMemory: EdgeTransformMemory
     """
-    edgeMask = graph.get_edge_image(source, target, 'maskname', returnNoneOnMissing=True)\
-        if replacementEdgeMask is None else ImageWrapper(replacementEdgeMask)
-    edgeMask = np.asarray(edgeMask) if edgeMask is not None else None
+    if replacementEdgeMask is not None:
+        # artifacts of a replacement mask are not those of the edge
+        transformMemory = _noTransformMemory
+        edgeMask = np.asarray(ImageWrapper(replacementEdgeMask))
+    else:
+        transformMemory = transformMemory if transformMemory is not None else _noTransformMemory
+        edgeMask = transformMemory(source, target, 'composite edge mask',
+                                   lambda: _getEdgeMaskArray(graph, source, target, copy=False))
 
-    source_shape,target_shape = getShapes(graph,source,target,edge,edgeMask)
+    source_shape,target_shape = transformMemory(source, target, 'shapes',
+                                                lambda: getShapes(graph,source,target,edge,edgeMask))
 
     buildState = BuildState(edge,
                             source,
@@ -2474,7 +2653,8 @@ def alterComposite(graph,
                             compositeMask=composite,
                             directory=directory,
                             graph=graph,
-                            checkEmpties= checkEmptyMask)
+                            checkEmpties= checkEmptyMask,
+                            transformMemory=transformMemory)
 
     transformFunction = _getMaskTranformationFunction(op, source, target, buildState.getVideoMetaExtractor())
     nodefiletype = buildState.getVideoMetaExtractor().getNodeFileType(source)
@@ -2583,6 +2763,18 @@ class GraphCompositeIdAssigner:
                 }
 
 
+def _changedPixels(mask):
+    """
+    :param mask: target mask, black where changed
+    :return: the changed pixels selected
+    @type mask: ImageWrapper or PackedMask
+    @rtype: PackedMask
+    """
+    if isinstance(mask, PackedMask):
+        return mask.invert()
+    return PackedMask(np.asarray(mask) == 0)
+
+
 class CompositeBuilder:
     def __init__(self, passes, composite_type):
         self.passes = passes
@@ -2636,8 +2828,9 @@ class Jpeg2000CompositeBuilder(CompositeBuilder):
                 str(probe.edgeId),probe.finalNodeId,probe.finalImageFileName
             ))
         # check to see if the bits are in fact the same for a group
+        changed = _changedPixels(probe.targetMaskImage)
         if (groupid, targetid) not in self.group_bit_check:
-            self.group_bit_check[(groupid, targetid)] = imarray
+            self.group_bit_check[(groupid, targetid)] = changed
             while (composite_mask_id + 1) > len(composite_list):
                 composite_list.append(np.zeros((imarray.shape[0], imarray.shape[1])).astype('uint8'))
             thisbit = np.zeros((imarray.shape[0], imarray.shape[1])).astype('uint8')
@@ -2645,7 +2838,7 @@ class Jpeg2000CompositeBuilder(CompositeBuilder):
             thisbit[imarray == 0] = bitvalue
             composite_list[composite_mask_id] = composite_list[composite_mask_id] | thisbit
         else:
-            check = np.all(self.group_bit_check[(groupid, targetid)] == imarray)
+            check = self.group_bit_check[(groupid, targetid)].equals(changed)
             if not check:
                 logging.getLogger('maskgen').error('Failed assertion for edge {} to {}:{}'.format(
                   str(probe.edgeId), probe.finalNodeId,probe.finalImageFileName)
@@ -2668,7 +2861,7 @@ class Jpeg2000CompositeBuilder(CompositeBuilder):
             img = np.ones((jp2img.shape[0], jp2img.shape[1])).astype('uint8')*255
             try:
                 img[(byteplane&bit)>0]  = 0
-                if not np.all(img==probe.targetMaskImage.image_array):
+                if not np.all(img==np.asarray(probe.targetMaskImage)):
                     raise EdgeMaskError('Not march on {}:{}'.format(file, str(probe.edgeId)),probe.edgeId)
             except Exception as ex:
                 print ex
@@ -2720,6 +2913,8 @@ class EmptyCompositeBuilder(CompositeBuilder):
 class ColorCompositeBuilder(CompositeBuilder):
     def __init__(self):
         self.composites = dict()
+        # changed pixels (PackedMask) and color of each probe in order per final node
+        self.changes = dict()
         self.colors = dict()
         CompositeBuilder.__init__(self, 2, 'color')
 
@@ -2740,11 +2935,30 @@ class ColorCompositeBuilder(CompositeBuilder):
 
     def pass1(self, probe, edge):
         color = [int(x) for x in edge['linkcolor'].split(' ')]
-        colorMask = maskToColorArray(probe.targetMaskImage, color=color)
-        if probe.finalNodeId in self.composites:
-            self.composites[probe.finalNodeId] = mergeColorMask(self.composites[probe.finalNodeId], colorMask)
-        else:
-            self.composites[probe.finalNodeId] = colorMask
+        if probe.finalNodeId not in self.changes:
+            self.changes[probe.finalNodeId] = []
+        self.changes[probe.finalNodeId].append((_changedPixels(probe.targetMaskImage), color))
+
+    def _getComposite(self, finalNodeId):
+        """
+        Color the changed pixels of each probe in order, later probes overlaying earlier ones.
+        Only the bounding region of each probe's change is unpacked.
+        :param finalNodeId:
+        :return: RGB composite array, white where unchanged
+        """
+        if finalNodeId not in self.composites:
+            changes = self.changes.pop(finalNodeId)
+            shape = changes[0][0].shape
+            composite = np.ones((shape[0], shape[1], 3), dtype=np.uint8) * 255
+            for changed, color in changes:
+                region = changed.bounding_region()
+                if region is None:
+                    continue
+                (left, top), (right, bottom) = region
+                selected = changed.unpack_rows(top, bottom)[:, left:right] > 0
+                composite[top:bottom, left:right][selected] = color
+            self.composites[finalNodeId] = composite
+        return self.composites[finalNodeId]
 
     def pass2(self, probe, edge):
         """
@@ -2756,7 +2970,7 @@ class ColorCompositeBuilder(CompositeBuilder):
         """
         # now reconstruct the probe target to be color coded and obscured by overlaying operations
         color = [int(x) for x in edge['linkcolor'].split(' ')]
-        composite_mask_array = self.composites[probe.finalNodeId]
+        composite_mask_array = self._getComposite(probe.finalNodeId)
         result = np.ones(composite_mask_array.shape).astype('uint8') * 255
         matches = np.all(composite_mask_array == color, axis=2)
         #  only contains visible color in the composite
@@ -2764,6 +2978,8 @@ class ColorCompositeBuilder(CompositeBuilder):
 
     def finalize(self, probes, save=True):
         results = {}
+        for finalNodeId in self.changes.keys():
+            self._getComposite(finalNodeId)
         for finalNodeId, compositeMask in self.composites.iteritems():
             result = np.zeros((compositeMask.shape[0], compositeMask.shape[1])).astype('uint8')
             matches = np.any(compositeMask != [255, 255, 255], axis=2)
@@ -2796,16 +3012,19 @@ class ColorCompositeBuilder(CompositeBuilder):
 class CompositeDelegate:
     composite = None
 
-    def __init__(self, edge_id, graph, gopLoader, maskMemory, notifier=None):
+    def __init__(self, edge_id, graph, gopLoader, maskMemory, notifier=None, transformMemory=None):
         """
         :param edge_id
         :param graph:
         :param gopLoader:
+        :param transformMemory: edge artifacts shared with other delegates
         @type edge_id : (str,str)
         @type graph: ImageGraph
         @type gopLoader: GroupFilterLoader
+        @type transformMemory: EdgeTransformMemory
         """
         self.maskMemory= maskMemory
+        self.transformMemory = transformMemory
         self.gopLoader = gopLoader
         self.graph = graph
         self.meta_extractor = MetaDataExtractor(self.graph)
@@ -2936,7 +3155,8 @@ class CompositeDelegate:
                                               self.get_dir(),
                                               maskMemory=self.maskMemory,
                                               base_id=self.edge_id,
-                                              checkEmptyMask=checkEmptyMask)
+                                              checkEmptyMask=checkEmptyMask,
+                                              transformMemory=self.transformMemory)
                     if newMask is None:
                         logging.getLogger('maskgen').warn("Mask is empty for {} due to edge ({},{}) using operation {}.".format(
                             str(edge_id),source,target,op.name
@@ -2989,7 +3209,7 @@ class CompositeDelegate:
                 compositeMask = compositeMaskSetFromVideoSegment(probe.targetVideoSegments)
             else:
                 media_type = 'image'
-                compositeMask = probe.targetMaskImage.invert().image_array
+                compositeMask = np.asarray(probe.targetMaskImage.invert())
             edge = self.graph.get_edge(source, target)
             if len(override_args) > 0 and edge is not None:
                 edge = copy.deepcopy(edge)
@@ -3113,7 +3333,7 @@ class CompositeDelegate:
                                                 shortenName(self.edge_id[0] + '_' + self.edge_id[1] + '_' + finalNodeId,
                                                             '_ps.png',
                                                             identifier=self.graph.nextId()))
-            target_mask = ImageWrapper(image.mask).invert()
+            target_mask = packMask(ImageWrapper(image.mask).invert())
             if saveTargets:
                 target_mask.save(target_mask_filename, format='PNG')
             return CompositeImage(image.source,image.target,image.media_type,target_mask), \
@@ -3228,7 +3448,8 @@ class CompositeDelegate:
                                         graph=self.graph,
                                         maskMemory=self.maskMemory,
                                         baseEdge=baseEdge,
-                                        checkEmptyMask=checkEmptyMask)
+                                        checkEmptyMask=checkEmptyMask,
+                                        transformMemory=self.transformMemory)
             if checkEmptyMask and donorMask.isEmpty():
                 continue
             result.extend(fillEmptyMasks(pred, node, self._constructDonor(pred, donorMask, media_type=media_type,
@@ -3321,7 +3542,7 @@ class CompositeDelegate:
         return None
 
     def __imagePreprocess(self, mask):
-        return ImageWrapper(mask).invert()
+        return packMask(ImageWrapper(mask).invert())
 
     def __videoPreprocess(self, mask):
         return mask
@@ -3455,15 +3676,136 @@ class CompositeDelegate:
         return donors
 
 
-def prepareComposite(edge_id, graph, gopLoader, memory=None, notifier=None):
+def prepareComposite(edge_id, graph, gopLoader, memory=None, notifier=None, transformMemory=None):
     """
     Depending on the edge properties, construct the composite mask
     :param graph
     :param edge_id: edge
     :param edge:  dictionary of edge
+    :param transformMemory: edge artifacts shared across composites
     :return: CompositeDelegate
     @type graph: ImageGraph
     @type edge_id: (str, str)
     @type edge: dict[str,dict]
+    @type transformMemory: EdgeTransformMemory
+    """
+    return CompositeDelegate(edge_id, graph, gopLoader, memory, notifier=notifier, transformMemory=transformMemory)
+
+
+def _detachProbeMasks(probes):
+    """
+    Drop in-memory masks that are already persisted to files, reducing the
+    size of probes passed between processes.
+    @type probes: list of Probe
     """
-    return CompositeDelegate(edge_id, graph, gopLoader, memory, notifier=notifier)
+    for probe in probes:
+        if probe.targetMaskImage is not None and probe.targetMaskFileName is not None and \
+                os.path.exists(probe.targetMaskFileName):
+            probe.targetMaskImage = None
+        if probe.donorMaskImage is not None and probe.donorMaskFileName is not None and \
+                os.path.exists(probe.donorMaskFileName):
+            probe.donorMaskImage = None
+    return probes
+
+
+def _attachProbeMasks(probes):
+    """
+    Restore masks dropped by _detachProbeMasks from their files.
+    @type probes: list of Probe
+    """
+    for probe in probes:
+        if probe.targetMaskImage is None and probe.targetMaskFileName is not None and \
+                probe.targetVideoSegments is None and os.path.exists(probe.targetMaskFileName):
+            probe.targetMaskImage = packMask(openImageFile(probe.targetMaskFileName, isMask=True))
+        if probe.donorMaskImage is None and probe.donorMaskFileName is not None and \
+                probe.donorVideoSegments is None and os.path.exists(probe.donorMaskFileName):
+            probe.donorMaskImage = packMask(openImageFile(probe.donorMaskFileName, isMask=True))
+    return probes
+
+
+# state of a probe worker process, set once per process by initializeProbeWorker
+probe_worker = {}
+
+
+def initializeProbeWorker(graph, memory=None):
+    """
+    Initialize a worker process of the probe construction pool.
+    The graph is received once per process rather than with each edge.
+    The edge artifacts memoized by the process are shared across the edges it constructs.
+    :param graph:
+    :param memory: ProbeMaskMemory
+    @type graph: ImageGraph
+    """
+    probe_worker['graph'] = graph
+    probe_worker['memory'] = memory
+    probe_worker['transformMemory'] = EdgeTransformMemory()
+
+
+def constructProbesForEdge(edge_id, graph=None, memory=None, idStart=None, transformMemory=None, **kwargs):
+    """
+    Construct the probes for a single edge, rebuilding the CompositeDelegate.
+    Designed to run in a worker process: the graph is a pickled copy, notifications are
+    collected and returned to the caller to replay and masks saved to files are not returned with
+    the probes (see _attachProbeMasks).
+    Without a graph, the graph, memory and edge artifacts of the worker process are used (see initializeProbeWorker).
+    Mask file names use provisional identifiers following idStart; the caller replaces them
+    (see renumberProbeMasks).
+    :param edge_id:
+    :param graph:
+    :param memory: ProbeMaskMemory
+    :param idStart: identifiers issued by the graph follow idStart
+    :param transformMemory: edge artifacts memoized across calls
+    :param kwargs: arguments to CompositeDelegate.constructProbes
+    :return: probes, collected notifications and the last identifier issued
+    @type edge_id: (str, str)
+    @type graph: ImageGraph
+    @rtype: (list of Probe, list, int)
+    """
+    from group_filter import GroupOperationsLoader
+    if graph is None:
+        graph = probe_worker['graph']
+        memory = probe_worker['memory']
+        transformMemory = probe_worker['transformMemory']
+    if idStart is not None:
+        graph.idc = idStart
+    notifications = []
+    delegate = prepareComposite(edge_id, graph, GroupOperationsLoader(), memory, notifier=notifications.append,
+                                transformMemory=transformMemory)
+    probes = delegate.constructProbes(**kwargs)
+    return _detachProbeMasks(probes), notifications, graph.idc
+
+
+def renumberProbeMasks(probes, graph, idStart, idEnd):
+    """
+    Replace the provisional identifiers (idStart, idEnd] in the mask file names of the probes
+    with identifiers issued by the graph, renaming the files saved under the provisional names.
+    :param probes:
+    :param graph:
+    :param idStart: see constructProbesForEdge
+    :param idEnd: the last provisional identifier issued
+    @type probes: list of Probe
+    @type graph: ImageGraph
+    """
+    identifiers = dict([('_{}_'.format(identifier), '_{}_'.format(graph.nextId()))
+                        for identifier in range(idStart + 1, idEnd + 1)])
+    names = {}
+
+    def rename(filename):
+        if filename is None or len(identifiers) == 0:
+            return filename
+        if filename not in names:
+            directory, name = os.path.split(filename)
+            newname = name
+            for provisional, identifier in identifiers.iteritems():
+                if provisional in name:
+                    newname = name.replace(provisional, identifier)
+                    break
+            names[filename] = os.path.join(directory, newname)
+            if newname != name and os.path.exists(filename):
+                os.rename(filename, names[filename])
+        return names[filename]
+
+    for probe in probes:
+        probe.targetMaskFileName = rename(probe.targetMaskFileName)
+        probe.donorMaskFileName = rename(probe.donorMaskFileName)
+    return probes
@@ -7,7 +7,13 @@
 # ==============================================================================
 
 from pkg_resources import iter_entry_points
+import json
+import os
 import qa_logic
+from maskgen import __version__
+from disk_cache import DiskCache, make_key, file_md5
+from support import getValue
+from maskgen_loader import MaskGenLoader
 
 class MaskgenNotifer:
 
@@ -111,7 +117,7 @@ class QaNotifier:
         """
         self.qadata = None
         self.scmodel = scmodel
-        self.scmodel.set_probe_mask_memory(ProbeMaskMemory())
+        self.scmodel.set_probe_mask_memory(createProbeMaskMemory(MaskGenLoader(), inProcess=True))
 
     def __call__(self, *args, **kwargs):
         if args[1] != 'update_edge':
@@ -231,3 +237,141 @@ class ProbeMaskMemory:
                     self.basetypeedge[base][probe_type].pop(edge)
                 except:
                     pass
+
+    def forWorker(self):
+        """
+        :return: the memory given to a worker process: masks remembered in process are not sent,
+        as the worker's additions are not returned
+        """
+        return ProbeMaskMemory()
+
+    def fetch(self, key, mask, graph, edge, related_edges=[]):
+        """
+        :param key: (probe type, base edge id, edge id)
+        :param mask: the mask entering the edge
+        :param graph:
+        :param edge: edge dictionary of the edge id
+        :param related_edges: other edge dictionaries contributing to the transform
+        :return: the remembered transformed mask or None
+        @type mask: CompositeImage
+        @type graph: ImageGraph
+        """
+        return self[key]
+
+    def store(self, key, mask, graph, edge, result, related_edges=[]):
+        """
+        Remember the result of transforming the mask through the edge.  See fetch.
+        """
+        self[key] = result
+
+
+_volatile_properties = ['description', 'username', 'ctime', 'opsys', 'tool', 'errors', 'xpos', 'ypos',
+                        'semanticGroups', 'qacomment', 'pathanalysis']
+
+
+def _signature(item):
+    return json.dumps(dict([(k, v) for k, v in item.iteritems() if k not in _volatile_properties]),
+                      sort_keys=True, default=str) if item is not None else ''
+
+
+class PersistentProbeMaskMemory(ProbeMaskMemory):
+    """
+    Transformed masks persisted on disk, shared across processes and runs.
+    Entries are keyed by content: the mask entering the edge with its source and target, the base edge,
+    the edge (operation and arguments), the nodes of the edge and the md5 of the media and mask files of the edge.
+    Video composites are not persisted.
+    """
+
+    def __init__(self, cache, inProcess=True):
+        """
+        :param cache:
+        :param inProcess: also remember by base and edge id in process, requiring forget() on change
+        @type cache: DiskCache
+        """
+        ProbeMaskMemory.__init__(self)
+        self.cache = cache
+        self.inProcess = inProcess
+
+    def __getitem__(self, item):
+        return ProbeMaskMemory.__getitem__(self, item) if self.inProcess else None
+
+    def __setitem__(self, key, item):
+        if self.inProcess:
+            ProbeMaskMemory.__setitem__(self, key, item)
+
+    def forWorker(self):
+        """
+        :return: the memory given to a worker process, sharing the persistent cache only
+        """
+        return PersistentProbeMaskMemory(self.cache, inProcess=self.inProcess)
+
+    def _edgeFiles(self, graph, edge):
+        files = []
+        for name in ['maskname', 'inputmaskname']:
+            value = getValue(edge, name)
+            if value is not None and len(value) > 0:
+                files.append(os.path.join(graph.dir, value))
+        for value in getValue(edge, 'arguments', {}).values():
+            if isinstance(value, basestring) and len(value) > 0 and os.path.isfile(os.path.join(graph.dir, value)):
+                files.append(os.path.join(graph.dir, value))
+        return files
+
+    def _contentKey(self, key, mask, graph, edge, related_edges):
+        if mask is None or not mask.isImage() or mask.region is None or graph is None:
+            return None
+        source, target = key[2]
+        files = [graph.get_image_path(source), graph.get_image_path(target)]
+        for item in [edge] + list(related_edges):
+            files.extend(self._edgeFiles(graph, item))
+        # the composite fetched carries the source and target it was stored with
+        return make_key(__version__,
+                        key[0],
+                        key[1],
+                        mask.source,
+                        mask.target,
+                        mask.offset,
+                        mask.shape,
+                        mask.region,
+                        _signature(edge),
+                        sorted([_signature(item) for item in related_edges]),
+                        _signature(graph.get_node(source)),
+                        _signature(graph.get_node(target)),
+                        [file_md5(filename) for filename in files])
+
+    def fetch(self, key, mask, graph, edge, related_edges=[]):
+        result = self[key]
+        if result is not None:
+            return result
+        content_key = self._contentKey(key, mask, graph, edge, related_edges)
+        if content_key is None:
+            return None
+        result = self.cache.get(content_key)
+        if result is not None:
+            self[key] = result
+        return result
+
+    def store(self, key, mask, graph, edge, result, related_edges=[]):
+        self[key] = result
+        if result is None or not result.isImage():
+            return
+        content_key = self._contentKey(key, mask, graph, edge, related_edges)
+        if content_key is not None:
+            self.cache.put(content_key, result)
+
+
+def createProbeMaskMemory(preferences, inProcess=False):
+    """
+    The persistent memory is used if the preference 'probe_mask_cache.dir' is set.
+    The byte budget is set by preference 'probe_mask_cache.bytes'.
+    :param preferences:
+    :param inProcess: remember masks by base and edge id in process (requires forget() on change)
+    :return: probe mask memory
+    @type preferences: MaskGenLoader
+    """
+    from video_tools import DummyMemory
+    directory = preferences.get_key('probe_mask_cache.dir')
+    if directory is not None and len(directory) > 0:
+        cache = DiskCache(directory,
+                          max_bytes=int(preferences.get_key('probe_mask_cache.bytes', 2 * 1024 * 1024 * 1024)))
+        return PersistentProbeMaskMemory(cache, inProcess=inProcess)
+    return ProbeMaskMemory() if inProcess else DummyMemory(None)
@@ -7,7 +7,6 @@
 # ==============================================================================
 
 from image_graph import createGraph
-from maskgen.video_tools import DummyMemory
 from support import getPathValues
 import exif
 import os
@@ -26,8 +25,10 @@ from group_filter import buildFilterOperation,  GroupFilter,  GroupOperationsLoa
 from graph_auto_updates import updateJournal
 import hashlib
 import shutil
+import cPickle
+import networkx as nx
 import collections
-from threading import Lock
+from threading import Lock, Event
 import mask_rules
 from mask_rules import ColorCompositeBuilder, Probe
 from maskgen.image_graph import ImageGraph
@@ -35,7 +36,7 @@ import copy
 from maskgen.userinfo import get_username
 from validation.core import Validator, ValidationMessage,Severity,removeErrorMessages
 import traceback
-from support import MaskgenThreadPool, StatusTracker, getPathValuesFunc
+from support import MaskgenThreadPool, MaskgenProcessPool, StatusTracker, getPathValuesFunc
 import notifiers
 
 def formatStat(val):
@@ -50,6 +51,23 @@ prefLoader = MaskGenLoader()
 def defaultNotify(edge, message, **kwargs):
     return True
 
+
+def probeCompare(x,y):
+    """
+    Probe order: final image file name, level and then edge id.
+    :param x:
+    :param y:
+    :return:
+    @type x: Probe
+    @type y: Probe
+    """
+    diff = cmp(x.finalImageFileName,y.finalImageFileName)
+    if diff == 0:
+        diff = x.level - y.level
+        if diff == 0:
+            return cmp (str(x.edgeId), str(y.edgeId))
+    return diff
+
 def loadProject(projectFileName, notify=None, username=None, tool=None):
     """
       Given JSON file name, open then the appropriate type of project
@@ -494,8 +512,9 @@ class ImageImageLinkTool(LinkTool):
                 mask = startIm.apply_alpha_to_mask(mask)
         else:
             logging.getLogger('maskgen').debug('Create Mask')
-            mask, analysis, error = createMask(startIm,
+            mask, analysis, error = scModel.createMask(startIm,
                                         destIm,
+                                        [startFileName, destFileName],
                                         invert=invert,
                                         arguments=arguments,
                                         alternativeFunction=operation.getCompareFunction(),
@@ -985,6 +1004,170 @@ linkTools = {'image.image': ImageImageLinkTool(), 'video.video': VideoVideoLinkT
 def true_notify(object, message, **kwargs):
     return True
 
+
+class ProbeCache:
+    """
+    Probes of the last probe set construction, by base edge.
+    Probes are reused until a changed edge (see ImageGraph.pop_dirty_edges) falls on
+    the paths that construct them: the paths from the base nodes through the base edge
+    to the final nodes and the donor paths into the base edge's target.
+    Only probes referring to their masks by file are kept; the masks are not held.
+    Used only if the preference 'probe_reuse' is set.
+    """
+
+    def __init__(self):
+        self.graph = None
+        self.arguments = None
+        self.probes = {}
+
+    def _isAffected(self, graph, edge_id, dirty_edges):
+        upstream = nx.ancestors(graph.G, edge_id[1])
+        upstream.add(edge_id[1])
+        downstream = nx.descendants(graph.G, edge_id[1])
+        downstream.add(edge_id[1])
+        for source, target in dirty_edges:
+            if target in upstream or source in downstream:
+                return True
+        return False
+
+    def _isIntact(self, probes):
+        for probe in probes:
+            for filename in [probe.targetMaskFileName, probe.donorMaskFileName]:
+                if filename is not None and not os.path.exists(filename):
+                    return False
+        return True
+
+    def split(self, graph, edge_ids, arguments):
+        """
+        :param graph:
+        :param edge_ids: base edges of the probe set
+        :param arguments: arguments of the probe set construction
+        :return: reusable probes and the base edges requiring construction
+        @type graph: ImageGraph
+        @rtype: (list of Probe, list of (str,str))
+        """
+        dirty_edges = graph.pop_dirty_edges()
+        if graph is not self.graph or arguments != self.arguments:
+            self.graph = graph
+            self.arguments = arguments
+            self.probes = {}
+        reused = []
+        edge_ids_to_construct = []
+        for edge_id in edge_ids:
+            probes = self.probes.get(edge_id)
+            if probes is not None and self._isIntact(probes) and \
+                    not self._isAffected(graph, edge_id, dirty_edges):
+                reused.extend(probes)
+            else:
+                edge_ids_to_construct.append(edge_id)
+        return reused, edge_ids_to_construct
+
+    def update(self, edge_ids, probes):
+        """
+        :param edge_ids: base edges of the probe set
+        :param probes: the probe set
+        @type probes: list of Probe
+        """
+        self.probes = dict([(edge_id, []) for edge_id in edge_ids])
+        for probe in probes:
+            if probe.edgeId in self.probes:
+                detached = ProbeCache.detach(probe)
+                if detached is None:
+                    # constructed again rather than holding the mask
+                    self.probes.pop(probe.edgeId)
+                else:
+                    self.probes[probe.edgeId].append(detached)
+
+    @staticmethod
+    def detach(probe):
+        """
+        :param probe:
+        :return: a copy of the probe without its masks, or None if a mask is not saved to a file
+        @type probe: Probe
+        @rtype: Probe
+        """
+        probe = mask_rules._detachProbeMasks([copy.copy(probe)])[0]
+        if probe.targetMaskImage is not None or probe.donorMaskImage is not None:
+            return None
+        return probe
+
+    def clear(self):
+        self.graph = None
+        self.probes = {}
+
+class MediaPrefetch:
+    """
+    Open the media of a project ahead of first use, in a bounded pool of threads:
+    node files, their exif and video meta-data, edge masks and input masks.
+    Nodes are visited breadth first from the base nodes, each followed by the masks of its
+    outgoing edges.  The media is held by the image, exif and video meta-data caches.
+    """
+
+    def __init__(self, graph, workers):
+        """
+        :param graph:
+        :param workers: number of threads
+        @type graph: ImageGraph
+        """
+        self.graph = graph
+        self.workers = workers
+        self.cancelled = Event()
+        self.pool = None
+
+    def tasks(self):
+        """
+        :return: (function, arguments) in the order of expected first use
+        @rtype: list of (function, tuple)
+        """
+        graph = self.graph
+        tasks = []
+        visited = set()
+        queue = collections.deque([node for node in graph.get_nodes() if len(graph.predecessors(node)) == 0])
+        while len(queue) > 0:
+            node = queue.popleft()
+            if node in visited:
+                continue
+            visited.add(node)
+            pathname = graph.get_pathname(node)
+            if graph.getNodeFileType(node) == 'video':
+                tasks.append((video_tools.getMaskSetForEntireVideo, (video_tools.FileMetaDataLocator(pathname),)))
+            else:
+                tasks.append((graph.get_image, (node,)))
+            tasks.append((exif.getexif, (pathname,)))
+            for successor in graph.successors(node):
+                for path in ['maskname', 'inputmaskname']:
+                    if path in graph.get_edge(node, successor):
+                        tasks.append((graph.get_edge_image, (node, successor, path, True)))
+                queue.append(successor)
+        return tasks
+
+    def _run(self, func, args):
+        if self.cancelled.is_set():
+            return
+        try:
+            func(*args)
+        except Exception as e:
+            logging.getLogger('maskgen').debug('Prefetch of {} failed: {}'.format(str(args), str(e)))
+
+    def start(self):
+        from multiprocessing.pool import ThreadPool
+        tasks = self.tasks()
+        self.pool = ThreadPool(self.workers)
+        for func, args in tasks:
+            self.pool.apply_async(self._run, args=(func, args))
+        self.pool.close()
+
+    def cancel(self):
+        """
+        Skip the media not yet opened; does not wait for those being opened.
+        """
+        self.cancelled.set()
+
+    def wait(self):
+        if self.pool is not None:
+            self.pool.join()
+
+
 class ImageProjectModel:
     """
        A ProjectModel manages a project.  A project is made up of a directed graph of Image nodes and links.
@@ -1016,7 +1199,9 @@ class ImageProjectModel:
 
     def __init__(self, projectFileName, graph=None, notify=None,
                  baseImageFileName=None, username=None,tool=None):
-        self.probeMaskMemory = DummyMemory(None)
+        self.probeMaskMemory = notifiers.createProbeMaskMemory(prefLoader)
+        self.probeCache = ProbeCache()
+        self.maskCache = createMaskCache(prefLoader)
         if notify is not None:
             self.notify = notifiers.NotifyDelegate(
                 [notify, notifiers.QaNotifier(self), notifiers.ValidationNotifier(total_errors=None)])
@@ -1030,7 +1215,25 @@ class ImageProjectModel:
 
         self.gopLoader = GroupOperationsLoader()
         self.username = username if username is not None else get_username()
+        self.prefetch = None
         self._setup(projectFileName, graph=graph, baseImageFileName=baseImageFileName,tool=tool)
+        self.startPrefetch()
+
+    def startPrefetch(self, workers=None):
+        """
+        Open the project's media in the background (see MediaPrefetch).
+        :param workers: number of threads; defaults to preference media_prefetch_threads, 0 for none
+        """
+        self.cancelPrefetch()
+        workers = int(prefLoader.get_key('media_prefetch_threads', 0)) if workers is None else workers
+        if workers > 0:
+            self.prefetch = MediaPrefetch(self.G, workers)
+            self.prefetch.start()
+
+    def cancelPrefetch(self):
+        if self.prefetch is not None:
+            self.prefetch.cancel()
+            self.prefetch = None
 
 
     def set_notifier(self, notifier):
@@ -1272,6 +1475,7 @@ class ImageProjectModel:
                 newfile = os.path.split(newfilename)[1]
                 node['file'] = newfile
                 node['compressed'] = compressor
+                self.G.mark_node_dirty(start)
         return newfile
 
     def connect(self, destination, mod=Modification('Donor', '',category='Donor'), invert=False, sendNotifications=True,
@@ -1316,27 +1520,167 @@ class ImageProjectModel:
         :return: The set of probes
         @rtype: list [Probe]
         """
+        return sorted(self.generateProbes(inclusionFunction=inclusionFunction,
+                                          saveTargets=saveTargets,
+                                          graph=graph,
+                                          constructDonors=constructDonors,
+                                          keepFailures=keepFailures,
+                                          exclusions=exclusions,
+                                          checkEmptyMask=checkEmptyMask,
+                                          audioToVideo=audioToVideo,
+                                          notifier=notifier),
+                      cmp=probeCompare)
+
+    def generateProbes(self, inclusionFunction=mask_rules.isEdgeLocalized,
+                       saveTargets=True,
+                       graph=None,
+                       constructDonors=True,
+                       keepFailures=False,
+                       exclusions={},
+                       checkEmptyMask=True,
+                       audioToVideo=False,
+                       notifier=None,
+                       maxInFlight=None):
+        """
+        Yields the probes of getProbeSetWithoutComposites as the probes of each base edge are constructed,
+        unsorted.  Construction stays at most maxInFlight base edges ahead of the consumer, so the
+        masks held in memory are bounded by the consumer.
+        :param maxInFlight: base edges constructed ahead of the consumer (preference 'probe_max_in_flight',
+        default is twice the number of workers)
+        See getProbeSetWithoutComposites for the other parameters.
+        @rtype: generator of Probe
+        """
         self._executeSkippedComparisons()
-        thread_pool = MaskgenThreadPool(int(prefLoader.get_key('skipped_threads', 2)))
-        futures = list()
         useGraph = graph if graph is not None else self.G
-        for edge_id in useGraph.get_edges():
-            edge = useGraph.get_edge(edge_id[0], edge_id[1])
-            if inclusionFunction(edge_id, edge, self.gopLoader.getOperationWithGroups(edge['op'],fake=True)):
-                composite_generator =  mask_rules.prepareComposite(edge_id, useGraph, self.gopLoader, self.probeMaskMemory, notifier=notifier)
-                futures.append(thread_pool.apply_async(composite_generator.constructProbes, args=(),kwds={
-                    'saveTargets':saveTargets,
-                    'inclusionFunction':inclusionFunction,
-                    'constructDonors':constructDonors,
-                    'keepFailures':keepFailures,
-                    'exclusions':exclusions,
-                    'checkEmptyMask':checkEmptyMask,
-                    'audioToVideo':audioToVideo
-                }))
-        probes = list()
-        for future in futures:
-            probes.extend(future.get(timeout=int(prefLoader.get_key('probe_timeout', 100000))))
-        return probes
+        kwds = {
+            'saveTargets': saveTargets,
+            'inclusionFunction': inclusionFunction,
+            'constructDonors': constructDonors,
+            'keepFailures': keepFailures,
+            'exclusions': exclusions,
+            'checkEmptyMask': checkEmptyMask,
+            'audioToVideo': audioToVideo
+        }
+        edge_ids = [edge_id for edge_id in useGraph.get_edges()
+                    if inclusionFunction(edge_id,
+                                         useGraph.get_edge(edge_id[0], edge_id[1]),
+                                         self.gopLoader.getOperationWithGroups(
+                                             useGraph.get_edge(edge_id[0], edge_id[1])['op'], fake=True))]
+        # reuse is opt-in (preference 'probe_reuse'): edits setting edge attributes directly must
+        # mark the edge with ImageGraph.mark_edge_dirty
+        if useGraph is not self.G or not prefLoader.get_key('probe_reuse', False):
+            for edge_probes in self._constructProbes(useGraph, edge_ids, notifier, kwds, maxInFlight):
+                for probe in edge_probes:
+                    yield probe
+            return
+        # only edges on paths crossing edges changed since the last probe set are reconstructed
+        reused, edge_ids_to_construct = self.probeCache.split(useGraph, edge_ids, copy.deepcopy(kwds))
+        # the cache keeps the probes whose masks are saved to files, without the masks;
+        # edges with masks held only in memory are constructed again
+        cached = list(reused)
+        uncached = set()
+        complete = False
+        try:
+            for probe in reused:
+                yield mask_rules._attachProbeMasks([copy.copy(probe)])[0]
+            for edge_probes in self._constructProbes(useGraph, edge_ids_to_construct, notifier, kwds, maxInFlight):
+                for probe in edge_probes:
+                    detached = ProbeCache.detach(probe)
+                    if detached is None:
+                        uncached.add(probe.edgeId)
+                    else:
+                        cached.append(detached)
+                    yield probe
+            complete = True
+        finally:
+            if complete:
+                self.probeCache.update([edge_id for edge_id in edge_ids if edge_id not in uncached], cached)
+            else:
+                self.probeCache.clear()
+
+    def _constructProbes(self, graph, edge_ids, notifier, kwds, maxInFlight=None):
+        """
+        Construct the probes of each base edge with worker threads or, with preference
+        'probe_processes' above one, worker processes.
+        Each worker process receives a copy of the graph once, when the process starts.
+        Mask files saved by the workers are named with provisional identifiers, replaced by
+        identifiers issued by the graph as the probes of each edge are received.  Masks saved by the
+        workers are reloaded from their files.
+        Notifications issued by the workers are replayed to the notifier.
+        Each worker process starts with an empty probe mask memory (see ProbeMaskMemory.forWorker): masks
+        it remembers in process are not merged into this model's memory (masks persisted by a
+        PersistentProbeMaskMemory are shared through its directory).
+        The arguments must be picklable for worker processes (e.g. a lambda as inclusion function
+        is not); otherwise worker threads are used.
+        :param graph:
+        :param edge_ids: edges to construct probes for
+        :param notifier:
+        :param kwds: arguments to CompositeDelegate.constructProbes
+        :param maxInFlight: edges submitted ahead of the consumer
+        :return: the probes of each edge, in the order of the edges
+        @type graph: ImageGraph
+        @rtype: generator of list of Probe
+        """
+        probe_processes = int(prefLoader.get_key('probe_processes', 0))
+        timeout = int(prefLoader.get_key('probe_timeout', 100000))
+        workerMemory = self.probeMaskMemory.forWorker() if probe_processes > 1 else None
+        if probe_processes > 1:
+            try:
+                cPickle.dumps((graph, workerMemory, kwds), cPickle.HIGHEST_PROTOCOL)
+            except (cPickle.PicklingError, TypeError, AttributeError) as e:
+                logging.getLogger('maskgen').warning(
+                    'Probe arguments cannot be sent to worker processes, using threads: {}'.format(str(e)))
+                probe_processes = 0
+        if probe_processes > 1:
+            workers = probe_processes
+            pool = MaskgenProcessPool(probe_processes,
+                                      initializer=mask_rules.initializeProbeWorker,
+                                      initargs=(graph, workerMemory))
+            # provisional identifiers, distinct per edge, cannot collide with those issued by the graph
+            provisional_block = 1 << 20
+            submitted = [0]
+
+            def submit(edge_id):
+                submitted[0] += 1
+                idStart = -submitted[0] * provisional_block
+                return idStart, pool.apply_async(mask_rules.constructProbesForEdge,
+                                                 args=(edge_id,),
+                                                 kwds=dict(kwds, idStart=idStart))
+
+            def receive(future):
+                idStart, result = future
+                edge_probes, notifications, idEnd = result.get(timeout=timeout)
+                if notifier is not None:
+                    for notification in notifications:
+                        notifier(notification)
+                mask_rules.renumberProbeMasks(edge_probes, graph, idStart, idEnd)
+                return mask_rules._attachProbeMasks(edge_probes)
+        else:
+            workers = int(prefLoader.get_key('skipped_threads', 2))
+            pool = MaskgenThreadPool(workers)
+            transformMemory = mask_rules.EdgeTransformMemory()
+
+            def submit(edge_id):
+                composite_generator = mask_rules.prepareComposite(edge_id, graph, self.gopLoader, self.probeMaskMemory,
+                                                                  notifier=notifier,
+                                                                  transformMemory=transformMemory)
+                return pool.apply_async(composite_generator.constructProbes, args=(), kwds=kwds)
+
+            def receive(future):
+                return future.get(timeout=timeout)
+        if maxInFlight is None:
+            maxInFlight = int(prefLoader.get_key('probe_max_in_flight', 2 * max(1, workers)))
+        maxInFlight = max(1, maxInFlight)
+        futures = collections.deque()
+        position = 0
+        try:
+            while position < len(edge_ids) or len(futures) > 0:
+                while position < len(edge_ids) and len(futures) < maxInFlight:
+                    futures.append(submit(edge_ids[position]))
+                    position += 1
+                yield receive(futures.popleft())
+        finally:
+            pool.close()
 
     def getProbeSet(self,
                     inclusionFunction=mask_rules.isEdgeLocalized,
@@ -1367,22 +1711,6 @@ class ImageProjectModel:
         @type inclusionFunction: (tuple, dict) -> bool
         @rtype: list of Probe
         """
-        def probeCompare(x,y):
-            """
-
-            :param x:
-            :param y:
-            :return:
-            @type x: Probe
-            @type y: Probe
-            """
-            diff = cmp(x.finalImageFileName,y.finalImageFileName)
-            if diff == 0:
-                diff = x.level - y.level
-                if diff == 0:
-                    return cmp (str(x.edgeId), str(y.edgeId))
-            return diff
-
         self.assignColors()
         probes = replacement_probes if replacement_probes is not None else \
             self.getProbeSetWithoutComposites(inclusionFunction=inclusionFunction,
@@ -1530,6 +1858,7 @@ class ImageProjectModel:
                 #                    edge['arguments'] = {}
                 edge['inputmaskname'] = os.path.split(inputmaskname)[1]
                 #               edge['arguments']['inputmaskname'] = os.path.split(inputmaskname)[1]
+                self.G.mark_edge_dirty(edge_id[0], edge_id[1])
                 self.G.setDataItem('autopastecloneinputmask', 'yes')
 
     def renametobase(self):
@@ -1757,6 +2086,26 @@ class ImageProjectModel:
                                                                        invert=invert,
                                                                        analysis_params=analysis_params)
 
+    def createMask(self, img1, img2, files, invert=False, arguments={}, alternativeFunction=None,
+                   convertFunction=None):
+        """
+        See tool_set.createMask.  Results are reused from the mask cache (preference 'mask_cache.dir')
+        when the media files, functions and arguments are identical to a prior comparison,
+        such as recomputing skipped comparisons or reproducing masks.
+        :param files: files of img1 and img2
+        """
+        if self.maskCache is None:
+            return createMask(img1, img2, invert=invert, arguments=arguments,
+                              alternativeFunction=alternativeFunction,
+                              convertFunction=convertFunction)
+        # files referenced by the arguments, such as input masks
+        files = files + [os.path.join(self.get_dir(), value) for value in arguments.values()
+                         if isinstance(value, basestring) and len(value) > 0 and
+                         os.path.isfile(os.path.join(self.get_dir(), value))]
+        return self.maskCache.createMask(files, img1, img2, invert=invert, arguments=arguments,
+                                         alternativeFunction=alternativeFunction,
+                                         convertFunction=convertFunction)
+
     def reproduceMask(self, skipDonorAnalysis=False,edge_id=None, analysis_params=dict()):
         mask_edge_id = (self.start, self.end) if edge_id is None else edge_id
         edge = self.G.get_edge(mask_edge_id[0],mask_edge_id[1])
@@ -2092,6 +2441,17 @@ class ImageProjectModel:
             return ImageWrapper(np.zeros((250, 250, 4)).astype('uint8'))
         return self.G.get_image(name)[0]
 
+    def getThumbnail(self, name, size):
+        """
+        :param name:
+        :param size: (width, height) of the box the image is shown within
+        :return: image of the node, possibly reduced, at least as large as the image scaled to fit the box
+        @rtype: ImageWrapper
+        """
+        if name is None or name == '':
+            return ImageWrapper(np.zeros((250, 250, 4)).astype('uint8'))
+        return self.G.get_image_for_size(name, size)[0]
+
     def getImageAndName(self, name, arguments=dict()):
         """
         :param name:
@@ -2298,8 +2658,12 @@ class ImageProjectModel:
             level = level + 1
         redistribute_intensity(edgeMap)
         for k, v in edgeMap.iteritems():
-            self.G.get_edge(k[0], k[1])['linkcolor'] = str(list(v[1])).replace('[', '').replace(']', '').replace(
-                ',', '')
+            color = str(list(v[1])).replace('[', '').replace(']', '').replace(',', '')
+            edge = self.G.get_edge(k[0], k[1])
+            if getValue(edge, 'linkcolor') != color:
+                edge['linkcolor'] = color
+                # probes carry the color of their edge
+                self.G.mark_edge_dirty(k[0], k[1])
         return edgeMap
 
     def __assignLabel(self, node, label):
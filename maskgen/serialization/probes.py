@@ -111,14 +111,15 @@ def compare_mask_images(got, expected):
     :param got:
     :param expected:
     :return:
-    @type got: ImageWrapper
+    @type got: ImageWrapper or PackedMask
     @type expected: ImageWrapper
     """
     import numpy as np
     if got is not None and expected is not None:
-        diff = abs(got.image_array.astype('float') - expected.image_array.astype('float'))
+        expected_array = np.asarray(expected)
+        diff = abs(np.asarray(got).astype('float') - expected_array.astype('float'))
         diffsize = np.sum(diff > 0)
-        masksize = np.sum(expected.image_array > 0)
+        masksize = np.sum(expected_array > 0)
         if diffsize / masksize <= 0.05:
             return True
     return False
@@ -37,12 +37,16 @@ def append_segment(row, segment):
                   segment.starttime, segment.endtime, segment.rate, segment.error]
 
 
-def archive_probes(project, directory='.', archive=True, reproduceMask= True):
+def archive_probes(project, directory='.', archive=True, reproduceMask= True, maxInFlight=None):
     """
     Create an archive containing probe files and CSV file describing the probes.
+    Probes are written in probe order (see scenario_model.probeCompare).  Their masks are
+    released as they are constructed, once saved to files, so the masks held in memory are
+    bounded by maxInFlight (see ImageProjectModel.generateProbes).
 
     :param project:  project (tgz or directory) location
     :param directory: location to place archive
+    :param maxInFlight: base edges constructed ahead of writing their probes
     :return:
     @param project: str
     @param directory: str
@@ -54,77 +58,101 @@ def archive_probes(project, directory='.', archive=True, reproduceMask= True):
     if reproduceMask:
         for edge_id in scModel.getGraph().get_edges():
             scModel.reproduceMask(edge_id=edge_id)
-    probes = scModel.getProbeSet(compositeBuilders=[EmptyCompositeBuilder])
+    # as getProbeSet, edges are given link colors before the probes are constructed
+    scModel.assignColors()
     project_dir = scModel.get_dir()
     csvfilename = os.path.join(project_dir, 'probes.csv')
-    items_to_archive = []
-    with open(csvfilename, 'w') as outputfile:
-        csvwriter = csv.writer(outputfile, delimiter=',')
-        for probe in probes:
-            base_node = scModel.getGraph().get_node(probe.targetBaseNodeId)
-            final_node = scModel.getGraph().get_node(probe.finalNodeId)
-            items_to_archive.append(base_node['file'])
-            items_to_archive.append(final_node['file'])
-            if probe.donorBaseNodeId is not None:
-                donor_node = scModel.getGraph().get_node(probe.donorBaseNodeId)
-                items_to_archive.append(donor_node['file'])
-            else:
-                donor_node = None
-            if probe.donorMaskFileName is not None:
-                items_to_archive.append(os.path.basename(probe.donorMaskFileName))
-            if probe.targetMaskFileName is not None:
-                items_to_archive.append(os.path.basename(probe.targetMaskFileName))
-            edge = scModel.getGraph().get_edge(probe.edgeId[0], probe.edgeId[1])
-            csvwriter.writerow(append_segment(['summary',
-                                               probe.edgeId[0],
-                                               probe.edgeId[1],
-                                               edge['op'],
-                                               base_node['file'],
-                                               final_node['file'],
-                                               '' if probe.targetMaskFileName is None else os.path.basename(
-                                                   probe.targetMaskFileName),
-                                               '' if donor_node is None else donor_node['file'],
-                                               '' if probe.donorMaskFileName is None else os.path.basename(
-                                                   probe.donorMaskFileName)],
-                                              None))
-            for donor_segment in (probe.donorVideoSegments if probe.donorVideoSegments is not None else []):
-                if donor_segment.filename is not None and len(donor_segment.filename) > 0:
-                    items_to_archive.append(os.path.basename(donor_segment.filename))
-                csvwriter.writerow(append_segment(['donor_segment',
-                                                   probe.edgeId[0],
-                                                   probe.edgeId[1],
-                                                   edge['op'],
-                                                   base_node['file'],
-                                                   final_node['file'],
-                                                   '',
-                                                   '',
-                                                   ''],
-                                                  donor_segment))
-            for video_segment in (probe.targetVideoSegments if probe.targetVideoSegments is not None else []):
-                if video_segment.filename is not None and len(video_segment.filename) > 0:
-                    items_to_archive.append(os.path.basename(video_segment.filename))
-                csvwriter.writerow(append_segment(['target_segment',
-                                                   probe.edgeId[0],
-                                                   probe.edgeId[1],
-                                                   edge['op'],
-                                                   base_node['file'],
-                                                   final_node['file'],
-                                                   '',
-                                                   '',
-                                                   ''],
-                                                  video_segment))
-    if archive:
-        fname = os.path.join(directory, scModel.getName() + '.tgz')
-        archive_file = tarfile.open(fname, "w:gz", errorlevel=2)
-        # retain the CSV file in the archive
-        items_to_archive.append(os.path.basename(csvfilename))
-        # insure unique file names, as probes often reference the same image files (donors and targets)
-        items_to_archive = set(items_to_archive)
-        # move all files of interest into the archive
-        for item in items_to_archive:
+    probes = []
+    for probe in scModel.generateProbes(audioToVideo=True, maxInFlight=maxInFlight):
+        detached = maskgen.scenario_model.ProbeCache.detach(probe)
+        probes.append(detached if detached is not None else probe)
+    # opened once the probes are constructed, so a failed construction leaves no partial archive
+    archive_file = tarfile.open(os.path.join(directory, scModel.getName() + '.tgz'), "w:gz", errorlevel=2) \
+        if archive else None
+    # insure unique file names, as probes often reference the same image files (donors and targets)
+    archived = set()
+
+    def archive_item(item):
+        if archive_file is not None and item not in archived:
+            archived.add(item)
             archive_file.add(os.path.join(project_dir, item),
-                        arcname=os.path.join(scModel.getName(), item))
-        archive_file.close()
+                             arcname=os.path.join(scModel.getName(), item))
+
+    try:
+        with open(csvfilename, 'w') as outputfile:
+            csvwriter = csv.writer(outputfile, delimiter=',')
+            for probe in sorted(probes, cmp=maskgen.scenario_model.probeCompare):
+                write_probe(scModel, probe, csvwriter, archive_item)
+        if archive_file is not None:
+            # retain the CSV file in the archive
+            archive_item(os.path.basename(csvfilename))
+    finally:
+        if archive_file is not None:
+            archive_file.close()
+
+
+def write_probe(scModel, probe, csvwriter, archive_item=lambda item: None):
+    """
+    Write the CSV rows describing the probe.
+    :param scModel:
+    :param probe:
+    :param csvwriter:
+    :param archive_item: called with the name (relative to the project directory) of each file of the probe
+    @type scModel: maskgen.scenario_model.ImageProjectModel
+    @type probe: Probe
+    """
+    base_node = scModel.getGraph().get_node(probe.targetBaseNodeId)
+    final_node = scModel.getGraph().get_node(probe.finalNodeId)
+    archive_item(base_node['file'])
+    archive_item(final_node['file'])
+    if probe.donorBaseNodeId is not None:
+        donor_node = scModel.getGraph().get_node(probe.donorBaseNodeId)
+        archive_item(donor_node['file'])
+    else:
+        donor_node = None
+    if probe.donorMaskFileName is not None:
+        archive_item(os.path.basename(probe.donorMaskFileName))
+    if probe.targetMaskFileName is not None:
+        archive_item(os.path.basename(probe.targetMaskFileName))
+    edge = scModel.getGraph().get_edge(probe.edgeId[0], probe.edgeId[1])
+    csvwriter.writerow(append_segment(['summary',
+                                       probe.edgeId[0],
+                                       probe.edgeId[1],
+                                       edge['op'],
+                                       base_node['file'],
+                                       final_node['file'],
+                                       '' if probe.targetMaskFileName is None else os.path.basename(
+                                           probe.targetMaskFileName),
+                                       '' if donor_node is None else donor_node['file'],
+                                       '' if probe.donorMaskFileName is None else os.path.basename(
+                                           probe.donorMaskFileName)],
+                                      None))
+    for donor_segment in (probe.donorVideoSegments if probe.donorVideoSegments is not None else []):
+        if donor_segment.filename is not None and len(donor_segment.filename) > 0:
+            archive_item(os.path.basename(donor_segment.filename))
+        csvwriter.writerow(append_segment(['donor_segment',
+                                           probe.edgeId[0],
+                                           probe.edgeId[1],
+                                           edge['op'],
+                                           base_node['file'],
+                                           final_node['file'],
+                                           '',
+                                           '',
+                                           ''],
+                                          donor_segment))
+    for video_segment in (probe.targetVideoSegments if probe.targetVideoSegments is not None else []):
+        if video_segment.filename is not None and len(video_segment.filename) > 0:
+            archive_item(os.path.basename(video_segment.filename))
+        csvwriter.writerow(append_segment(['target_segment',
+                                           probe.edgeId[0],
+                                           probe.edgeId[1],
+                                           edge['op'],
+                                           base_node['file'],
+                                           final_node['file'],
+                                           '',
+                                           '',
+                                           ''],
+                                          video_segment))
 
 def main():
     import sys
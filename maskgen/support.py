@@ -194,6 +194,29 @@ class MaskgenThreadPool:
             result._set(0,(True,func(*args, **kwds)))
             return result
 
+    def close(self):
+        if self.thread_pool is not None:
+            self.thread_pool.close()
+            self.thread_pool.join()
+
+
+class MaskgenProcessPool(MaskgenThreadPool):
+    """
+    Same contract as MaskgenThreadPool, backed by worker processes.
+    The function and its arguments must be picklable (module level functions).
+    The initializer is called with initargs once in each worker process (or once
+    in this process if the pool size is one).
+    """
+
+    def __init__(self,size, initializer=None, initargs=()):
+        from multiprocessing import Pool
+        if size > 1:
+            self.thread_pool = Pool(size, initializer=initializer, initargs=initargs)
+        else:
+            self.thread_pool = None
+            if initializer is not None:
+                initializer(*initargs)
+
 
 
 class ModuleStatus:
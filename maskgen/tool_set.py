@@ -8,6 +8,7 @@
 
 import math
 import re
+import copy
 from datetime import datetime
 from skimage.measure import compare_ssim
 import warnings
@@ -21,7 +22,7 @@ import threading
 import loghandling
 import cv2api
 from ffmpeg_api import get_ffprobe_tool
-from maskgen.support import removeValue, getValue
+from maskgen.support import removeValue, getValue, MaskgenThreadPool
 import os
 from maskgen.userinfo import get_username
 import maskgen.exif
@@ -390,6 +391,47 @@ class VidTimeManager:
                         self.frameCountWhenStarted = self.frameSinceBeginning
                         self.beforeStartTime = False
 
+    def framesBeforeStart(self, rate, milliNow, limit):
+        """
+        The frames following the current frame, of a video of constant rate, that can be passed
+        without reaching the start or end of the range (see skipFrames).  Frames within half a frame of
+        the start or end times are not passed, as their order against those times is uncertain.
+        :param rate: frames per second
+        :param milliNow: time of the current frame
+        :param limit: frames remaining in the video
+        :return: number of frames
+        """
+        if rate <= 0 or not self.isBeforeTime():
+            return 0
+        period = 1000.0 / rate
+        boundaries = [times[0] for times in [self.startTimeandFrame, self.stopTimeandFrame]
+                      if times and times[0] is not None]
+        simulated = copy.copy(self)
+        frames = 0
+        while frames < limit:
+            frame_time = milliNow + (frames + 1) * period
+            if len([boundary for boundary in boundaries if abs(frame_time - boundary) < period / 2.0]) > 0:
+                break
+            simulated.updateToNow(frame_time)
+            if not simulated.isBeforeTime() or simulated.isEnd():
+                break
+            frames += 1
+        return frames
+
+    def skipFrames(self, rate, milliNow, frames, lastTime):
+        """
+        Update to now for frames not read, of a video of constant rate, following the current frame.
+        :param rate: frames per second
+        :param milliNow: time of the current frame
+        :param frames: number of frames (see framesBeforeStart)
+        :param lastTime: time of the last of the frames
+        """
+        period = 1000.0 / rate
+        for frame in range(1, frames):
+            self.updateToNow(milliNow + frame * period)
+        if frames > 0:
+            self.updateToNow(lastTime)
+
     def setStopFrame(self, frame):
         ""
         if self.stopTimeandFrame[0] > 0:
@@ -1449,6 +1491,82 @@ def createMask(img1, img2, invert=False, arguments={}, alternativeFunction=None,
     analysis['empty mask'] = 'yes' if np.all(mask == 255) else 'no'
     return ImageWrapper(mask), analysis, error
 
+
+def _functionName(function):
+    return '' if function is None else '{}.{}'.format(getattr(function, '__module__', ''),
+                                                      getattr(function, '__name__', str(function)))
+
+
+class MaskCache:
+    """
+    Results of createMask by content: the md5 of the media files, the files the images were read
+    from (e.g. a proxy of the media) with the arguments they were opened with, the compare and convert
+    functions and the arguments.  Masks are stored as PNG along with the analysis.
+    Failed comparisons are not stored.
+    """
+
+    def __init__(self, cache):
+        """
+        @type cache: maskgen.disk_cache.DiskCache
+        """
+        self.cache = cache
+
+    def _key(self, files, images, invert, arguments, alternativeFunction, convertFunction):
+        import json
+        from maskgen import __version__
+        from maskgen.disk_cache import make_key, file_md5
+        opened = []
+        for img in images:
+            filename = getattr(img, 'filename', None)
+            opened.append((os.path.abspath(filename) if filename is not None else None,
+                           file_md5(filename) if filename is not None else '',
+                           json.dumps(getattr(img, 'open_args', None), sort_keys=True, default=str)))
+        return make_key(__version__,
+                        [file_md5(filename) for filename in files],
+                        opened,
+                        invert,
+                        json.dumps(arguments, sort_keys=True, default=str),
+                        _functionName(alternativeFunction),
+                        _functionName(convertFunction))
+
+    def createMask(self, files, img1, img2, invert=False, arguments={}, alternativeFunction=None,
+                   convertFunction=None):
+        """
+        See createMask.
+        :param files: the files of img1 and img2 and any file referenced by the arguments
+        """
+        key = self._key(files, [img1, img2], invert, arguments, alternativeFunction, convertFunction)
+        value = self.cache.get(key)
+        if value is not None:
+            mask = cv2.imdecode(np.frombuffer(value[0], dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            if mask is not None:
+                return ImageWrapper(mask), value[1], None
+        mask, analysis, error = createMask(img1, img2, invert=invert, arguments=arguments,
+                                           alternativeFunction=alternativeFunction,
+                                           convertFunction=convertFunction)
+        if error is None:
+            ok, png = cv2.imencode('.png', mask.to_array())
+            if ok:
+                self.cache.put(key, (png.tostring(), analysis))
+        return mask, analysis, error
+
+
+def createMaskCache(preferences):
+    """
+    The cache is used if the preference 'mask_cache.dir' is set.
+    The byte budget is set by preference 'mask_cache.bytes'.
+    :return: MaskCache or None
+    @type preferences: MaskGenLoader
+    @rtype: MaskCache
+    """
+    from maskgen.disk_cache import DiskCache
+    directory = preferences.get_key('mask_cache.dir')
+    if directory is None or len(directory) == 0:
+        return None
+    return MaskCache(DiskCache(directory,
+                               max_bytes=int(preferences.get_key('mask_cache.bytes', 2 * 1024 * 1024 * 1024)),
+                               compress=False))
+
 def __indexOf(source, dest):
     positions = []
     for spos in range(len(source)):
@@ -1472,14 +1590,83 @@ def __flannMatcher(d1, d2, args=None):
     return flann.knnMatch(d1, d2, k=2) if d1 is not None and d2 is not None else []
 
 
+feature_cache = None
+feature_cache_lock = threading.Lock()
+
+
+def __featureCache():
+    """
+    The cache of image features is used if the preference 'feature_cache.dir' is set.
+    The byte budget is set by preference 'feature_cache.bytes'.
+    @rtype: maskgen.disk_cache.DiskCache
+    """
+    global feature_cache
+    with feature_cache_lock:
+        if feature_cache is None:
+            from maskgen.disk_cache import DiskCache
+            preferences = MaskGenLoader()
+            directory = preferences.get_key('feature_cache.dir')
+            if directory is None or len(directory) == 0:
+                feature_cache = False
+            else:
+                feature_cache = DiskCache(directory,
+                                          max_bytes=int(preferences.get_key('feature_cache.bytes',
+                                                                            512 * 1024 * 1024)),
+                                          compress=False)
+        return feature_cache if feature_cache else None
+
+
+def __siftFeatures(img, mask=None):
+    """
+    SIFT keypoint locations and descriptors of the image with the mask applied.
+    The features of an image opened from a file are kept in the feature cache, keyed by the
+    MD5 of the file, the arguments it was opened with, the detector and the mask.  Descriptors are stored as uint8 when that is exact.
+    :param img:
+    :param mask:
+    :return: keypoint locations (N x 2) and descriptors (float32), or None, None if there are no keypoints
+    @type img: ImageWrapper
+    """
+    cache = __featureCache()
+    key = None
+    if cache is not None and img.filename is not None and os.path.exists(img.filename):
+        from maskgen.disk_cache import make_key, file_md5
+        open_args = getattr(img, 'open_args', None)
+        key = make_key('SIFT',
+                       cv2.__version__,
+                       file_md5(img.filename),
+                       sorted(open_args.items()) if isinstance(open_args, dict) else open_args,
+                       img.mode,
+                       img.image_array.shape,
+                       str(img.image_array.dtype),
+                       np.asarray(mask) if mask is not None else None)
+        value = cache.get(key)
+        if value is not None:
+            return value[0], value[1].astype('float32') if value[1] is not None else None
+    kp, descriptors = cv2api.cv2api_delegate.computeSIFT(img.to_rgb().apply_mask(mask).to_array())
+    if kp is None or len(kp) == 0:
+        points, descriptors = None, None
+    else:
+        points = np.float32([keypoint.pt for keypoint in kp])
+    if key is not None:
+        stored = descriptors
+        if descriptors is not None and np.array_equal(descriptors, descriptors.astype('uint8')):
+            stored = descriptors.astype('uint8')
+        cache.put(key, (points, stored))
+    return points, descriptors
+
+
 def getMatchedSIFeatures(img1, img2, mask1=None, mask2=None, arguments=dict(), matcher=__flannMatcher):
-    img1 = img1.to_rgb().apply_mask(mask1).to_array()
-    img2 = img2.to_rgb().apply_mask(mask2).to_array()
     threshold = arguments['sift_match_threshold'] if 'sift_match_threshold' in arguments else 10
     maxmatches = int(arguments['homography max matches']) if 'homography max matches' in arguments else 10000
 
-    (kp1, d1) = cv2api.cv2api_delegate.computeSIFT(img1)
-    (kp2, d2) = cv2api.cv2api_delegate.computeSIFT(img2)
+    # extract the features of the images concurrently, in the compare pool unless already within it
+    if getattr(compare_strip_state, 'active', False):
+        (kp2, d2) = __siftFeatures(img2, mask2)
+        (kp1, d1) = __siftFeatures(img1, mask1)
+    else:
+        features2 = __comparePool().apply_async(__siftFeatures, args=(img2, mask2))
+        (kp1, d1) = __siftFeatures(img1, mask1)
+        (kp2, d2) = features2.get()
 
     if kp2 is None or len(kp2) == 0:
         return None
@@ -1501,8 +1688,8 @@ def getMatchedSIFeatures(img1, img2, mask1=None, mask2=None, arguments=dict(), m
     good = good[0:min(maxmatches, len(good))]
 
     if len(good) >= threshold:
-        src_pts = np.float32([kp1[m.queryIdx].pt for m in good]).reshape(-1, 1, 2)
-        dst_pts = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1, 1, 2)
+        src_pts = np.float32([kp1[m.queryIdx] for m in good]).reshape(-1, 1, 2)
+        dst_pts = np.float32([kp2[m.trainIdx] for m in good]).reshape(-1, 1, 2)
         return (src_pts, dst_pts) if src_pts is not None else None
     return None
 
@@ -2002,38 +2189,139 @@ def __search1(pixel, img2, tally, endx, endy, x, y):
     return None
 
 
-def __search(pixel, img2, tally, position, depth):
-    startx = min(max(0, position[0] - depth[0]), img2.shape[0])
-    starty = min(max(0, position[1] - depth[1]), img2.shape[1])
-    endx = min(position[0] + depth[0], img2.shape[0]) + 1
-    endy = min(position[1] + depth[1], img2.shape[1]) + 1
-    imgbox = img2[startx:endx, starty:endy]
-    image_positions = zip(*np.where(imgbox == pixel))
-    if len(image_positions) > 0:
-        tallybox = tally[startx:endx, starty:endy]
-        tallypostions = zip(*np.where(tallybox > 0))
-        if len(tallypostions) > 0:
-            maxtally = max(tallypostions)
-            image_positions = [p for p in image_positions if p > maxtally]
-    else:
-        return None
-    if len(image_positions) > 0:
-        best = min(image_positions)
-        return startx + best[0], starty + best[1]
-    return None
+def _tallySeamKernel(img1, img2, tally1, tally2, depth_x, depth_y):
+    """
+    For each pixel of img1, in raster order, find the first pixel of img2 with a matching value
+    (any channel) within the depth window around the same position that follows, in raster order,
+    the last pixel of img2 already tallied within that window.
+    The last tallied column at or before each position of each row of img2 is kept as pixels are
+    tallied, so finding the last tallied pixel of a window reads one position per window row.
+    Compiled with numba when available.
+    :param img1: (height, width, channels)
+    :param img2: (height, width, channels)
+    :param tally1: bool (height, width) of img1, set for each pixel matched
+    :param tally2: bool (height, width) of img2, set for each pixel matched
+    """
+    h1 = img1.shape[0]
+    w1 = img1.shape[1]
+    h2 = img2.shape[0]
+    w2 = img2.shape[1]
+    channels = img1.shape[2]
+    # last[x, y]: the last tallied column of row x of img2 at or before column y, -1 if none
+    last = np.empty((h2, w2), np.int64)
+    for x in range(h2):
+        previous = -1
+        for y in range(w2):
+            if tally2[x, y]:
+                previous = y
+            last[x, y] = previous
+    for x1 in range(h1):
+        startx = min(max(0, x1 - depth_x), h2)
+        endx = min(x1 + depth_x + 1, h2)
+        for y1 in range(w1):
+            starty = min(max(0, y1 - depth_y), w2)
+            endy = min(y1 + depth_y + 1, w2)
+            # last tallied position within the window
+            x = startx
+            y = starty
+            lastx = endx - 1
+            while lastx >= startx:
+                lasty = last[lastx, endy - 1]
+                if lasty >= starty:
+                    x = lastx
+                    y = lasty + 1
+                    break
+                lastx -= 1
+            # first match after it
+            found = False
+            while x < endx and not found:
+                while y < endy:
+                    for c in range(channels):
+                        if img1[x1, y1, c] == img2[x, y, c]:
+                            found = True
+                            break
+                    if found:
+                        tally1[x1, y1] = True
+                        tally2[x, y] = True
+                        last[x, y] = y
+                        following = y + 1
+                        while following < w2 and not tally2[x, following]:
+                            last[x, following] = y
+                            following += 1
+                        break
+                    y += 1
+                x += 1
+                y = starty
+
+
+def _tallySeamNumpy(img1, img2, tally1, tally2, depth_x, depth_y):
+    """
+    Same as _tallySeamKernel, limiting each comparison to the part of window
+    following the last tallied position.
+    Each match depends on the matches before it, so pixels are visited one at a time: slow on large
+    images and used only if numba (a dependency) cannot be imported.
+    """
+    h2 = img2.shape[0]
+    w2 = img2.shape[1]
+    columns = np.arange(w2)
+    last = np.maximum.accumulate(np.where(tally2, columns, -1), axis=1) if w2 > 0 else None
+    for x1 in range(img1.shape[0]):
+        startx = min(max(0, x1 - depth_x), h2)
+        endx = min(x1 + depth_x + 1, h2)
+        if startx >= endx:
+            continue
+        for y1 in range(img1.shape[1]):
+            starty = min(max(0, y1 - depth_y), w2)
+            endy = min(y1 + depth_y + 1, w2)
+            if starty >= endy:
+                continue
+            rows = np.flatnonzero(last[startx:endx, endy - 1] >= starty)
+            if len(rows) > 0:
+                firstx = startx + rows[-1]
+                skip = last[firstx, endy - 1] + 1 - starty
+            else:
+                firstx = startx
+                skip = 0
+            matches = np.any(img2[firstx:endx, starty:endy] == img1[x1, y1], axis=2).ravel()
+            positions = np.flatnonzero(matches[skip:])
+            if len(positions) > 0:
+                position = positions[0] + skip
+                x = firstx + position // (endy - starty)
+                y = starty + position % (endy - starty)
+                tally1[x1, y1] = True
+                tally2[x, y] = True
+                following = np.flatnonzero(tally2[x, y + 1:])
+                last[x, y:y + 1 + following[0] if len(following) > 0 else w2] = y
+
+
+try:
+    from numba import jit as _jit
+    _tallySeamSearch = _jit(nopython=True)(_tallySeamKernel)
+except ImportError:
+    logging.getLogger('maskgen').warning('numba is not installed: seam carving comparisons are slow')
+    _tallySeamSearch = _tallySeamNumpy
 
 
 def _tallySeam(img1, img2, minDepth=50):
-    tally1 = np.zeros(img1.shape)
-    tally2 = np.zeros(img2.shape)
+    """
+    Mark the pixels of img1 retained, in order, in img2 (e.g. after seam carving).
+    :param img1:
+    :param img2:
+    :param minDepth: minimum distance searched about each position
+    :return: mask of img1 matched pixels
+    @type img1: numpy.ndarray
+    @type img2: numpy.ndarray
+    @rtype: numpy.ndarray
+    """
+    tally1 = np.zeros(img1.shape[0:2], dtype=np.bool)
+    tally2 = np.zeros(img2.shape[0:2], dtype=np.bool)
     depth_x = max(img2.shape[0] - img1.shape[0], minDepth)
     depth_y = max(img2.shape[1] - img1.shape[1], minDepth)
-    for x1 in range(img1.shape[0]):
-        for y1 in range(img1.shape[1]):
-            pos = __search(img1[x1, y1], img2, tally2, (x1, y1), (depth_x, depth_y))
-            if pos is not None:
-                tally1[x1, y1] = 1
-                tally2[pos[0], pos[1]] = 1
+    search1 = np.ascontiguousarray(img1 if len(img1.shape) == 3 else img1[:, :, np.newaxis])
+    search2 = np.ascontiguousarray(img2 if len(img2.shape) == 3 else img2[:, :, np.newaxis])
+    _tallySeamSearch(search1, search2, tally1, tally2, depth_x, depth_y)
+    if len(img1.shape) == 3:
+        tally1 = np.repeat(tally1[:, :, np.newaxis], img1.shape[2], axis=2)
     return tally1.astype('uint8') * 255
 
 
@@ -2042,13 +2330,20 @@ def rotateCompare(img1, img2, arguments=dict()):
     local = (arguments['local'] == 'yes') if 'local' in arguments else False
     if img1.shape == img2.shape:
         mask1, analysis1 = __diffMask(img1, img2, False, args=arguments)
-        if abs(rotation) < 0.0001:
+        if abs(rotation) < 0.0001 or local:
             return mask1, analysis1
-        mask2, analysis2 = __compareRotatedImage(rotation, img1, img2, arguments)
+    # the rotation is provided in whole degrees; refining it within +/- 'rotation refinement'
+    # degrees is opt-in, costing up to 'rotation evaluations' comparisons at reduced resolution
+    spread = float(getValue(arguments, 'rotation refinement', 0.0)) if rotation % 90 != 0 else 0.0
+    refined = __searchRotation(img1, img2, [rotation], arguments=arguments, spread=spread)
+    mask2, analysis2 = __compareRotatedImage(refined, img1, img2, arguments)
+    if refined != rotation:
+        # the rotation given is kept; the mask is of the refined rotation
+        analysis2['refined rotation'] = refined
+    if img1.shape == img2.shape:
         diff = sumMask(mask1) - sumMask(mask2)
-        return (mask1, analysis1) if diff < 0 or local else (mask2, analysis2)
-    else:
-        return __compareRotatedImage(rotation, img1, img2, arguments)
+        return (mask1, analysis1) if diff < 0 else (mask2, analysis2)
+    return mask2, analysis2
 
 
 def resizeImage(img1, shape, interpolation):
@@ -2076,20 +2371,102 @@ def moving_average(a, n=3):
     ret[n:] = ret[n:] - ret[:-n]
     return ret[n - 1:] / n
 
+# elements of each strip of mapStrips, bounding the scratch memory of a compare
+diff_strip_elements = 1 << 22
+
+compare_pool = None
+compare_pool_lock = threading.Lock()
+compare_strip_state = threading.local()
+
+
+def __comparePool():
+    global compare_pool
+    with compare_pool_lock:
+        if compare_pool is None:
+            from multiprocessing import cpu_count
+            compare_pool = MaskgenThreadPool(int(MaskGenLoader().get_key('compare_threads', cpu_count())))
+        return compare_pool
+
+
+def mapStrips(function, shape, overlap=0):
+    """
+    Apply the function to strips of rows of an image in the compare thread pool
+    (preference compare_threads, defaulting to the number of processors).
+    Each strip holds about diff_strip_elements elements.
+    :param function: function(start, end, top, bottom) where start to end are the rows of the strip
+    extended by up to overlap rows on each side, and top to bottom are the rows of the strip itself
+    relative to start.  The strips of a function that writes to a shared array must write only
+    their own rows.
+    :param shape: shape of the image
+    :param overlap: rows on each side of a strip needed to compute the strip, such as the reach
+    of a morphology kernel
+    :return: the results of the function for each strip, in order
+    @rtype: list
+    """
+    row_elements = max(1, reduce(lambda x, y: x * y, shape[1:], 1))
+    rows = max(1, 2 * overlap, diff_strip_elements // row_elements)
+    strips = []
+    for first in range(0, shape[0], rows):
+        last = min(shape[0], first + rows)
+        start = max(0, first - overlap)
+        end = min(shape[0], last + overlap)
+        strips.append((start, end, first - start, last - start))
+
+    def runStrip(strip):
+        active = getattr(compare_strip_state, 'active', False)
+        compare_strip_state.active = True
+        try:
+            return function(*strip)
+        finally:
+            compare_strip_state.active = active
+
+    # strips of a strip run in place
+    if len(strips) == 1 or getattr(compare_strip_state, 'active', False):
+        return [runStrip(strip) for strip in strips]
+    pool = __comparePool()
+    return [result.get() for result in [pool.apply_async(runStrip, args=(strip,)) for strip in strips]]
+
+
 def morphologyCompare(img_one, img_two, **kwargs):
     kernel_size = getValue(kwargs, 'kernel', 3)
     kernel = np.ones((kernel_size, kernel_size), np.uint8)
-    diff = (np.abs(img_one - img_two)).astype('uint16')
-    mask = np.sum(diff, 2)
     difference = float(kwargs['tolerance']) if kwargs is not None and 'tolerance' in kwargs else 0.00390625
     difference = difference * 256
-    mask[np.where(mask < difference)] = 0  # set to black if less than threshold
-    mask[np.where(mask > 0)] = 255
-    mask = mask.astype('uint8')
-    mask = cv2.morphologyEx(mask,cv2.MORPH_OPEN, kernel)
-    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)# filter out noise in the mask
+    mask = np.zeros(img_one.shape[0:2], dtype='uint8')
+
+    def compareStrip(start, end, top, bottom):
+        diff = (np.abs(img_one[start:end] - img_two[start:end])).astype('uint16')
+        strip = np.sum(diff, 2)
+        strip[np.where(strip < difference)] = 0  # set to black if less than threshold
+        strip[np.where(strip > 0)] = 255
+        strip = strip.astype('uint8')
+        strip = cv2.morphologyEx(strip, cv2.MORPH_OPEN, kernel)
+        strip = cv2.morphologyEx(strip, cv2.MORPH_CLOSE, kernel)  # filter out noise in the mask
+        mask[start + top:start + bottom] = strip[top:bottom]
+
+    # open and close each erode and dilate
+    mapStrips(compareStrip, img_one.shape, overlap=2 * kernel_size)
     return mask, {}
 
+def morphologyCompareFrames(frames_one, frames_two, **kwargs):
+    """
+    morphologyCompare of each pair of frames of two blocks of frames (N x H x W x C)
+    :return: masks (N x H x W)
+    @rtype: numpy.ndarray
+    """
+    kernel_size = getValue(kwargs, 'kernel', 3)
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+    difference = float(kwargs['tolerance']) if kwargs is not None and 'tolerance' in kwargs else 0.00390625
+    difference = difference * 256
+    diff = (np.abs(frames_one - frames_two)).astype('uint16')
+    masks = np.sum(diff, 3)
+    masks[masks < difference] = 0  # set to black if less than threshold
+    masks[masks > 0] = 255
+    masks = masks.astype('uint8')
+    for i in range(masks.shape[0]):
+        masks[i] = cv2.morphologyEx(cv2.morphologyEx(masks[i], cv2.MORPH_OPEN, kernel), cv2.MORPH_CLOSE, kernel)
+    return masks, {}
+
 def mediatedCompare(img_one, img_two, **kwargs):
     kernel_size=getValue(kwargs,'kernel',3)
     smoothing = getValue(kwargs, 'smoothing', 3)
@@ -2097,15 +2474,28 @@ def mediatedCompare(img_one, img_two, **kwargs):
     aggregate = getValue(kwargs, 'aggregate', 'sum')
     kernel = np.ones((kernel_size, kernel_size), np.uint8)
     from scipy import signal
-    # compute diff in 3 colors
-    diff = (np.abs(img_one - img_two)).astype('uint16')
     if aggregate == 'max':
-        mask = np.max(diff, 2)  # use the biggest difference of the 3 colors
+        aggregateFunction = np.max  # use the biggest difference of the 3 colors
         bins=256
     else:
-        mask = np.sum(diff, 2)
+        aggregateFunction = np.sum
         bins=768
-    hist, bin_edges = np.histogram(mask, bins=bins, density=False)
+    # compute diff in 3 colors
+    differences = np.empty(img_one.shape[0:2],
+                           dtype=aggregateFunction(np.zeros((1, 1, 1), dtype='uint16'), 2).dtype)
+
+    def differenceStrip(start, end, top, bottom):
+        diff = (np.abs(img_one[start:end] - img_two[start:end])).astype('uint16')
+        differences[start:end] = aggregateFunction(diff, 2)
+
+    mapStrips(differenceStrip, img_one.shape)
+    # the edges of the histogram of the whole image
+    histogram_range = (differences.min(), differences.max())
+
+    def histogramStrip(start, end, top, bottom):
+        return np.histogram(differences[start:end], bins=bins, range=histogram_range, density=False)[0]
+
+    hist = np.sum(mapStrips(histogramStrip, differences.shape), axis=0)
     hist = moving_average(hist,n=smoothing)  # smooth out the histogram
     minima = signal.argrelmin(hist, order=2)  # find local minima
     if minima[0].size == 0 or minima[0][0] > bins/2:  # if there was no minima, hardcode
@@ -2113,19 +2503,26 @@ def mediatedCompare(img_one, img_two, **kwargs):
     else:
         threshold = minima[0][0]  # Use first minima
 
-    mask[np.where(mask < threshold)] = 0  # set to black if less than threshold
-    mask[np.where(mask > 0)] = 255
-    mask = mask.astype('uint8')
-    if algorithm == 'morphology':
-        mask = cv2.morphologyEx(mask,cv2.MORPH_OPEN,kernel)
-        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-    else:
-        mask = cv2.medianBlur(mask, kernel_size)  # filter out noise in the mask
+    mask = np.zeros(differences.shape, dtype='uint8')
+
+    def maskStrip(start, end, top, bottom):
+        strip = np.copy(differences[start:end])
+        strip[np.where(strip < threshold)] = 0  # set to black if less than threshold
+        strip[np.where(strip > 0)] = 255
+        strip = strip.astype('uint8')
+        if algorithm == 'morphology':
+            strip = cv2.morphologyEx(strip, cv2.MORPH_OPEN, kernel)
+            strip = cv2.morphologyEx(strip, cv2.MORPH_CLOSE, kernel)
+        else:
+            strip = cv2.medianBlur(strip, kernel_size)  # filter out noise in the mask
+        mask[start + top:start + bottom] = strip[top:bottom]
+
+    mapStrips(maskStrip, differences.shape, overlap=2 * kernel_size)
     return mask, {'minima': threshold}
 
 def convertCompare(img1, img2, arguments=dict()):
     if 'Image Rotated' in arguments and arguments['Image Rotated'] == 'yes':
-        rotation, mask = __findRotation(img1, img2, [0, 90, 180, 270])
+        rotation, mask = __findRotation(img1, img2, [0, 90, 180, 270], arguments=arguments)
         return 255 - mask, {'rotation': rotation}
     if img1.shape != img2.shape:
         new_img2 = cv2.resize(img2, (img1.shape[1], img1.shape[0]))
@@ -2287,18 +2684,117 @@ def __compareRotatedImage(rotation, img1, img2, arguments):
     return res, analysis
 
 
-def __findRotation(img1, img2, range):
-    best = 0
-    r = None
-    best_mask = None
-    for rotation in range:
-        res, analysis = __compareRotatedImage(rotation, img1, img2, {})
-        c = np.sum(res)
-        if c > best or best_mask is None:
-            best = c
-            best_mask = res
-            r = rotation
-    return r, best_mask
+def __rotationPyramids(img1, img2, minSize=64):
+    """
+    Gaussian pyramids of both images with the same number of levels, from full resolution
+    down to a level whose smallest dimension is at least minSize.
+    """
+    levels1 = [img1.astype('float32')]
+    levels2 = [img2.astype('float32')]
+    while min(levels1[-1].shape[0:2] + levels2[-1].shape[0:2]) >= 2 * minSize:
+        levels1.append(cv2.pyrDown(levels1[-1]))
+        levels2.append(cv2.pyrDown(levels2[-1]))
+    return levels1, levels2
+
+
+def __rotationDifference(rotation, img1, img2):
+    """
+    :return: mean absolute difference of img1 rotated to img2
+    """
+    if rotation != 0 or img1.shape != img2.shape:
+        res = __rotateImage(rotation, img1, expectedDims=img2.shape[0:2], cval=0)
+        res = res.reshape(img2.shape)
+    else:
+        res = img1
+    return np.mean(np.abs(res - img2))
+
+
+def __goldenSection(score, low, high, evaluations):
+    """
+    Minimize score over [low, high] with at most evaluations calls.
+    :return: (argument, score) of the best evaluated argument or None if no evaluations are permitted
+    """
+    if evaluations < 2:
+        return None
+    ratio = (math.sqrt(5) - 1) / 2
+    c = high - ratio * (high - low)
+    d = low + ratio * (high - low)
+    fc = score(c)
+    fd = score(d)
+    evaluations -= 2
+    while evaluations > 0:
+        if fc < fd:
+            high, d, fd = d, c, fc
+            c = high - ratio * (high - low)
+            fc = score(c)
+        else:
+            low, c, fc = c, d, fd
+            d = low + ratio * (high - low)
+            fd = score(d)
+        evaluations -= 1
+    return (c, fc) if fc < fd else (d, fd)
+
+
+def __searchRotation(img1, img2, candidates, arguments=dict(), spread=0.0):
+    """
+    Coarse to fine search for the rotation of img1 that best aligns with img2.
+    Candidates are scored at the coarsest pyramid level; the better half are rescored at each
+    finer level, short of full resolution, until one remains.
+    If spread is set, the angle is then refined within +/- spread degrees by golden-section search
+    at the finest reduced level.
+    The number of scored comparisons is bounded by the 'rotation evaluations' argument;
+    each candidate is scored at least once.
+    :param img1:
+    :param img2:
+    :param candidates: rotations in degrees
+    :param arguments:
+    :param spread: degrees
+    :return: rotation in degrees
+    @type candidates: list of float
+    @rtype: float
+    """
+    evaluations = int(getValue(arguments, 'rotation evaluations', 12))
+    if len(candidates) == 1 and (spread <= 0 or evaluations < 2):
+        return candidates[0]
+    levels1, levels2 = __rotationPyramids(img1, img2)
+    level = len(levels1) - 1
+    finest = min(1, level)
+    if len(candidates) > 1:
+        scores = [(__rotationDifference(rotation, levels1[level], levels2[level]), rotation)
+                  for rotation in candidates]
+        evaluations -= len(scores)
+        while level > finest and len(scores) > 1 and evaluations > 0:
+            level -= 1
+            scores = sorted(scores)[0:min(max(1, len(scores) / 2), evaluations)]
+            scores = [(__rotationDifference(rotation, levels1[level], levels2[level]), rotation)
+                      for score, rotation in scores]
+            evaluations -= len(scores)
+        best_score, best = min(scores)
+    else:
+        best = candidates[0]
+        level = None
+    if spread > 0:
+        if level != finest:
+            best_score = __rotationDifference(best, levels1[finest], levels2[finest])
+            evaluations -= 1
+        refined = __goldenSection(lambda rotation: __rotationDifference(rotation, levels1[finest], levels2[finest]),
+                                  best - spread,
+                                  best + spread,
+                                  evaluations)
+        if refined is not None and refined[1] < best_score:
+            best = refined[0]
+    return best
+
+
+def __findRotation(img1, img2, range, arguments=dict()):
+    """
+    Search the rotations of img1 at reduced resolution, comparing at full resolution only
+    at the chosen rotation.
+    :return: rotation and mask of the chosen rotation
+    """
+    rotation = __searchRotation(img1, img2, range, arguments=arguments)
+    mask, analysis = __compareRotatedImage(rotation, img1, img2, {})
+    return rotation, mask
 
 
 #      res = __resize(mask,(max(img2.shape[0],img1.shape[0]), max(img2.shape[1],img1.shape[1])))
@@ -2332,6 +2828,18 @@ def extractAlpha(rawimg1, rawimg2):
 def convert16bitcolor(rawimg1, rawimg2):
     return rawimg1.to_array().astype('int16'), rawimg2.to_array().astype('int16')
 
+
+def convert16bitcolorFrames(frames_one, frames_two):
+    """
+    convert16bitcolor of blocks of frames (N x H x W x C)
+    """
+    return frames_one.astype('int16'), frames_two.astype('int16')
+
+# forms of compare and convert functions over blocks of video frames; see video_tools.FrameBlockCompare
+frame_block_functions = {morphologyCompare: morphologyCompareFrames,
+                         convert16bitcolor: convert16bitcolorFrames}
+
+
 def __alignChannels(rawimg1, rawimg2, convertFunction=None):
     """
 
@@ -2421,7 +2929,6 @@ def composeCloneMask(changemask, startimage, finalimage):
     """
     mask = np.asarray(changemask.invert())
     start_image_array = np.array(startimage)
-    final_image_array = np.array(finalimage)
     newmask = np.zeros(start_image_array.shape).astype('uint8')
     contours, hierarchy = cv2api.findContours(np.copy(mask), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     for i in range(0, len(contours)):
@@ -2430,7 +2937,8 @@ def composeCloneMask(changemask, startimage, finalimage):
             x, y, w, h = cv2.boundingRect(cnt)
             if w <= 2 or h <= 2:
                 continue
-            final_image_subarray = final_image_array[y:y + h, x:x + w]
+            # only the regions of the final image are read (e.g. from a memory mapped image)
+            final_image_subarray = finalimage.crop((x, y, x + w, y + h)).image_array
             for i in range(final_image_subarray.shape[2]):
                 final_image_subarray[:, :, i] = final_image_subarray[:, :, i] * (mask[y:y + h, x:x + w] / 255)
             matched_tuple = __findBestMatch(start_image_array, final_image_subarray)
@@ -2468,7 +2976,13 @@ def __colorPSNR(z1, z2, size=None):
     d = (z1 - z2) ** 2
     sse = np.sum(d)
     size = float(reduce(lambda x, y: x * y, d.shape)) if size is None else float(size)
-    mse = float(sse) / size
+    return __psnrFromSSE(sse, size)
+
+
+def __psnrFromSSE(sse, size):
+    if size == 0:
+        return 0.0
+    mse = float(sse) / float(size)
     return 0.0 if mse == 0.0 else 20.0 * math.log10(255.0 / math.sqrt(mse))
 
 
@@ -2697,14 +3211,40 @@ def img_analytics(z1, z2, mask=None):
 
 
 def __diffMask(img1, img2, invert, args=None):
+    """
+    Mask of the pixels that differ by more than the tolerance, computed over strips of rows
+    (see mapStrips).
+    The PSNR and local PSNR are those of img_analytics given the mask.
+    :param img1:
+    :param img2:
+    :param invert: if True, differing pixels are white
+    :param args: tolerance as a fraction of the range of the image type
+    :return: mask, analysis
+    @type img1: numpy.ndarray
+    @type img2: numpy.ndarray
+    """
     itype = np.iinfo(img1.dtype)
-    dst = np.abs(np.subtract(img1.astype('int32'), img2.astype('int32')))
-    gray_image = np.zeros(img1.shape).astype('uint8')
     difference = float(args['tolerance']) if args is not None and 'tolerance' in args else 0.0001
     difference = difference * (itype.max - itype.min)
-    gray_image[dst > difference] = 255
-    analysis = img_analytics(img1, img2, mask=gray_image)
-    return (gray_image if invert else (255 - gray_image)), analysis
+    gray_image = np.zeros(img1.shape, dtype='uint8')
+
+    def diffStrip(start, end, top, bottom):
+        z1 = img1[start:end]
+        z2 = img2[start:end]
+        changed = np.abs(np.subtract(z1.astype('int32'), z2.astype('int32'))) > difference
+        gray_image[start:end][changed] = 255
+        # the same (wrapping) arithmetic as __colorPSNR
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            d = (z1 - z2) ** 2
+        return int(np.sum(d)), int(np.sum(d[changed])), int(np.count_nonzero(changed))
+
+    sums = mapStrips(diffStrip, img1.shape)
+    analysis = {'psnr': __psnrFromSSE(sum([strip[0] for strip in sums]), gray_image.size),
+                'local psnr': __psnrFromSSE(sum([strip[1] for strip in sums]), sum([strip[2] for strip in sums]))}
+    if not invert:
+        np.subtract(255, gray_image, out=gray_image)
+    return gray_image, analysis
 
 def coordsFromString(value):
     import re
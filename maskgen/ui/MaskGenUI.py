@@ -166,6 +166,7 @@ class MakeGenUI(Frame):
         newProject = createProject(dir, base=file_path, suffixes=self.getMergedSuffixes(), tool='jtui',
                                      organization=self.prefLoader.get_key('organization'), username=self.get_username())
         if newProject is not None:
+            self.scModel.cancelPrefetch()
             self.scModel.__wrapped__ = newProject[0]
         self.scModel.__wrapped__.set_notifier(self.changeEvent)
         self.updateFileTypePrefs()
@@ -186,6 +187,7 @@ class MakeGenUI(Frame):
         self.canvas.reformat()
 
     def _open_project(self, path):
+        self.scModel.cancelPrefetch()
         self.scModel.__wrapped__ = loadProject(path, username=self.get_username(), tool='jtui')
         self.scModel.set_notifier(self.changeEvent)
         if self.scModel.getProjectData('typespref') is None:
@@ -470,6 +472,16 @@ class MakeGenUI(Frame):
         skipped_threads = d.choice if d.choice is not None else skipped_threads
         self.prefLoader.save('skipped_threads',int(skipped_threads))
 
+    def setProbeProcesses(self):
+        probe_processes = self.prefLoader.get_key('probe_processes',0)
+        d = SelectDialog(self,
+                         "Probe Processes",
+                         "Processes used to generate probes (0 uses Skip Link Threads)",
+                         [0, 2, 4, 8, 16],
+                         initial_value=probe_processes)
+        probe_processes = d.choice if d.choice is not None else probe_processes
+        self.prefLoader.save('probe_processes',int(probe_processes))
+
     def undo(self):
         self.scModel.undo()
         self.drawState()
@@ -670,11 +682,14 @@ class MakeGenUI(Frame):
 
         start_cache_name = self.scModel.start if self.scModel.start else '#empty@'
         sim,sim_time = self.image_cache[start_cache_name] if start_cache_name in self.image_cache else \
-            (fixTransparency(imageResizeRelative(self.scModel.startImage(), (250, 250), None)).toPIL(),0)
+            (fixTransparency(imageResizeRelative(self.scModel.getThumbnail(self.scModel.start, (250, 250)),
+                                                 (250, 250), None)).toPIL(),0)
 
         end_cache_name = start_cache_name + '#end' if self.scModel.end is None else self.scModel.end
         nim,nim_time = self.image_cache[end_cache_name] if end_cache_name in self.image_cache else \
-            (fixTransparency(imageResizeRelative(self.scModel.nextImage(), (250, 250), None)).toPIL(),0)
+            (fixTransparency(imageResizeRelative(self.scModel.getThumbnail(self.scModel.end, (250, 250))
+                                                 if self.scModel.end is not None else self.scModel.nextImage(),
+                                                 (250, 250), None)).toPIL(),0)
 
         mask_cache_name = start_cache_name+ '#mask' if self.scModel.end is None else start_cache_name + self.scModel.end
         mim_time = self.scModel.maskImageFileTime()
@@ -1046,6 +1061,7 @@ class MakeGenUI(Frame):
         settingsmenu.add_command(label="File Types", command=self.setPreferredFileTypes)
         settingsmenu.add_command(label="Skip Link Compare", command=self.setSkipStatus)
         settingsmenu.add_command(label="Skip Link Threads", command=self.setSkipThreads)
+        settingsmenu.add_command(label="Probe Processes", command=self.setProbeProcesses)
         settingsmenu.add_command(label="Autosave", command=self.setautosave)
         for k,v in self.notifiers.get_properties().iteritems():
             settingsmenu.add_command(label=v, command=partial(self.setproperty,k,v))
@@ -385,6 +385,7 @@ def repairMask(graph,start,end):
     inputmaskname = os.path.splitext(name)[0] + '_inputmask.png'
     ImageWrapper(composeCloneMask(mask, startimage, finalimage)).save(inputmaskname)
     edge['inputmaskname'] = os.path.split(inputmaskname)[1]
+    graph.mark_edge_dirty(start, end)
     graph.setDataItem('autopastecloneinputmask', 'yes')
 
 
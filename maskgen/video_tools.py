@@ -6,11 +6,14 @@
 # All rights reserved.
 # ==============================================================================
 
+import copy
 import logging
 import os
 import time
 from subprocess import Popen, PIPE
-from threading import RLock
+from threading import RLock, Thread, Event
+from Queue import Queue, Full
+from collections import deque
 
 import cv2
 import ffmpeg_api
@@ -19,7 +22,7 @@ import tool_set
 from cachetools import LRUCache
 from cachetools import cached
 from cachetools.keys import hashkey
-from cv2api import cv2api_delegate
+from cv2api import cv2api_delegate, CAPReader, CAPReaderWithFFMPEG
 from image_wrap import ImageWrapper
 from maskgen import exif
 from maskgen_loader import  MaskGenLoader
@@ -1342,6 +1345,255 @@ class VidAnalysisComponents:
         res, self.frame_two = self.vid_two.retrieve()
         return res,self.frame_two
 
+class FramePump:
+    """
+    Decodes a video in a background thread into a bounded queue of (position, retrieved frame),
+    ahead of the reader.  Presents the capture interface used by the frame analyses
+    (grab, retrieve, read, get, isOpened, release); the position (prop_pos_msec) is the one read
+    when the frame was grabbed, so readers see the same frames and times as reading the capture directly.
+    prop_pos_frames is the number of frames grabbed by the reader.  The frame rate, count and dimensions
+    are read from the capture before decoding starts; other properties cannot be read while the capture
+    is decoding and raise ValueError.
+    """
+
+    def __init__(self, capture, depth=4):
+        """
+        :param capture: see buildCaptureTool
+        :param depth: decoded frames held ahead of the reader
+        """
+        self.capture = capture
+        self.properties = dict([(prop, capture.get(prop)) for prop in [cv2api_delegate.prop_fps,
+                                                                       cv2api_delegate.prop_frame_count,
+                                                                       cv2api_delegate.prop_frame_height,
+                                                                       cv2api_delegate.prop_frame_width]])
+        self.opened = capture.isOpened()
+        self.ended = False
+        self.position = 0
+        self.retrieved = (False, None)
+        # frames grabbed
+        self.count = 0
+        # frames taken from the queue by peek
+        self.ahead = deque()
+        self.frames = Queue(maxsize=max(1, depth))
+        self.stopped = Event()
+        self.thread = Thread(target=self._decode, name='FramePump')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def _decode(self):
+        try:
+            while not self.stopped.is_set() and self.capture.grab():
+                position = self.capture.get(cv2api_delegate.prop_pos_msec)
+                self._put((position, self.capture.retrieve()))
+        except Exception as e:
+            logging.getLogger('maskgen').error('Failed to decode video: ' + str(e))
+        finally:
+            self._put(None)
+
+    def _next(self):
+        return self.ahead.popleft() if len(self.ahead) > 0 else self.frames.get()
+
+    def grab(self):
+        if not self.opened or self.ended:
+            return False
+        item = self._next()
+        if item is None:
+            self.ended = True
+            return False
+        self.position, self.retrieved = item
+        self.count += 1
+        return True
+
+    def peek(self, count):
+        """
+        :param count:
+        :return: up to count (position, retrieved frame) following the current frame, without grabbing them
+        @rtype: list
+        """
+        while self.opened and len(self.ahead) < count and (len(self.ahead) == 0 or self.ahead[-1] is not None):
+            self.ahead.append(self.frames.get())
+        return [item for item in list(self.ahead)[0:count] if item is not None]
+
+    def retrieve(self, channel=None):
+        return self.retrieved
+
+    def read(self):
+        return self.retrieve() if self.grab() else (False, None)
+
+    def get(self, prop):
+        if prop == cv2api_delegate.prop_pos_msec:
+            return self.position
+        if prop == cv2api_delegate.prop_pos_frames:
+            return float(self.count)
+        if prop in self.properties:
+            return self.properties[prop]
+        raise ValueError('Video property {} is not available while decoding ahead'.format(prop))
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        self.opened = False
+        self.stopped.set()
+        self.thread.join()
+        self.capture.release()
+
+
+def pumpFrames(capture):
+    """
+    :param capture: see buildCaptureTool
+    :return: a FramePump of the capture, or the capture if preference 'video_decode_queue' is 0
+    """
+    depth = int(MaskGenLoader().get_key('video_decode_queue', 4))
+    return FramePump(capture, depth=depth) if depth > 0 else capture
+
+
+class FrameBlockCompare:
+    """
+    The masks of tool_set.createMask for pairs of frames of the same shape, computed with the block
+    forms of the compare and convert functions (tool_set.frame_block_functions).
+    The masks of the current frames of two FramePumps are computed together with those of the
+    frames decoded ahead (up to preference 'video_compare_block' frames) and kept until the frames
+    are grabbed.  Once a full block is computed, the block that follows it is compared in a worker
+    thread while the masks of the current block are analysed; its frames are held ahead of the reader.
+    """
+
+    def __init__(self, compare_function, convert_function, arguments={}):
+        self.compare = tool_set.frame_block_functions.get(compare_function)
+        self.convert = tool_set.frame_block_functions.get(convert_function)
+        # as passed to the compare function by createMask
+        self.arguments = dict(arguments)
+        self.arguments['source filename'] = None
+        self.arguments['target filename'] = None
+        self.size = int(MaskGenLoader().get_key('video_compare_block', 8))
+        self.masks = {}
+        # (frame counts of the first frames, result) of the block compared in the worker
+        self.pending = None
+        self.pool = None
+
+    def usable(self):
+        return self.compare is not None and self.convert is not None
+
+    def compareFrames(self, frames_one, frames_two):
+        """
+        :param frames_one: N x H x W x C
+        :param frames_two: N x H x W x C
+        :return: the masks (N x H x W) or None if the compare function rejects the frames
+        @rtype: numpy.ndarray
+        """
+        try:
+            return self.compare(*self.convert(frames_one, frames_two), arguments=self.arguments)[0]
+        except ValueError:
+            return None
+
+    def comparePair(self, frame_one, frame_two):
+        """
+        :return: the mask or None if not computed in block form
+        @rtype: numpy.ndarray
+        """
+        if not self.usable() or frame_one is None or frame_two is None or frame_one.shape != frame_two.shape:
+            return None
+        masks = self.compareFrames(frame_one[np.newaxis], frame_two[np.newaxis])
+        return masks[0] if masks is not None else None
+
+    def _compareBlock(self, block_one, block_two):
+        return self.compareFrames(np.stack(block_one), np.stack(block_two))
+
+    def _aheadFrames(self, vid_one, vid_two, shape, start, count):
+        """
+        :param start: offset of the first frame following the current frame (1 is the next frame)
+        :param count: frames
+        :return: the frames decoded ahead of each video, up to a frame of another shape
+        """
+        block_one = []
+        block_two = []
+        if not isinstance(vid_one, FramePump) or not isinstance(vid_two, FramePump):
+            return block_one, block_two
+        items = zip(vid_one.peek(start + count - 1), vid_two.peek(start + count - 1))[start - 1:]
+        for item_one, item_two in items:
+            ahead_one = item_one[1][1]
+            ahead_two = item_two[1][1]
+            if ahead_one is None or ahead_two is None or ahead_one.shape != shape or ahead_two.shape != shape:
+                break
+            block_one.append(ahead_one)
+            block_two.append(ahead_two)
+        return block_one, block_two
+
+    def _submit(self, vid_one, vid_two, key, shape):
+        """
+        Compare the block following the full block starting at key in the worker thread.
+        """
+        block_one, block_two = self._aheadFrames(vid_one, vid_two, shape, self.size, self.size)
+        if len(block_one) == 0:
+            return
+        if self.pool is None:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(1)
+        self.pending = ((key[0] + self.size, key[1] + self.size),
+                        self.pool.apply_async(self._compareBlock, args=(block_one, block_two)))
+
+    def _received(self, key):
+        """
+        :return: the masks of the block starting at key compared in the worker thread, or None
+        """
+        pending = self.pending
+        self.pending = None
+        if pending is None or pending[0] != key:
+            return None
+        return pending[1].get()
+
+    def mask(self, vid_one, vid_two, frame_one, frame_two):
+        """
+        :param vid_one: FramePump
+        :param vid_two: FramePump
+        :param frame_one: current frame of vid_one
+        :param frame_two: current frame of vid_two
+        :return: the mask of the current frames or None if not computed in block form
+        @rtype: numpy.ndarray
+        """
+        key = (vid_one.count, vid_two.count)
+        if key in self.masks:
+            return self.masks.pop(key)
+        self.masks.clear()
+        if not self.usable() or frame_one is None or frame_two is None or frame_one.shape != frame_two.shape:
+            self.pending = None
+            return None
+        masks = self._received(key)
+        if masks is None:
+            block_one = [frame_one]
+            block_two = [frame_two]
+            if self.size > 1:
+                ahead_one, ahead_two = self._aheadFrames(vid_one, vid_two, frame_one.shape, 1, self.size - 1)
+                block_one.extend(ahead_one)
+                block_two.extend(ahead_two)
+            masks = self._compareBlock(block_one, block_two)
+            if masks is None:
+                return None
+        for i in range(1, masks.shape[0]):
+            self.masks[(key[0] + i, key[1] + i)] = masks[i]
+        if self.size > 1 and masks.shape[0] == self.size:
+            self._submit(vid_one, vid_two, key, frame_one.shape)
+        return masks[0]
+
+    def close(self):
+        """
+        Wait for the worker thread
+        """
+        self.pending = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
 def default_compare(x,y,args):
     return np.abs(x - y)
 
@@ -1472,8 +1724,12 @@ def cropCompare(fileOne, fileTwo, name_prefix, time_manager, arguments=None,anal
     """
     entireVideoMaskSet = getMaskSetForEntireVideo(FileMetaDataLocator(fileOne))
     analysis_components = VidAnalysisComponents()
-    analysis_components.vid_one = cv2api_delegate.videoCapture(fileOne)
-    analysis_components.vid_two = cv2api_delegate.videoCapture(fileTwo)
+    analysis_components.vid_one, passed, analysis_components.elapsed_time_one = \
+        openAtStart(lambda: cv2api_delegate.videoCapture(fileOne), time_manager)
+    analysis_components.vid_two, analysis_components.elapsed_time_two = \
+        passFrames(lambda: cv2api_delegate.videoCapture(fileTwo), passed)
+    analysis_components.one_count = passed
+    analysis_components.two_count = passed
     analysis_components.fps = analysis_components.vid_one.get(cv2api_delegate.prop_fps)
     analysis_components.frame_one_mask = \
         np.zeros((int(analysis_components.vid_one.get(cv2api_delegate.prop_frame_height)),
@@ -1670,6 +1926,8 @@ def fixVideoMasks(graph, source, edge, media_types=['video'], channel=0):
             drop_mask_from_segment(item)
         edge['masks count'] = len(video_masks)
         edge['videomasks'] = video_masks
+        # the edge is not identified, so all edges out of the source are marked changed
+        graph.mark_node_dirty(source)
 
 
 def formMaskDiffForImage(vidFile,
@@ -2138,6 +2396,88 @@ def buildCaptureTool(vidFile):
     else:
         return cv2api_delegate.videoCapture(vidFile)
 
+def __canSeek(capture):
+    # frame times are computed from the rate: only constant rate videos read by OpenCV
+    return isinstance(capture, CAPReader) and not isinstance(capture, CAPReaderWithFFMPEG)
+
+
+def __seekToFrame(capture, frame):
+    """
+    Seek (to the preceding key frame, decoding forward) and grab the frame.
+    :param frame: frame number, starting at 1
+    :return: True if the frame is grabbed and is the requested frame
+    """
+    try:
+        if not capture.set(cv2api_delegate.prop_pos_frames, frame - 1) or not capture.grab():
+            return False
+        return int(round(capture.get(cv2api_delegate.prop_pos_frames))) == frame
+    except Exception as e:
+        logging.getLogger('maskgen').debug('Cannot seek: ' + str(e))
+        return False
+
+
+def openAtStart(open_capture, time_manager):
+    """
+    Open a video for a scan bounded by the time manager.  The frames before the start of the range
+    are passed by seeking rather than decoding each frame, if the video is of constant rate and
+    more than preference 'video_seek_frames' frames (default 120) would be passed.
+    The first frame is decoded for its time; the times of the passed frames follow from the rate.
+    The last passed frame is grabbed and its frame number and time checked; otherwise (or if the video
+    cannot seek) the video is reopened, to be read from the beginning.
+    The time manager is updated for the passed frames.
+    :param open_capture: function returning a new capture of the video (see buildCaptureTool)
+    :param time_manager:
+    :return: the capture, the number of frames passed and the time of the last frame passed
+    @type time_manager: tool_set.VidTimeManager
+    """
+    capture = open_capture()
+    if time_manager.isAtBeginning() or time_manager.frameSinceBeginning > 0 or not __canSeek(capture):
+        return capture, 0, 0
+    rate = capture.get(cv2api_delegate.prop_fps)
+    frame_count = int(capture.get(cv2api_delegate.prop_frame_count))
+    minimum = int(MaskGenLoader().get_key('video_seek_frames', 120))
+    # the first frame must be passed whether its time is zero or one frame
+    if rate <= 0 or min([time_manager.framesBeforeStart(rate, first_time, frame_count)
+                         for first_time in [-1000.0 / rate, 0.0]]) <= minimum:
+        return capture, 0, 0
+    checked = copy.copy(time_manager)
+    if capture.grab():
+        first_time = capture.get(cv2api_delegate.prop_pos_msec)
+        checked.updateToNow(first_time)
+        frames = checked.framesBeforeStart(rate, first_time, frame_count - 1)
+        if checked.isBeforeTime() and frames > minimum and __seekToFrame(capture, frames + 1):
+            last_time = capture.get(cv2api_delegate.prop_pos_msec)
+            if abs(last_time - (first_time + frames * 1000.0 / rate)) < 250.0 / rate:
+                time_manager.updateToNow(first_time)
+                time_manager.skipFrames(rate, first_time, frames, last_time)
+                return capture, frames + 1, last_time
+    logging.getLogger('maskgen').debug('Seek failed; reading from the beginning')
+    capture.release()
+    return open_capture(), 0, 0
+
+
+def passFrames(open_capture, frames):
+    """
+    Open a video and pass the given number of frames, seeking if possible (see openAtStart).
+    :param open_capture: function returning a new capture of the video
+    :param frames: number of frames to pass
+    :return: the capture and the time of the last frame passed
+    """
+    capture = open_capture()
+    if frames == 0:
+        return capture, 0
+    if __canSeek(capture) and __seekToFrame(capture, frames):
+        return capture, capture.get(cv2api_delegate.prop_pos_msec)
+    capture.release()
+    capture = open_capture()
+    last_time = 0
+    for frame in range(frames):
+        if not capture.grab():
+            break
+        last_time = capture.get(cv2api_delegate.prop_pos_msec)
+    return capture, last_time
+
+
 def __runImageDiff(vidFile, img_wrapper, name_prefix, time_manager, arguments={}):
     """
       compare frame to frame of each video
@@ -2149,10 +2489,14 @@ def __runImageDiff(vidFile, img_wrapper, name_prefix, time_manager, arguments={}
      @type time_manager: VidTimeManager
      @type img_wrapper: ImageWrapper
      """
-    vid_cap = buildCaptureTool(vidFile)
+    vid_cap, passed, elapsed_time = openAtStart(lambda: buildCaptureTool(vidFile), time_manager)
     fps = vid_cap.get(cv2api_delegate.prop_fps)
     writer = tool_set.GrayBlockWriter(name_prefix, fps)
     segment = create_segment(rate= fps, type='video', startframe=1, starttime=0, frames=0)
+    if passed > 0:
+        update_segment(segment,
+                       startframe=time_manager.frameSinceBeginning,
+                       starttime=elapsed_time - fps)
     exifdiff = None
     compare_args = {'tolerance': getValue(arguments, 'tolerance', 0.0001)}
     compare_args.update(arguments)
@@ -2208,9 +2552,14 @@ def __runDiff(fileOne, fileTwo, name_prefix, time_manager, opFunc,
      :return:
      @type time_manager: VidTimeManager
      """
+    block_compare = FrameBlockCompare(compare_function, convert_function, arguments if arguments is not None else {})
+
     def compare_func(x,
                      y,
                      arguments=None):
+        mask = block_compare.comparePair(x, y)
+        if mask is not None:
+            return mask
         return tool_set.createMask(ImageWrapper(x),
                                    ImageWrapper(y),
                                    False,
@@ -2221,8 +2570,14 @@ def __runDiff(fileOne, fileTwo, name_prefix, time_manager, opFunc,
     analysis_components = VidAnalysisComponents()
     analysis_components.file_one = fileOne
     analysis_components.file_two = fileTwo
-    analysis_components.vid_one = buildCaptureTool(fileOne)
-    analysis_components.vid_two = buildCaptureTool(fileTwo)
+    vid_one, passed, analysis_components.elapsed_time_one = openAtStart(lambda: buildCaptureTool(fileOne),
+                                                                        time_manager)
+    vid_two, analysis_components.elapsed_time_two = passFrames(lambda: buildCaptureTool(fileTwo), passed)
+    analysis_components.one_count = passed
+    analysis_components.two_count = passed
+    # each video is decoded in its own thread, ahead of the comparison
+    analysis_components.vid_one = pumpFrames(vid_one)
+    analysis_components.vid_two = pumpFrames(vid_two)
     analysis_components.fps = analysis_components.vid_one.get(cv2api_delegate.prop_fps)
     analysis_components.frame_one_mask = \
         np.zeros((int(analysis_components.vid_one.get(cv2api_delegate.prop_frame_height)),
@@ -2257,12 +2612,17 @@ def __runDiff(fileOne, fileTwo, name_prefix, time_manager, opFunc,
             ret_two, frame_two = analysis_components.retrieveTwo()
             if frame_one.shape != frame_two.shape:
                 return getMaskSetForEntireVideo(FileMetaDataLocator(fileOne)),[]
-            analysis_components.mask = tool_set.createMask(ImageWrapper(frame_one),
-                                                           ImageWrapper(frame_two),
-                                                           False,
-                                                           convertFunction=convert_function,
-                                                           alternativeFunction=compare_function,
-                                                           arguments=compare_args)[0].to_array()
+            analysis_components.mask = block_compare.mask(analysis_components.vid_one,
+                                                          analysis_components.vid_two,
+                                                          frame_one,
+                                                          frame_two)
+            if analysis_components.mask is None:
+                analysis_components.mask = tool_set.createMask(ImageWrapper(frame_one),
+                                                               ImageWrapper(frame_two),
+                                                               False,
+                                                               convertFunction=convert_function,
+                                                               alternativeFunction=compare_function,
+                                                               arguments=compare_args)[0].to_array()
             if not opFunc(analysis_components,ranges,compare_args,compare_function=compare_func):
                 done = True
                 break
@@ -2276,6 +2636,7 @@ def __runDiff(fileOne, fileTwo, name_prefix, time_manager, opFunc,
             opFunc(analysis_components,ranges,arguments)
         analysis_components.writer.release()
     finally:
+        block_compare.close()
         analysis_components.vid_one.release()
         analysis_components.vid_two.release()
         analysis_components.writer.close()
@@ -2284,7 +2645,41 @@ def __runDiff(fileOne, fileTwo, name_prefix, time_manager, opFunc,
             'Mask Computation Failed to a read videos.  FFMPEG and OPENCV may not be installed correctly or the videos maybe empty.')
     return ranges,[]
 
+def __seekBeforeTime(video, frame_time):
+    """
+    Pass the frames before the first frame at or after the given time by seeking, if the video
+    is of constant rate and more than preference 'video_seek_frames' frames (default 120) would be passed.
+    The frame numbers follow from the rate, stopping a frame short of the time.
+    The last passed frame is grabbed and its frame number checked and its time must precede the given time;
+    otherwise (or if the video cannot seek) the video is returned to its prior position, to be read frame by frame.
+    :param video: capture
+    :param frame_time: time in milliseconds
+    """
+    if not __canSeek(video):
+        return
+    rate = video.get(cv2api_delegate.prop_fps)
+    if rate <= 0:
+        return
+    current = int(round(video.get(cv2api_delegate.prop_pos_frames)))
+    frames = int(frame_time * rate / 1000.0 - 0.5)
+    if frames - current <= int(MaskGenLoader().get_key('video_seek_frames', 120)):
+        return
+    if __seekToFrame(video, frames):
+        last_time = video.get(cv2api_delegate.prop_pos_msec)
+        if last_time < frame_time:
+            return
+    logging.getLogger('maskgen').debug('Seek failed; reading frame by frame')
+    video.set(cv2api_delegate.prop_pos_frames, current)
+
+
 def __get_video_frame(video, frame_time):
+    """
+    Read the first frame at or after the given time, seeking over the frames before it (see __seekBeforeTime).
+    :param video: capture
+    :param frame_time: time in milliseconds
+    :return: the frame and its time, or None,None if the video ends first
+    """
+    __seekBeforeTime(video, frame_time)
     while video.isOpened():
         ret = video.grab()
         if not ret:
@@ -3296,3 +3691,9 @@ class DummyMemory:
         return self.default
     def __setitem__(self, key, item):
         pass
+    def fetch(self, *args, **kwargs):
+        return self.default
+    def store(self, *args, **kwargs):
+        pass
+    def forWorker(self):
+        return self
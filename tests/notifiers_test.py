@@ -8,7 +8,13 @@
 from test_support import TestSupport
 import unittest
 from maskgen.scenario_model import ImageProjectModel
-from maskgen.notifiers import NotifyDelegate
+from maskgen.notifiers import NotifyDelegate, PersistentProbeMaskMemory
+from maskgen.disk_cache import DiskCache
+from maskgen import mask_rules
+import tempfile
+import numpy as np
+import shutil
+from mock import patch
 
 class TestNotifiers(TestSupport):
 
@@ -38,6 +44,54 @@ class TestNotifiers(TestSupport):
        self.assertTrue (memory[key3] is None)
        self.assertTrue (memory[key4] is None)
 
+   def test_persistent_memory(self):
+       directory = tempfile.mkdtemp()
+       self.addCleanup(shutil.rmtree, directory)
+       cache = DiskCache(directory)
+       model = ImageProjectModel(self.locateFile('images/sample.json'),
+                                 notify=NotifyDelegate([]))
+       model.set_probe_mask_memory(PersistentProbeMaskMemory(cache, inProcess=False))
+       with patch('maskgen.mask_rules.alterComposite', wraps=mask_rules.alterComposite) as alter:
+           first_probes = model.getProbeSetWithoutComposites()
+           first_calls = alter.call_count
+       self.assertTrue(cache.size() > 0)
+       model = ImageProjectModel(self.locateFile('images/sample.json'),
+                                 notify=NotifyDelegate([]))
+       model.set_probe_mask_memory(PersistentProbeMaskMemory(DiskCache(directory), inProcess=False))
+       with patch('maskgen.mask_rules.alterComposite', wraps=mask_rules.alterComposite) as alter:
+           second_probes = model.getProbeSetWithoutComposites()
+           self.assertTrue(alter.call_count < first_calls)
+       self.assertEqual(len(first_probes), len(second_probes))
+       cache.max_bytes = 0
+       cache.evict()
+       self.assertEqual(0, cache.size())
+       # the same mask arriving from another base edge or path is another entry
+       memory = PersistentProbeMaskMemory(cache, inProcess=False)
+       graph = model.getGraph()
+       edge = graph.get_edge('input_mod_1', 'input_mod_2')
+       mask = mask_rules.CompositeImage('orig_input', 'input_mod_1', 'image', np.ones((8, 8), dtype=np.uint8))
+       keys = set([memory._contentKey(('composite', base, ('input_mod_1', 'input_mod_2')), composite, graph, edge, [])
+                   for base, composite in [(('orig_input', 'input_mod_1'), mask),
+                                           (('sample', 'orig_input'), mask),
+                                           (('orig_input', 'input_mod_1'),
+                                            mask_rules.CompositeImage('sample', 'input_mod_1', 'image',
+                                                                      np.ones((8, 8), dtype=np.uint8)))]])
+       self.assertEqual(3, len(keys))
 
+   def test_worker_memory(self):
+       import cPickle
+       directory = tempfile.mkdtemp()
+       self.addCleanup(shutil.rmtree, directory)
+       memory = PersistentProbeMaskMemory(DiskCache(directory), inProcess=True)
+       key = ('composite', ('orig_input', 'input_mod_1'), ('input_mod_1', 'input_mod_2'))
+       memory[key] = mask_rules.CompositeImage('orig_input', 'input_mod_1', 'image', np.ones((8, 8), dtype=np.uint8))
+       # sent to worker processes without the masks remembered in process
+       worker_memory = cPickle.loads(cPickle.dumps(memory.forWorker(), cPickle.HIGHEST_PROTOCOL))
+       self.assertTrue(worker_memory[key] is None)
+       self.assertEqual(directory, worker_memory.cache.directory)
+       with worker_memory.cache.lock:
+           pass
 
 
+if __name__ == '__main__':
+    unittest.main()
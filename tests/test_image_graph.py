@@ -19,6 +19,16 @@ class TestImageGraph(TestSupport):
        self.assertEqual(3,len(graph.get_nodes()))
        self.assertEqual(2,len(graph.get_edges()))
 
+   def test_pickle(self):
+       import pickle
+       initial = image_graph.createGraph(self.locateFile('images/sample.json'),'image')
+       start = initial.idc
+       graph = pickle.loads(pickle.dumps(initial))
+       self.assertEqual(initial.get_nodes(), graph.get_nodes())
+       self.assertEqual(initial.dir, graph.dir)
+       self.assertTrue(graph.arg_checker_callback is None)
+       self.assertEqual(start + 1, graph.nextId())
+
    def test_build_graph(self):
         edgePaths = ['videomasks', 'videosegment']
         value = {'videomasks': [
@@ -0,0 +1,49 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+from maskgen import image_pyramid
+from maskgen.image_wrap import ImageWrapper
+from test_support import TestSupport
+
+
+class TestImagePyramid(TestSupport):
+
+    def test_levels(self):
+        from mock import patch
+        directory = tempfile.mkdtemp()
+        self.addFileToRemove(directory)
+        filename = os.path.join(directory, 'pyramid.png')
+        ImageWrapper(np.random.randint(0, 255, (300, 520, 3), dtype='uint8')).save(filename)
+        pyramid = image_pyramid.ImagePyramid(filename)
+        self.assertEqual([(520, 300), (260, 150), (130, 75)], pyramid.sizes())
+        self.assertEqual((130, 75), pyramid.level((100, 100)).size)
+        self.assertEqual((260, 150), pyramid.level((250, 250)).size)
+        self.assertEqual((520, 300), pyramid.level((1000, 1000)).size)
+        self.assertEqual((130, 75), image_pyramid.getPyramidLevel(filename, (125, 125)).size)
+        # a touched file with the same content keeps its levels
+        os.utime(filename, (0, 0))
+        with patch.object(pyramid, 'build') as build:
+            pyramid.sizes()
+            self.assertEqual(0, build.call_count)
+        ImageWrapper(np.random.randint(0, 255, (200, 200, 3), dtype='uint8')).save(filename)
+        self.assertEqual([(200, 200), (100, 100)], pyramid.sizes())
+        # levels are renamed in place
+        self.assertEqual([], [name for name in os.listdir(pyramid.directory) if name.find('.tmp') >= 0])
+
+    def test_background_build(self):
+        from mock import patch
+        directory = tempfile.mkdtemp()
+        self.addFileToRemove(directory)
+        filename = os.path.join(directory, 'pyramid.png')
+        ImageWrapper(np.random.randint(0, 255, (300, 520, 3), dtype='uint8')).save(filename)
+        pyramid = image_pyramid.ImagePyramid(filename)
+        with patch.object(image_pyramid, 'buildInBackground') as background:
+            self.assertEqual(None, pyramid.level((100, 100), wait=False))
+            background.assert_called_once_with(pyramid.filename)
+        image_pyramid._build(filename)
+        self.assertEqual((130, 75), pyramid.level((100, 100), wait=False).size)
+
+
+if __name__ == '__main__':
+    unittest.main()
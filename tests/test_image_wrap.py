@@ -149,6 +149,188 @@ class TestImageWrap(TestSupport):
         wrapper = image_wrap.ImageWrapper(np.random.rand(32, 32, 3), to_mask=True)
         self.assertTrue(wrapper.to_float().to_array() is not None)
 
+    def test_packed_mask(self):
+        mask = np.zeros((20, 35), dtype=np.uint8)
+        mask[5:9, 11:30] = 255
+        packed = image_wrap.packMask(image_wrap.ImageWrapper(mask))
+        self.assertTrue(isinstance(packed, image_wrap.PackedMask))
+        self.assertEqual((35, 20), packed.size)
+        self.assertTrue(np.all(mask == np.asarray(packed)))
+        self.assertEqual(4 * 19, packed.count())
+        self.assertEqual(((11, 5), (30, 9)), packed.bounding_region())
+        inverted = packed.invert()
+        self.assertEqual(20 * 35 - 4 * 19, inverted.count())
+        self.assertTrue(np.all(255 - mask == inverted.to_array()))
+        self.assertEqual(0, (packed & inverted).count())
+        self.assertEqual(20 * 35, (packed | inverted).count())
+        self.assertEqual(None, image_wrap.PackedMask(np.zeros((3, 9))).bounding_region())
+        self.assertEqual(4 * 19, np.sum(packed.to_mask().to_array() == 255))
+        self.assertTrue(isinstance(packed.unpack(), image_wrap.ImageWrapper))
+        self.assertEqual((7, 4), packed.resize((7, 4), 0).size)
+        # other ImageWrapper attributes are not unpacked implicitly
+        self.assertFalse(hasattr(packed, 'image_array'))
+        gray = mask.copy()
+        gray[0, 0] = 128
+        self.assertTrue(image_wrap.packMask(gray) is gray)
+
+
+    def test_mapped_tiff(self):
+        from mock import patch
+        data = np.random.randint(0, 255, (64, 48, 3), dtype='uint8')
+        fname = os.path.join(os.path.dirname(self.locateFile('tests/images/postfill.png')), 'mapped.tif')
+        self.addFileToRemove(fname)
+        image_wrap.imsave(fname, data)
+        with patch('maskgen.image_wrap.MaskGenLoader.get_key', return_value=0):
+            wrapper = image_wrap.openMappedTiff(fname)
+        self.assertTrue(wrapper.is_mapped())
+        self.assertEqual((48, 64), wrapper.size)
+        self.assertEqual('RGB', wrapper.mode)
+        self.assertTrue(np.all(data[8:30, 4:20] == wrapper.crop((4, 8, 20, 30)).to_array()))
+        # smaller files are left to the other openers
+        self.assertEqual(None, image_wrap.openMappedTiff(fname))
+        wrapper.save(fname)
+        self.assertFalse(wrapper.is_mapped())
+        self.assertTrue(np.all(data == image_wrap.openImageFile(fname).to_array()))
+
+    def test_opener_memo(self):
+        from mock import Mock, patch
+        declining = Mock(return_value=None)
+        image_wrap.opener_memo.pop(('.jpg', None), None)
+        with patch.object(image_wrap, 'file_registry', [('', [declining, image_wrap.defaultOpen])]):
+            self.assertTrue(image_wrap.openFromRegistry(self.locateFile('images/sample.jpg')) is not None)
+            self.assertEqual(1, declining.call_count)
+            # the declining opener may accept other files of the type
+            self.assertFalse(('.jpg', None) in image_wrap.opener_memo)
+        with patch.object(image_wrap, 'file_registry', [('', [image_wrap.defaultOpen, declining])]):
+            self.assertTrue(image_wrap.openFromRegistry(self.locateFile('images/sample.jpg')) is not None)
+            self.assertTrue(image_wrap.opener_memo[('.jpg', None)] is image_wrap.defaultOpen)
+            self.assertEqual(1, declining.call_count)
+
+    def test_opener_memo_after_exception(self):
+        from mock import Mock, patch
+        failing = Mock(side_effect=IOError('unreadable'))
+        failing.__name__ = 'failing'
+        fallback = Mock(side_effect=image_wrap.defaultOpen)
+        fallback.__name__ = 'fallback'
+        image_wrap.opener_memo.pop(('.jpg', None), None)
+        with patch.object(image_wrap, 'file_registry', [('', [failing, fallback, image_wrap.proxyOpen])]):
+            self.assertTrue(image_wrap.openFromRegistry(self.locateFile('images/sample.jpg')) is not None)
+            self.assertEqual(1, fallback.call_count)
+            self.assertTrue(image_wrap.opener_memo[('.jpg', None)] is fallback)
+            # later files of the type skip the opener that raised
+            self.assertTrue(image_wrap.openFromRegistry(self.locateFile('images/sample.jpg')) is not None)
+            self.assertEqual(1, failing.call_count)
+            self.assertEqual(2, fallback.call_count)
+        # the proxy of the media is not remembered
+        image_wrap.opener_memo.pop(('.jpg', None), None)
+        proxy = Mock(side_effect=image_wrap.defaultOpen)
+        with patch.object(image_wrap, 'proxyOpen', proxy), \
+                patch.object(image_wrap, 'file_registry', [('', [failing, proxy])]):
+            self.assertTrue(image_wrap.openFromRegistry(self.locateFile('images/sample.jpg')) is not None)
+            self.assertFalse(('.jpg', None) in image_wrap.opener_memo)
+
+    def test_open_tiff_sizes(self):
+        from mock import patch
+        directory = os.path.dirname(self.locateFile('tests/images/postfill.png'))
+        small = os.path.join(directory, 'small.tif')
+        large = os.path.join(directory, 'large.tif')
+        self.addFileToRemove(small)
+        self.addFileToRemove(large)
+        image_wrap.imsave(small, np.random.randint(0, 255, (8, 8, 3), dtype='uint8'))
+        image_wrap.imsave(large, np.random.randint(0, 255, (64, 48, 3), dtype='uint8'))
+        image_wrap.opener_memo.pop(('.tif', None), None)
+        with patch('maskgen.image_wrap.MaskGenLoader.get_key', return_value=4096):
+            self.assertFalse(image_wrap.openFromRegistry(small).is_mapped())
+            # large files are mapped ahead of the opener remembered for small ones
+            self.assertTrue(image_wrap.openFromRegistry(large).is_mapped())
+            self.assertFalse(image_wrap.openFromRegistry(small).is_mapped())
+
+    def test_open_sniffed(self):
+        import shutil
+        fname = os.path.join(os.path.dirname(self.locateFile('tests/images/postfill.png')), 'sniffed.dat')
+        self.addFileToRemove(fname)
+        shutil.copy(self.locateFile('tests/images/test.png'), fname)
+        self.assertEqual('png', image_wrap.sniffImageType(fname))
+        # types without openers of their own are left to the file name
+        self.assertEqual(None, image_wrap.sniffImageType(self.locateFile('images/sample.jpg')))
+        self.assertEqual(image_wrap.readPNG, image_wrap._openers(fname, 'png')[0])
+        wrapper = image_wrap.openFromRegistry(fname)
+        self.assertEqual(image_wrap.openImageFile(self.locateFile('tests/images/test.png')).size, wrapper.size)
+        self.assertEqual(image_wrap.readPNG, image_wrap.opener_memo[('.dat', 'png')])
+
+    def test_read_png16(self):
+        from numpngw import write_png
+        fname = os.path.join(os.path.dirname(self.locateFile('tests/images/postfill.png')), 'png16.png')
+        self.addFileToRemove(fname)
+        for data in [np.random.randint(0, 65535, (30, 40, 3), dtype='uint16'),
+                     np.random.randint(0, 65535, (30, 40), dtype='uint16')]:
+            write_png(fname, data)
+            self.assertEqual(16, image_wrap._pngHeader(fname)[0])
+            wrapper = image_wrap.readPNG(fname)
+            self.assertEqual('uint16', wrapper.image_array.dtype)
+            self.assertTrue(np.all(data == wrapper.image_array))
+            self.assertTrue(np.all(image_wrap._readPNG16(fname).image_array == wrapper.image_array))
+        self.assertEqual(None, image_wrap._pngHeader(self.locateFile('images/sample.jpg')))
+
+    def test_image_cache(self):
+        cache = image_wrap.ImageCache(1000)
+        cache.store('a.png', 1.0, image_wrap.ImageWrapper(np.zeros((20, 20), dtype=np.uint8)))
+        cache.store('b.png', 1.0, image_wrap.ImageWrapper(np.zeros((20, 20), dtype=np.uint8)))
+        self.assertTrue(cache.lookup('a.png', 1.0) is not None)
+        self.assertTrue(cache.lookup('a.png', 1.0, isMask=True) is not None)
+        cache.store('c.png', 1.0, image_wrap.ImageWrapper(np.zeros((20, 20), dtype=np.uint8)))
+        self.assertEqual(None, cache.lookup('b.png', 1.0))
+        self.assertEqual(None, cache.lookup('a.png', 2.0))
+        # larger than the budget
+        cache.store('d.png', 1.0, image_wrap.ImageWrapper(np.zeros((40, 40), dtype=np.uint8)))
+        self.assertEqual(None, cache.lookup('d.png', 1.0))
+        self.assertEqual({'hits': 2, 'misses': 3, 'evictions': 1, 'bytes': 800, 'entries': 2, 'budget': 1000},
+                         cache.stats())
+        cache.discard('a.png')
+        self.assertEqual(400, cache.stats()['bytes'])
+
+    def test_memoized_conversions(self):
+        from mock import patch
+        wrapper = image_wrap.ImageWrapper(np.random.randint(0, 255, (20, 20, 3), dtype=np.uint8))
+        self.assertFalse(wrapper.to_float() is wrapper.to_float())
+        wrapper.memoize(2)
+        gray = wrapper.to_16BitGray()
+        self.assertTrue(gray is wrapper.to_16BitGray())
+        self.assertFalse(gray is wrapper.to_16BitGray(equalize_colors=True))
+        self.assertTrue(wrapper.to_float() is wrapper.to_float())
+        # kept conversions are shared read-only; copies and the image itself remain writable
+        with self.assertRaises(ValueError):
+            gray.image_array[0, 0] = 0
+        gray.to_array()[0, 0] = 0
+        # replacing the pixels drops the conversions
+        rgb = wrapper.to_rgb()
+        wrapper.image_array = np.copy(wrapper.image_array)
+        self.assertFalse(rgb is wrapper.to_rgb())
+        # conversions are not kept past the image cache budget
+        with patch.object(image_wrap, 'image_cache', image_wrap.ImageCache(1000)):
+            mask = wrapper.to_mask()
+            self.assertFalse(mask is wrapper.to_mask())
+            # conversions not kept are the caller's own
+            mask.image_array[0, 0] = 0
+        # the conversions of a cached image are weighed with it
+        cache = image_wrap.ImageCache(2500)
+        with patch.object(image_wrap, 'image_cache', cache):
+            other = image_wrap.ImageWrapper(np.zeros((20, 20), dtype=np.uint8), filename='b.png')
+            cache.store('b.png', 1, other)
+            wrapper.filename = 'a.png'
+            wrapper.memoize(2)
+            cache.store('a.png', 1, wrapper)
+            self.assertEqual(1600, cache.stats()['bytes'])
+            gray = wrapper.to_16BitGray()
+            self.assertTrue(gray is wrapper.to_16BitGray())
+            self.assertEqual(2400, cache.stats()['bytes'])
+            # weighing the conversions evicts other images
+            mask = wrapper.to_mask()
+            self.assertTrue(mask is wrapper.to_mask())
+            self.assertEqual(1, cache.stats()['entries'])
+            self.assertEqual(2400, cache.stats()['bytes'])
+            # conversions that would not fit with the image are not kept
+            self.assertFalse(wrapper.invert() is wrapper.invert())
 
     def pilFixTransparency(self,img):
         if img.mode.find('A') < 0:
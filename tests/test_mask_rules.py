@@ -351,6 +351,36 @@ class TestMaskRules(TestSupport):
         ImageWrapper(result).save('foo.png')
         self.assertEqual(255, result[205, 206])
 
+    def test_transform_memory(self):
+        edge = {u'maskname': u'Rotate_mask.png',
+                u'inputmaskname': None,
+                'empty mask': 'no',
+                u'arguments': {u'transform matrix': {u'c': 3,
+                                                     u'r': 3,
+                                                     u'r0': [1, 0, 2],
+                                                     u'r1': [0, 1, 12],
+                                                     u'r2': [0, 0, 1.0]}},
+                u'op': u'TransformResize'}
+        memory = EdgeTransformMemory()
+        states = [BuildState(edge,
+                             'a',
+                             'b',
+                             np.zeros((100, 100), dtype=np.uint8),
+                             (100, 100),
+                             (100, 100),
+                             compositeMask=CompositeImage(base, 'b', 'image', np.ones((100, 100), dtype=np.uint8)),
+                             transformMemory=memory) for base in ['x', 'y']]
+        self.assertTrue(states[0].transformMatrix() is states[1].transformMatrix())
+        self.assertEqual(12, states[0].transformMatrix()[1, 2])
+        self.assertFalse(states[0].transformMatrix().flags.writeable)
+        edge_mask = np.zeros((4, 4), dtype=np.uint8)
+        self.assertFalse(memory('a', 'b', 'edge mask', lambda: edge_mask).flags.writeable)
+        self.assertTrue(edge_mask.flags.writeable)
+        built = []
+        self.assertEqual(1, memory('a', 'c', 'shapes', lambda: built.append(1) or 1))
+        self.assertEqual(1, memory('a', 'c', 'shapes', lambda: built.append(1) or 2))
+        self.assertEqual(1, len(built))
+
     def test_cas_transform(self):
         edge = {u'maskname': u'Rotate_mask.png',
                 u'inputmaskname': None,
@@ -436,6 +466,39 @@ class TestMaskRules(TestSupport):
         self.assertEqual(0, result[26, 26])
         self.assertEqual(1, result[51, 51])
 
+    def test_sparse_composite(self):
+        cm = np.zeros((400, 300), dtype=np.uint8)
+        cm[25:75, 30:90] = 255
+        composite = CompositeImage('a', 'b', 'image', cm)
+        self.assertEqual((25, 30), composite.offset)
+        self.assertEqual((50, 60), composite.region.shape)
+        self.assertTrue(np.all(cm == composite.mask))
+        self.assertEqual(400 * 300 - 50 * 60, composite.sizeOfChange())
+        cropped = composite.crop((50, 50), (300, 300))
+        self.assertEqual((300, 250), cropped.shape)
+        self.assertTrue(np.all(cm[50:350, 50:300] == cropped.mask))
+        shifted = composite.shift((-10, 20), (400, 300))
+        expected = np.zeros((400, 300), dtype=np.uint8)
+        expected[0:390, 20:300] = cm[10:400, 0:280]
+        self.assertTrue(np.all(expected == shifted.mask))
+        self.assertTrue(composite.crop((100, 100), (50, 50)).isEmpty())
+        edgeMask = np.ones((400, 300), dtype=np.uint8) * 255
+        edgeMask[25:50, :] = 0
+        removed = composite.removeChange(edgeMask)
+        self.assertEqual((25, 60), (np.sum(removed.mask[:, 30] == 255), np.sum(removed.mask[50, :] == 255)))
+        self.assertTrue(np.all(cm == composite.mask))
+        self.assertTrue(CompositeImage('a', 'b', 'image', np.zeros((40, 30), dtype=np.uint8)).isEmpty())
+        # writes to the mask are refused rather than lost
+        with self.assertRaises(ValueError):
+            composite.mask[0, 0] = 255
+        ones = np.ones((40, 30), dtype=np.uint8)
+        full = CompositeImage('a', 'b', 'image', ones)
+        with self.assertRaises(ValueError):
+            full.mask[0, 0] = 0
+        # the array given to the composite stays writable
+        ones[0, 0] = 0
+        self.assertEqual(0, full.mask[0, 0])
+
     def test_select_crop_transform(self):
         edge = {u'maskname': u'Rotate_mask.png',
                 u'inputmaskname': None,
@@ -1382,3 +1445,23 @@ class TestMaskRules(TestSupport):
         self.assertEquals(index[(('1', '2'), '10')], index[(('1', '2'), '9')])
         self.assertEquals(index[(('2', '4'), '10')], index[(('2', '4'), '9')])
         self.assertNotEquals(index[(('1', '2'), '10')], index[(('1', '2'), '7')])
+
+    def test_renumber_probe_masks(self):
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addFileToRemove(directory)
+        donor = os.path.join(directory, shortenName('a_b', '_d_mask.png', identifier=-1048575))
+        target = os.path.join(directory, shortenName('a_b_c', '_ps.png', identifier=-1048574))
+        open(donor, 'w').close()
+        graph = Mock()
+        graph.nextId.side_effect = [21, 22]
+        probes = [Probe(('a', 'b'), 'c', 'a', 'b', donorMaskFileName=donor, targetMaskFileName=target),
+                  Probe(('a', 'b'), 'd', 'a', 'b', donorMaskFileName=donor)]
+        renumberProbeMasks(probes, graph, -1048576, -1048574)
+        self.assertEqual(os.path.join(directory, shortenName('a_b', '_d_mask.png', identifier=21)),
+                         probes[0].donorMaskFileName)
+        self.assertEqual(probes[0].donorMaskFileName, probes[1].donorMaskFileName)
+        self.assertTrue(os.path.exists(probes[0].donorMaskFileName))
+        self.assertFalse(os.path.exists(donor))
+        self.assertEqual(os.path.join(directory, shortenName('a_b_c', '_ps.png', identifier=22)),
+                         probes[0].targetMaskFileName)
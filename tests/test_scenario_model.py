@@ -33,6 +33,87 @@ class TestScenarioModel(TestSupport):
       self.assertTrue(foundPasteSplice)
 
 
+   def test_probe_cache(self):
+      from maskgen.image_graph import createGraph
+      from maskgen.mask_rules import Probe
+      graph = createGraph(self.locateFile('images/sample.json'))
+      graph.pop_dirty_edges()
+      cache = scenario_model.ProbeCache()
+      edge_ids = [('orig_input', 'input_mod_1'), ('hat', 'hat_splice')]
+      probes, to_construct = cache.split(graph, edge_ids, {'saveTargets': False})
+      self.assertEqual(0, len(probes))
+      self.assertEqual(edge_ids, to_construct)
+      cache.update(edge_ids, [Probe(edge_id, 'final', 'base', None) for edge_id in edge_ids])
+      probes, to_construct = cache.split(graph, edge_ids, {'saveTargets': False})
+      self.assertEqual(2, len(probes))
+      self.assertEqual(0, len(to_construct))
+      # upstream of orig_input->input_mod_1 only
+      graph.update_edge('sample', 'orig_input', description='changed')
+      probes, to_construct = cache.split(graph, edge_ids, {'saveTargets': False})
+      self.assertEqual([('orig_input', 'input_mod_1')], to_construct)
+      self.assertEqual([('hat', 'hat_splice')], [probe.edgeId for probe in probes])
+      probes, to_construct = cache.split(graph, edge_ids, {'saveTargets': True})
+      self.assertEqual(edge_ids, to_construct)
+      cache.update(edge_ids, [Probe(edge_id, 'final', 'base', None) for edge_id in edge_ids])
+      cache.split(graph, edge_ids, {'saveTargets': True})
+      # a changed node affects the edges through it
+      graph.update_node('orig_input', description='changed')
+      probes, to_construct = cache.split(graph, edge_ids, {'saveTargets': True})
+      self.assertEqual([('orig_input', 'input_mod_1')], to_construct)
+      # masks held only in memory are not kept
+      cache.update(edge_ids, [Probe(edge_ids[0], 'final', 'base', None, targetMaskImage=object()),
+                              Probe(edge_ids[1], 'final', 'base', None)])
+      probes, to_construct = cache.split(graph, edge_ids, {'saveTargets': True})
+      self.assertEqual([edge_ids[0]], to_construct)
+      # attributes set directly on an edge are marked
+      cache.update(edge_ids, [Probe(edge_id, 'final', 'base', None) for edge_id in edge_ids])
+      graph.get_edge('hat', 'hat_splice')['inputmaskname'] = 'hat_inputmask.png'
+      graph.mark_edge_dirty('hat', 'hat_splice')
+      probes, to_construct = cache.split(graph, edge_ids, {'saveTargets': True})
+      self.assertEqual([('hat', 'hat_splice')], to_construct)
+
+   def test_generate_probes(self):
+      from mock import patch
+      from maskgen import mask_rules
+      model = scenario_model.ImageProjectModel(self.locateFile('images/sample.json'))
+      with patch('maskgen.mask_rules.prepareComposite', wraps=mask_rules.prepareComposite) as prepare:
+         generator = model.generateProbes(maxInFlight=1)
+         probes = [next(generator)]
+         # construction does not run ahead of the consumer
+         self.assertTrue(prepare.call_count < len(model.getGraph().get_edges()))
+         probes.extend(generator)
+      self.assertEqual(len(probes), len(model.getProbeSetWithoutComposites()))
+      # probes are reused only with the preference probe_reuse
+      self.assertEqual(0, len(model.probeCache.probes))
+      get_key = scenario_model.prefLoader.get_key
+      with patch.object(scenario_model.prefLoader, 'get_key',
+                        side_effect=lambda key, *args: True if key == 'probe_reuse' else get_key(key, *args)):
+         # target masks not saved are not held by the probe cache
+         probes = list(model.generateProbes(saveTargets=False))
+      self.assertTrue(len(probes) > 0)
+      self.assertTrue(len(model.probeCache.probes) > 0)
+      for edge_probes in model.probeCache.probes.values():
+         for probe in edge_probes:
+            self.assertTrue(probe.targetMaskImage is None and probe.donorMaskImage is None)
+
+   def test_media_prefetch(self):
+      from mock import Mock, patch
+      model = scenario_model.ImageProjectModel(self.locateFile('images/sample.json'))
+      graph = model.getGraph()
+      prefetch = scenario_model.MediaPrefetch(graph, 2)
+      tasks = prefetch.tasks()
+      self.assertEqual(0, len(graph.predecessors(tasks[0][1][0])))
+      self.assertEqual(len(graph.get_nodes()), len([task for task in tasks if task[0] == graph.get_image]))
+      prefetch.start()
+      prefetch.wait()
+      func = Mock()
+      prefetch = scenario_model.MediaPrefetch(graph, 2)
+      with patch.object(prefetch, 'tasks', return_value=[(func, ())]):
+         prefetch.cancel()
+         prefetch.start()
+         prefetch.wait()
+      self.assertEqual(0, func.call_count)
+
    def test_video_video_link_tool(self):
       from maskgen.scenario_model import VideoVideoLinkTool
       from maskgen.software_loader import Operation
@@ -59,6 +59,29 @@ class TestToolSet(TestSupport):
         self.assertTrue(np.all(img3[10:15,10:15]==3))
         img3[10:15, 10:15] = 0
 
+    def test_find_rotation(self):
+        from mock import patch
+        pre = tool_set.openImageFile(self.locateFile('tests/images/prefill.png')).to_array()[:, :, 0]
+        post = np.rot90(pre, 1)
+        with patch('maskgen.tool_set.__compareRotatedImage',
+                   wraps=getattr(tool_set, '__compareRotatedImage')) as compare:
+            mask, analysis = tool_set.convertCompare(pre, post, arguments={'Image Rotated': 'yes'})
+            # candidates are scored at reduced resolution
+            self.assertEqual(1, compare.call_count)
+        self.assertEqual(90, analysis['rotation'])
+        angle, score = getattr(tool_set, '__goldenSection')(lambda x: (x - 0.3) ** 2, -1.0, 1.0, 20)
+        self.assertTrue(abs(angle - 0.3) < 0.01)
+        self.assertEqual(None, getattr(tool_set, '__goldenSection')(lambda x: x, -1.0, 1.0, 1))
+        # refinement of a given rotation is opt-in
+        with patch('maskgen.tool_set.__rotationPyramids',
+                   wraps=getattr(tool_set, '__rotationPyramids')) as pyramids:
+            mask, analysis = tool_set.rotateCompare(pre, pre, arguments={'rotation': '10'})
+            self.assertEqual(0, pyramids.call_count)
+            self.assertFalse('refined rotation' in analysis)
+            mask, analysis = tool_set.rotateCompare(pre, pre, arguments={'rotation': '10',
+                                                                         'rotation refinement': 0.5})
+            self.assertEqual(1, pyramids.call_count)
+
     def testCropCompare(self):
         import cv2
         pre = tool_set.openImageFile(self.locateFile('tests/images/prefill.png')).to_array()
@@ -93,6 +116,27 @@ class TestToolSet(TestSupport):
         t = tool_set.getDurationStringFromMilliseconds(100001.111)
         self.assertEqual('00:01:40.001111',t)
 
+    def test_time_manager_skip(self):
+        rate = 30.0
+        for start, stop in [((10000, 0), (20000, 0)), ((0, 400), (0, 500)), ((5000, 10), None)]:
+            linear = tool_set.VidTimeManager(startTimeandFrame=start, stopTimeandFrame=stop)
+            skipped = tool_set.VidTimeManager(startTimeandFrame=start, stopTimeandFrame=stop)
+            skipped.updateToNow(0.0)
+            frames = skipped.framesBeforeStart(rate, 0.0, 10000)
+            self.assertTrue(frames > 100)
+            skipped.skipFrames(rate, 0.0, frames, frames * 1000.0 / rate)
+            self.assertTrue(skipped.isBeforeTime())
+            frame = 0
+            while linear.frameSinceBeginning < skipped.frameSinceBeginning:
+                linear.updateToNow(frame * 1000.0 / rate)
+                frame += 1
+            while not linear.isPastTime() and frame < 1000:
+                linear.updateToNow(frame * 1000.0 / rate)
+                skipped.updateToNow(frame * 1000.0 / rate)
+                frame += 1
+            self.assertEqual(linear.getStartFrame(), skipped.getStartFrame())
+            self.assertEqual(linear.getEndFrame(), skipped.getEndFrame())
+
     def test_timeparse(self):
         t, f = tool_set.getMilliSecondsAndFrameCount('00:00:00')
         self.assertEqual(1, f)
@@ -221,5 +265,126 @@ class TestToolSet(TestSupport):
         self.assertFalse(len(tool_set.dateTimeStampCompare(v1, v2))==0)
         self.assertTrue(len(tool_set.dateTimeStampCompare(v1, v3))==0)
 
+    def test_mask_cache(self):
+        import tempfile
+        import shutil
+        from mock import patch
+        from maskgen.disk_cache import DiskCache
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        files = [self.locateFile('tests/images/prefill.png'), self.locateFile('tests/images/postfill.png')]
+        img1 = tool_set.openImageFile(files[0])
+        img2 = tool_set.openImageFile(files[1])
+        cache = tool_set.MaskCache(DiskCache(directory, compress=False))
+        with patch('maskgen.tool_set.createMask', wraps=tool_set.createMask) as create:
+            mask1, analysis1, error1 = cache.createMask(files, img1, img2)
+            mask2, analysis2, error2 = cache.createMask(files, img1, img2)
+            self.assertEqual(1, create.call_count)
+            cache.createMask(files, img1, img2, arguments={'tolerance': 3})
+            self.assertEqual(2, create.call_count)
+            # the same files opened with other arguments
+            reopened = tool_set.ImageWrapper(img1.to_array(), filename=files[0])
+            reopened.open_args = {'raw': 'camera'}
+            cache.createMask(files, reopened, img2)
+            self.assertEqual(3, create.call_count)
+        self.assertTrue(np.all(mask1.to_array() == mask2.to_array()))
+        self.assertEqual(analysis1, analysis2)
+        self.assertEqual(None, error2)
+
+    def test_tally_seam(self):
+        from mock import patch
+        img1 = np.asarray([[1, 2], [3, 4]], dtype=np.uint8)
+        img2 = np.asarray([[1, 3, 2], [3, 4, 4]], dtype=np.uint8)
+        # matches must follow, in raster order, those already tallied
+        crossed1 = np.asarray([[2, 1]], dtype=np.uint8)
+        crossed2 = np.asarray([[1, 2]], dtype=np.uint8)
+        for search in [tool_set._tallySeamSearch, tool_set._tallySeamNumpy]:
+            with patch('maskgen.tool_set._tallySeamSearch', search):
+                self.assertTrue(np.all(255 == tool_set._tallySeam(img1, img2, minDepth=1)))
+                self.assertEqual([[255, 0]], tool_set._tallySeam(crossed1, crossed2, minDepth=1).tolist())
+                mask = tool_set._tallySeam(np.dstack([crossed1] * 3), np.dstack([crossed2] * 3), minDepth=1)
+                self.assertEqual((1, 2, 3), mask.shape)
+                self.assertEqual([255, 0], mask[0, :, 1].tolist())
+
+    def test_diff_mask(self):
+        from mock import patch
+        diffMask = getattr(tool_set, '__diffMask')
+        for dtype in ['uint8', 'uint16']:
+            img1 = np.random.randint(0, np.iinfo(dtype).max, (50, 40, 3)).astype(dtype)
+            img2 = np.copy(img1)
+            img2[10:20, 5:30] = np.random.randint(0, np.iinfo(dtype).max, (10, 25, 3)).astype(dtype)
+            mask = np.zeros(img1.shape, dtype='uint8')
+            mask[np.abs(img1.astype('int32') - img2.astype('int32')) > 0] = 255
+            expected = tool_set.img_analytics(img1, img2, mask=mask)
+            with patch('maskgen.tool_set.diff_strip_elements', 7 * 40 * 3):
+                result, analysis = diffMask(img1, img2, True, args={'tolerance': 0})
+            self.assertEqual(expected, analysis)
+            self.assertTrue(np.all(mask == result))
+            self.assertTrue(np.all(255 - mask == diffMask(img1, img2, False, args={'tolerance': 0})[0]))
+
+    def test_clone_mask_regions(self):
+        from mock import Mock
+        start = np.random.randint(0, 255, (60, 60, 3)).astype('uint8')
+        final = np.copy(start)
+        final[30:40, 30:40] = start[5:15, 5:15]
+        changemask = np.ones((60, 60), dtype='uint8') * 255
+        changemask[30:40, 30:40] = 0
+        finalimage = image_wrap.ImageWrapper(final)
+        # the final image is read by region
+        finalimage.__array__ = Mock(side_effect=AssertionError)
+        mask = tool_set.composeCloneMask(image_wrap.ImageWrapper(changemask), image_wrap.ImageWrapper(start),
+                                         finalimage)
+        self.assertTrue(np.all(mask[5:15, 5:15] == 255))
+        self.assertEqual(0, np.sum(mask[30:40, 30:40]))
+
+    def test_feature_cache(self):
+        import tempfile
+        from mock import patch
+        from maskgen import cv2api
+        from maskgen.disk_cache import DiskCache
+        directory = tempfile.mkdtemp()
+        self.addFileToRemove(directory)
+        pre = image_wrap.openImageFile(self.locateFile('tests/images/prefill.png'))
+        post = image_wrap.openImageFile(self.locateFile('tests/images/postfill.png'))
+        expected = tool_set.getMatchedSIFeatures(pre, post)
+        with patch('maskgen.tool_set.feature_cache', DiskCache(directory, compress=False)):
+            with patch.object(cv2api.cv2api_delegate, 'computeSIFT',
+                              wraps=cv2api.cv2api_delegate.computeSIFT) as computeSIFT:
+                tool_set.getMatchedSIFeatures(pre, post)
+                self.assertEqual(2, computeSIFT.call_count)
+                result = tool_set.getMatchedSIFeatures(pre, post)
+                self.assertEqual(2, computeSIFT.call_count)
+                tool_set.getMatchedSIFeatures(pre, post, mask1=np.ones((pre.size[1], pre.size[0]), dtype='uint8'))
+                self.assertEqual(3, computeSIFT.call_count)
+                # the same file opened with other arguments is not the same image
+                raw_pre = image_wrap.openImageFile(self.locateFile('tests/images/prefill.png'),
+                                                   args={'use_camera_wb': True})
+                tool_set.getMatchedSIFeatures(raw_pre, post)
+                self.assertEqual(4, computeSIFT.call_count)
+        self.assertTrue(np.all(expected[0] == result[0]))
+        self.assertTrue(np.all(expected[1] == result[1]))
+
+    def test_strip_compare(self):
+        from mock import patch
+        img1 = np.random.randint(0, 255, (120, 80, 3)).astype('uint8')
+        img2 = np.copy(img1)
+        img2[30:70, 20:60] = np.random.randint(0, 255, (40, 40, 3)).astype('uint8')
+        img2[90:93, 10:13] = 0
+        for compare, kwargs in [(tool_set.morphologyCompare, {'kernel': 5}),
+                                (tool_set.mediatedCompare, {'kernel': 3}),
+                                (tool_set.mediatedCompare, {'kernel': 3, 'filling': 'median', 'aggregate': 'max'})]:
+            whole = compare(img1, img2, **kwargs)
+            with patch('maskgen.tool_set.diff_strip_elements', 9 * 80 * 3):
+                strips = compare(img1, img2, **kwargs)
+            self.assertTrue(np.all(whole[0] == strips[0]))
+            self.assertEqual(whole[1], strips[1])
+        with patch('maskgen.tool_set.diff_strip_elements', 30):
+            results = tool_set.mapStrips(lambda start, end, top, bottom: (start + top, start + bottom), (100, 10),
+                                         overlap=5)
+        self.assertEqual(10, len(results))
+        self.assertEqual(0, results[0][0])
+        self.assertEqual(100, results[-1][1])
+        self.assertTrue(all(results[i][1] == results[i + 1][0] for i in range(len(results) - 1)))
+
 if __name__ == '__main__':
     unittest.main()
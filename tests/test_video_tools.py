@@ -246,6 +246,84 @@ class TestVideoTools(TestSupport):
             duration = video_tools.get_duration(mock_locator)
             self.assertTrue(abs(duration - expected) < 1)
 
+    def test_frame_pump(self):
+        filename = self.locateFile('tests/videos/sample1.mov')
+        capture = video_tools.buildCaptureTool(filename)
+        pump = video_tools.FramePump(video_tools.buildCaptureTool(filename), depth=2)
+        try:
+            self.assertEqual(capture.get(video_tools.cv2api_delegate.prop_fps),
+                             pump.get(video_tools.cv2api_delegate.prop_fps))
+            for i in range(20):
+                self.assertTrue(pump.grab())
+                self.assertTrue(capture.grab())
+                self.assertEqual(capture.get(video_tools.cv2api_delegate.prop_pos_msec),
+                                 pump.get(video_tools.cv2api_delegate.prop_pos_msec))
+                if i % 2 == 0:
+                    self.assertTrue(np.all(capture.retrieve()[1] == pump.retrieve()[1]))
+            ret, frame = pump.read()
+            self.assertTrue(ret)
+            self.assertTrue(np.all(capture.read()[1] == frame))
+            self.assertEqual(capture.get(video_tools.cv2api_delegate.prop_pos_frames),
+                             pump.get(video_tools.cv2api_delegate.prop_pos_frames))
+            self.assertRaises(ValueError, pump.get, -1)
+        finally:
+            capture.release()
+            pump.release()
+        self.assertFalse(pump.isOpened())
+        self.assertFalse(pump.grab())
+
+    def test_get_video_frame(self):
+        filename = 'sample1_ffr.mov'
+        get_video_frame = getattr(video_tools, '__get_video_frame')
+        linear = video_tools.buildCaptureTool(filename)
+        seeking = video_tools.buildCaptureTool(filename)
+        try:
+            rate = linear.get(video_tools.cv2api_delegate.prop_fps)
+            frame_time = 40 * 1000.0 / rate
+            with patch('maskgen.video_tools.MaskGenLoader.get_key', return_value=10):
+                self.assertTrue(abs(frame_time - get_video_frame(seeking, frame_time)[1]) < 1)
+                seeking.grab = Mock(wraps=seeking.grab)
+                frame_time = 80 * 1000.0 / rate
+                frame, elapsed_time = get_video_frame(seeking, frame_time)
+            self.assertTrue(seeking.grab.call_count < 40)
+            while linear.grab():
+                if linear.get(video_tools.cv2api_delegate.prop_pos_msec) >= frame_time:
+                    break
+            self.assertEqual(linear.get(video_tools.cv2api_delegate.prop_pos_msec), elapsed_time)
+            self.assertTrue(np.all(linear.retrieve()[1] == frame))
+        finally:
+            linear.release()
+            seeking.release()
+
+    def test_frame_block_compare(self):
+        from maskgen.image_wrap import ImageWrapper
+        filename = self.locateFile('tests/videos/sample1.mov')
+        vid_one = video_tools.FramePump(video_tools.buildCaptureTool(filename))
+        vid_two = video_tools.FramePump(video_tools.buildCaptureTool(filename))
+        block_compare = video_tools.FrameBlockCompare(tool_set.morphologyCompare, tool_set.convert16bitcolor)
+        self.assertFalse(video_tools.FrameBlockCompare(tool_set.mediatedCompare, tool_set.convert16bitcolor).usable())
+        try:
+            # the second video is a frame behind
+            vid_two.read()
+            self.assertEqual(3, len(vid_one.peek(3)))
+            self.assertEqual(1, vid_two.count)
+            for i in range(12):
+                frame_one = vid_one.read()[1]
+                frame_two = vid_two.read()[1]
+                expected = tool_set.createMask(ImageWrapper(frame_one), ImageWrapper(frame_two), False,
+                                               convertFunction=tool_set.convert16bitcolor,
+                                               alternativeFunction=tool_set.morphologyCompare,
+                                               arguments={})[0].to_array()
+                self.assertTrue(np.all(expected == block_compare.mask(vid_one, vid_two, frame_one, frame_two)))
+                self.assertTrue(np.all(expected == block_compare.comparePair(frame_one, frame_two)))
+            self.assertEqual(12, vid_one.count)
+            # the block following the first full block was compared in the worker
+            self.assertTrue(block_compare.pool is not None)
+        finally:
+            block_compare.close()
+            vid_one.release()
+            vid_two.release()
+
     def test_frame_rate(self):
         locator = video_tools.FileMetaDataLocator(self.locateFile('tests/videos/sample1.mov'))
         rate = video_tools.get_frame_rate(locator)
@@ -253,6 +331,16 @@ class TestVideoTools(TestSupport):
         rate = video_tools.get_frame_rate(locator, audio=True)
         self.assertTrue(abs(rate - 44100) < 1)
 
+    def test_frame_attribute(self):
+        from maskgen import ffmpeg_api
+        filename = self.locateFile('tests/videos/sample1.mov')
+        meta, frames = get_meta_from_video(filename, show_streams=True)
+        with patch('maskgen.ffmpeg_api.run_ffmpeg', side_effect=AssertionError):
+            self.assertEqual(meta[0]['r_frame_rate'], ffmpeg_api.get_frame_attribute(filename, 'r_frame_rate'))
+            self.assertEqual(meta[1]['sample_rate'],
+                             ffmpeg_api.get_frame_attribute(filename, 'sample_rate', audio=True))
+            self.assertEqual('na', ffmpeg_api.get_frame_attribute(filename, 'unknown', default='na'))
+
     def test_meta(self):
         meta, frames = get_meta_from_video(self.locateFile('tests/videos/sample1.mov'), with_frames=True)
         self.assertEqual(803, len(frames[0]))
@@ -261,6 +349,49 @@ class TestVideoTools(TestSupport):
         self.assertEqual('yuv420p', meta[0]['pix_fmt'])
         self.assertEqual('audio', meta[1]['codec_type'])
 
+    def test_probe_cache(self):
+        import tempfile
+        from maskgen import ffmpeg_api
+        from maskgen.disk_cache import DiskCache
+        directory = tempfile.mkdtemp()
+        self.addFileToRemove(directory)
+        filename = self.locateFile('tests/videos/sample1.mov')
+        with patch('maskgen.ffmpeg_api.probe_cache', DiskCache(directory)):
+            meta, frames = get_meta_from_video(filename, with_frames=True, show_streams=True)
+            with patch('maskgen.ffmpeg_api.Popen') as popen:
+                cached_meta, cached_frames = get_meta_from_video(filename, with_frames=True, show_streams=True)
+                self.assertEqual(0, popen.call_count)
+            self.assertEqual(meta, cached_meta)
+            self.assertEqual(frames, cached_frames)
+            # different probe arguments are probed again
+            self.assertEqual(0, len(get_meta_from_video(filename, show_streams=True)[1]))
+        self.assertEqual(frames, ffmpeg_api._unpack_frames(ffmpeg_api._pack_frames(frames)))
+
+    def test_compact_frames(self):
+        import StringIO
+        from maskgen import ffmpeg_api
+        stream = StringIO.StringIO('media_type=video|stream_index=0|pkt_pts_time=0.000000|pkt_duration_time=0.033367\n'
+                                   '\n'
+                                   'media_type=audio|stream_index=1|pkt_pts_time=0.000000|pkt_duration_time=N/A\n'
+                                   'media_type=video|stream_index=0|pkt_pts_time=0.033367|pkt_duration_time=0.033367\n')
+        frames = ffmpeg_api.process_frames_from_compact_stream(stream, None)
+        self.assertEqual(2, len(frames))
+        # parsed straight into columns, with a dict view of each frame
+        self.assertEqual(['0.000000', '0.033367'], frames[0].columns['pkt_pts_time'])
+        self.assertEqual({'media_type': 'audio', 'pkt_pts_time': '0.000000', 'pkt_duration_time': 'N/A'},
+                         frames[1][-1])
+        self.assertEqual(list(frames[0]), frames[0])
+        self.assertEqual(frames[0][1:], [frames[0][1]])
+        self.assertEqual({'media_type': 'video', 'pkt_pts_time': '0.033367', 'pkt_duration_time': '0.033367'},
+                         frames[0][1])
+        table = ffmpeg_api.get_frame_table(frames[0])
+        self.assertEqual([0.0, 0.033367], list(table['pkt_pts_time']))
+        self.assertTrue(np.isnan(table['pkt_dts_time']).all())
+        self.assertTrue(np.isnan(ffmpeg_api.get_frame_table(frames[1])['pkt_duration_time'][0]))
+        meta = {'codec_type': 'video', 'nb_frames': '2', 'avg_frame_rate': '30/1', 'r_frame_rate': '30/1'}
+        self.assertFalse(ffmpeg_api.is_vfr(meta, frames[0]))
+        self.assertTrue(ffmpeg_api.is_vfr(meta, frames[0] + frames[1]))
+
     def test_frame_count(self):
 
 